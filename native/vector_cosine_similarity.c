@@ -4,6 +4,7 @@
 #include <stdlib.h>
 #include <stdio.h>
 #include <ctype.h>
+#include <stdint.h>
 SQLITE_EXTENSION_INIT1
 
 typedef struct {
@@ -130,8 +131,82 @@ static void vector_cosine_similarity(sqlite3_context *ctx, int argc, sqlite3_val
   sqlite3_result_double(ctx, similarity);
 }
 
+// 1bit量子化されたベクトル同士のハミング距離を計算する
+static void vector_hamming_distance(sqlite3_context *ctx, int argc, sqlite3_value **argv) {
+  const unsigned char *a = (const unsigned char *)sqlite3_value_blob(argv[0]);
+  const unsigned char *b = (const unsigned char *)sqlite3_value_blob(argv[1]);
+  int na = sqlite3_value_bytes(argv[0]);
+  int nb = sqlite3_value_bytes(argv[1]);
+  sqlite3_int64 distance = 0;
+  uint64_t x, y;
+  int i = 0;
+
+  if (a == NULL || b == NULL) {
+    sqlite3_result_null(ctx);
+    return;
+  }
+
+  if (na != nb) {
+    sqlite3_result_error(ctx, "lengths of given bit vectors differ.", -1);
+    return;
+  }
+
+  for (; i + 8 <= na; i += 8) {
+    memcpy(&x, a + i, 8);
+    memcpy(&y, b + i, 8);
+    distance += __builtin_popcountll(x ^ y);
+  }
+
+  for (; i < na; i++) {
+    distance += __builtin_popcount(a[i] ^ b[i]);
+  }
+
+  sqlite3_result_int64(ctx, distance);
+}
+
+// int8量子化されたベクトル同士の内積を計算する
+static void vector_int8_dot(sqlite3_context *ctx, int argc, sqlite3_value **argv) {
+  const int8_t *a = (const int8_t *)sqlite3_value_blob(argv[0]);
+  const int8_t *b = (const int8_t *)sqlite3_value_blob(argv[1]);
+  int na = sqlite3_value_bytes(argv[0]);
+  int nb = sqlite3_value_bytes(argv[1]);
+  sqlite3_int64 dot_product = 0;
+  int i;
+
+  if (a == NULL || b == NULL) {
+    sqlite3_result_null(ctx);
+    return;
+  }
+
+  if (na != nb) {
+    sqlite3_result_error(ctx, "dimensions of given vectors differ.", -1);
+    return;
+  }
+
+  for (i = 0; i < na; i++) {
+    dot_product += (int32_t)a[i] * (int32_t)b[i];
+  }
+
+  sqlite3_result_int64(ctx, dot_product);
+}
+
 int sqlite3_extension_init(sqlite3 *db, char **pzErrMsg, const sqlite3_api_routines *pApi) {
+  int rc;
   SQLITE_EXTENSION_INIT2(pApi);
 
-  return sqlite3_create_function(db, "similarity", 2, SQLITE_ANY, NULL, vector_cosine_similarity, NULL, NULL);
+  rc = sqlite3_create_function(db, "similarity", 2, SQLITE_ANY, NULL, vector_cosine_similarity, NULL, NULL);
+  if (rc != SQLITE_OK) {
+    return rc;
+  }
+
+  rc = sqlite3_create_function(
+    db, "hamming_distance", 2, SQLITE_ANY | SQLITE_DETERMINISTIC, NULL, vector_hamming_distance, NULL, NULL
+  );
+  if (rc != SQLITE_OK) {
+    return rc;
+  }
+
+  return sqlite3_create_function(
+    db, "int8_dot", 2, SQLITE_ANY | SQLITE_DETERMINISTIC, NULL, vector_int8_dot, NULL, NULL
+  );
 }
@@ -2,13 +2,30 @@ from os.path import dirname, join
 from typing import Optional
 from openai_secretary.agent import Agent
 from openai_secretary.database.models import Conversation, Message
+from openai_secretary.embedding import EmbeddingBackend
+from openai_secretary.memory import MemoryConfig
 from openai_secretary.resource import ContextItem, Emotion, IAgent
 
 
-def init_agent(*, debug: bool = False, conversation_id: Optional[int] = None) -> Agent:
+def read_api_key() -> str:
   with open(join(dirname(__file__), '..', '.secret')) as f:
-    key = f.read().strip()
+    return f.read().strip()
 
-  agent = Agent(key, debug=debug, conversation_id=conversation_id)
+
+def init_agent(
+  *,
+  debug: bool = False,
+  conversation_id: Optional[int] = None,
+  memory: Optional[MemoryConfig] = None,
+  embedding: Optional[EmbeddingBackend] = None,
+  api_key: Optional[str] = None,
+) -> Agent:
+  agent = Agent(
+    api_key or read_api_key(),
+    debug=debug,
+    conversation_id=conversation_id,
+    memory=memory,
+    embedding=embedding,
+  )
 
   return agent
@@ -1,12 +1,92 @@
+from argparse import ArgumentParser, FileType, Namespace
+import asyncio
 import atexit
-from asyncio import run
+import json
 from os.path import join, expanduser
+from queue import SimpleQueue
+from random import random
+from statistics import quantiles
 import sys
-from openai_secretary import init_agent
+from time import perf_counter
+from threading import Thread
+from typing import Any, AsyncIterator, Callable, TextIO, TypeVar
+from openai_secretary import Agent, init_agent
+from openai_secretary.arguments import add_client_arguments, add_embedding_arguments, client_config, embedding_backend
+from openai_secretary.checkpoint import checkpointer
+from openai_secretary.client import openai_client
+from openai_secretary.embedding import EmbeddingBackend
+from openai_secretary.memory.arguments import add_memory_arguments, memory_config
 from readline import read_history_file, set_history_length, write_history_file
 
 
-async def main():
+T = TypeVar('T')
+
+
+class BlockingCalls:
+  """
+  BlockingCalls runs blocking calls one at a time in a single long-lived daemon thread, which unlike the default
+  executor does not keep the process alive after Ctrl-C while it waits for a line.
+  """
+  requests: SimpleQueue[Callable[[], None]]
+  thread: Thread | None = None
+
+  def __init__(self) -> None:
+    self.requests = SimpleQueue()
+
+  def _serve(self) -> None:
+    while True:
+      self.requests.get()()
+
+  async def call(self, func: Callable[..., T], *args: Any) -> T:
+    loop = asyncio.get_running_loop()
+    future: asyncio.Future[T] = loop.create_future()
+
+    def settle(set: Callable[[Any], None], value: Any) -> None:
+      if not future.done():
+        set(value)
+
+    def run() -> None:
+      try:
+        result = func(*args)
+      except BaseException as e:
+        loop.call_soon_threadsafe(settle, future.set_exception, e)
+      else:
+        loop.call_soon_threadsafe(settle, future.set_result, result)
+
+    if self.thread is None:
+      self.thread = Thread(target=self._serve, daemon=True)
+      self.thread.start()
+    self.requests.put(run)
+    return await future
+
+
+blocking = BlockingCalls()
+
+
+async def read_lines(stream: TextIO) -> AsyncIterator[str]:
+  """
+  Yield lines of a file or pipe without blocking the event loop, as soon as each of them arrives. A reader thread
+  reads ahead into a queue, so that reading the next line overlaps handling the previous one.
+  """
+  loop = asyncio.get_running_loop()
+  lines: asyncio.Queue[str | BaseException] = asyncio.Queue()
+
+  def read() -> None:
+    try:
+      while line := stream.readline():
+        loop.call_soon_threadsafe(lines.put_nowait, line)
+      loop.call_soon_threadsafe(lines.put_nowait, '')
+    except BaseException as e:
+      loop.call_soon_threadsafe(lines.put_nowait, e)
+
+  Thread(target=read, daemon=True).start()
+  while line := await lines.get():
+    if isinstance(line, BaseException):
+      raise line
+    yield line.rstrip('\n')
+
+
+async def interactive(args: Namespace, embedding: EmbeddingBackend | None) -> None:
   history = join(expanduser("~"), ".oai_secretary", "input_history")
 
   try:
@@ -17,15 +97,130 @@ async def main():
   atexit.register(write_history_file, history)
   set_history_length(1000)
 
-  agent = init_agent(debug="--debug" in sys.argv)
+  agent = init_agent(debug=args.debug, embedding=embedding, memory=memory_config(args))
+  loop = asyncio.get_running_loop()
+  checkpoint_task = loop.create_task(checkpointer.run(60.0))
+  compaction: asyncio.Task[int] | None = None
 
   while True:
     try:
-      message = input('You: ')
+      # input() runs in a thread, so that compaction and checkpointing go on while the prompt waits.
+      message = await blocking.call(input, 'You: ')
       print('Agent:', await agent.talk(message))
-    except KeyboardInterrupt:
+      if compaction is None or compaction.done():
+        compaction = loop.create_task(agent.compact_memory())
+    except (KeyboardInterrupt, EOFError):
       print('Bye!')
       break
+    except asyncio.CancelledError:
+      # Ctrl-C cancels the main task, which must still end cancelled.
+      print('Bye!')
+      checkpoint_task.cancel()
+      raise
+
+  checkpoint_task.cancel()
+  if compaction is not None:
+    await compaction
+
+
+async def batch(args: Namespace, embedding: EmbeddingBackend | None) -> None:
+  """
+  Run every message of the input as a turn and report per-turn latency and throughput.
+
+  A line is either a plain message, which is assigned to `--conversations` in turn, or a JSON object with `message`
+  and optionally `conversation` and `need_response`. Turns of a conversation run in input order, and turns of
+  different conversations run concurrently up to `--concurrency`.
+  """
+  conversations: list[int | None] = [int(c) for c in args.conversations.split(',')] if args.conversations else [None]
+  agents: dict[int | None, Agent] = {}
+  queues: dict[int | None, asyncio.Queue[tuple[int, str, bool] | None]] = {}
+  workers: list[asyncio.Task[None]] = []
+  slots = asyncio.Semaphore(args.concurrency)
+  latencies: list[float] = []
+
+  async def worker(cid: int | None, queue: asyncio.Queue[tuple[int, str, bool] | None]) -> None:
+    while (turn := await queue.get()) is not None:
+      number, message, need_response = turn
+      async with slots:
+        start = perf_counter()
+        try:
+          reply = await agents[cid].talk(message, need_response=need_response)
+        except Exception as e:
+          reply = f'<error: {type(e).__name__}: {e}>'
+        elapsed = perf_counter() - start
+      latencies.append(elapsed)
+      print(f'{number}\t{agents[cid].cid}\t{elapsed * 1000:.1f} ms\t{message}\t{reply}', flush=True)
+
+  start = perf_counter()
+  number = 0
+  async for line in read_lines(args.batch):
+    if not line.strip():
+      continue
+    cid = conversations[number % len(conversations)]
+    need_response = random() < args.response_ratio
+    message = line
+    if line.lstrip().startswith('{'):
+      turn = json.loads(line)
+      message = turn['message']
+      cid = turn.get('conversation', cid)
+      need_response = turn.get('need_response', need_response)
+
+    if cid not in agents:
+      agents[cid] = init_agent(
+        debug=args.debug, conversation_id=cid, embedding=embedding, memory=memory_config(args)
+      )
+      queues[cid] = asyncio.Queue()
+      workers.append(asyncio.get_running_loop().create_task(worker(cid, queues[cid])))
+    number += 1
+    queues[cid].put_nowait((number, message, need_response))
+
+  for queue in queues.values():
+    queue.put_nowait(None)
+  await asyncio.gather(*workers)
+  elapsed = perf_counter() - start
+
+  for agent in agents.values():
+    agent.close()
+  if not latencies:
+    print('no messages.', file=sys.stderr)
+    return
+
+  cuts = quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else [latencies[0]] * 99
+  print(
+    f'{len(latencies)} turns in {len(agents)} conversations, {elapsed:.2f} s, {len(latencies) / elapsed:.2f} turns/s, '
+    f'latency p50 {cuts[49] * 1000:.1f} ms, p95 {cuts[94] * 1000:.1f} ms, max {max(latencies) * 1000:.1f} ms',
+    file=sys.stderr,
+  )
+
+
+async def main():
+  parser = ArgumentParser(prog='python -m openai_secretary', description='talk with the agent.')
+  parser.add_argument('--debug', action='store_true', help='print debug logs.')
+  parser.add_argument(
+    '--batch', type=FileType('r'), default=None, help='run messages of a file, or - for stdin, without prompting.'
+  )
+  parser.add_argument('--conversations', default=None, help='comma separated conversation ids of batch turns.')
+  parser.add_argument('--concurrency', type=int, default=4, help='batch turns in flight at once.')
+  parser.add_argument('--response-ratio', type=float, default=1.0, help='ratio of batch turns which need a response.')
+  add_memory_arguments(parser)
+  add_client_arguments(parser)
+  add_embedding_arguments(parser)
+  args = parser.parse_args()
+
+  atexit.register(checkpointer.flush)
+  openai_client.configure(client_config(args))
+  embedding = embedding_backend(args)
+
+  try:
+    if args.batch is not None:
+      await batch(args, embedding)
+    else:
+      await interactive(args, embedding)
+  finally:
+    await openai_client.close()
 
 
-run(main())
+try:
+  asyncio.run(main())
+except KeyboardInterrupt:
+  pass
@@ -1,3 +1,4 @@
+import asyncio
 from datetime import datetime
 from os import linesep as LF
 import json
@@ -7,13 +8,20 @@ from typing import Any, cast
 import openai as oai
 from openai.openai_object import OpenAIObject
 from openai.error import Timeout
-from pony.orm import db_session, desc, select, raw_sql
+from pony.orm import commit, db_session, desc, flush, max as orm_max, select
 
+from openai_secretary.checkpoint import checkpointer
+from openai_secretary.client import OpenAIClient, openai_client
 from openai_secretary.database import Master
-from openai_secretary.database.models import Conversation, Message, SavedEmotion
+from openai_secretary.database.models import Conversation, Message
+from openai_secretary.database.sharding import shard
+from openai_secretary.embedding import EmbeddingBackend, OpenAIEmbedding
+from openai_secretary.memory import MemoryConfig, TieredMemory
+from openai_secretary.metrics import metrics
 from openai_secretary.resource import ContextItem, Emotion, IAgent
 from openai_secretary.resource.iagent import RoleType
 import openai_secretary.resource.resources as res
+from openai_secretary.scoring import EmotionBatcher, emotion_batcher
 
 logger = logging.getLogger('oai_chatbot.agent')
 
@@ -23,6 +31,11 @@ class Agent(IAgent):
   emotion: Emotion
   emotion_delta: float = 0.5
   cid: int
+  memory: TieredMemory
+  openai: OpenAIClient
+  embedding: EmbeddingBackend
+  batcher: EmotionBatcher
+  emotion_lock: asyncio.Lock
 
   @property
   def _debug(self) -> bool:
@@ -32,39 +45,56 @@ class Agent(IAgent):
   def _debug(self, value: bool) -> None:
     logger.setLevel(logging.DEBUG if value else logging.INFO)
 
-  @db_session
-  def __init__(self, api_key: str | None, *, debug: bool = False, conversation_id: int | None = None):
+  def __init__(
+    self,
+    api_key: str | None,
+    *,
+    debug: bool = False,
+    conversation_id: int | None = None,
+    memory: MemoryConfig | None = None,
+    openai: OpenAIClient | None = None,
+    embedding: EmbeddingBackend | None = None,
+    batcher: EmotionBatcher | None = None,
+  ):
     self._debug = debug
     logger.debug('debug logs on.')
+    self.memory = TieredMemory(self, memory)
+    self.openai = openai or openai_client
+    self.embedding = embedding or OpenAIEmbedding(client=self.openai)
+    self.batcher = batcher or emotion_batcher
+    self.emotion_lock = asyncio.Lock()
 
-    master: Master | None = Master.select().order_by(desc(Master.version)).first()
+    with db_session:
+      master: Master | None = Master.select().order_by(desc(Master.version)).first()
 
-    if master is None or master.api_key != api_key:
-      master = Master(api_key=api_key)
+      if master is None or master.api_key != api_key:
+        master = Master(api_key=api_key)
 
-    oai.api_key = master.api_key
+      oai.api_key = master.api_key
 
-    if conversation_id is not None:
-      conv = Conversation.get(id=conversation_id)
-    else:
-      conv = Conversation.select().order_by(desc(Conversation.last_interact_at)).first()
+    with shard(conversation_id), db_session:
+      if conversation_id is not None:
+        conv = Conversation.get(id=conversation_id)
+      else:
+        conv = Conversation.select().order_by(desc(Conversation.last_interact_at)).first()
 
-    if conv is None:
-      logger.debug('no existing conversations found. initializing conversation.')
-      conv = self.init_conversation(conversation_id)
+      if conv is None:
+        logger.debug('no existing conversations found. initializing conversation.')
+        conv = self.init_conversation(conversation_id)
 
-    system = select(m for m in Message if m.role == 'system' and m.conversation == conv).order_by(Message.index)
-    self.cid = conv.id
+      system = select(m for m in Message if m.role == 'system' and m.conversation == conv).order_by(Message.index)
+      self.cid = conv.id
 
-    emo = SavedEmotion.get(id=self.cid)
-    if emo is None:
-      self.emotion = Emotion.random_emotion()
-      SavedEmotion(id=self.cid, emotion_set=json.dumps(self.emotion.json()))
-    else:
-      self.emotion = Emotion(*json.loads(emo.emotion_set))
+      checkpointer.attach(self)
 
-    self.context = [{'role': cast(RoleType, msg.role), 'content': msg.text} for msg in system]
-    res.create_initial_context(conv, self)
+      self.context = [{'role': cast(RoleType, msg.role), 'content': msg.text} for msg in system]
+      res.create_initial_context(conv, self)
+
+  def close(self) -> None:
+    """
+    Checkpoint the emotion and release the agent.
+    """
+    checkpointer.evict(self)
 
   def debugLog(self, *args: Any) -> None:
     if self._debug:
@@ -72,7 +102,7 @@ class Agent(IAgent):
 
   @property
   def initial_message(self) -> str:
-    with db_session:
+    with shard(self.cid), db_session:
       # yapf: disable
       msg = select(
         m for m in Message
@@ -89,7 +119,7 @@ class Agent(IAgent):
 
   @initial_message.setter
   def initial_message(self, message: str) -> None:
-    with db_session:
+    with shard(self.cid), db_session:
       # yapf: disable
       msg = select(
         m for m in Message if m.role == 'system' and m.conversation.id == self.cid
@@ -102,8 +132,9 @@ class Agent(IAgent):
       self.context[0]['content'] = message
     # yapf: enable
 
+  @staticmethod
   @db_session
-  def init_conversation(self, id: int | None) -> Conversation:
+  def init_conversation(id: int | None) -> Conversation:
     if id is None:
       conv = Conversation(
         name='Default',
@@ -130,13 +161,31 @@ class Agent(IAgent):
         conversation=conv,
       )
 
+    # the default conversation gets its id on flush, and its emotion is checkpointed by id.
+    flush()
     return conv
 
-  async def get_embedding_vector(self, text: str) -> list[str]:
-    resp = cast(dict, await oai.Embedding.acreate(model="text-search-ada-doc-001", input=text))
-    obj = resp.get('data', [{}])[0]
-    assert obj['object'] == 'embedding'
-    return obj['embedding']
+  def count_tokens(self, endpoint: str, usage: dict | None) -> None:
+    if not usage:
+      return
+    for kind in ('prompt', 'completion'):
+      if f'{kind}_tokens' not in usage:
+        continue
+      metrics.inc(
+        'openai_tokens_total', usage.get(f'{kind}_tokens', 0), conversation=self.cid, endpoint=endpoint, kind=kind
+      )
+
+  async def get_embedding_vector(self, text: str) -> tuple[list[float], str]:
+    """
+    Embed a text with the agent's backend.
+
+    Returns:
+      tuple[list[float], str]: The vector and its embedding space.
+    """
+    with metrics.span('embedding', backend=self.embedding.name):
+      vectors, space, usage = await self.embedding.embed([text])
+    self.count_tokens('embedding', usage)
+    return vectors[0], space
 
   async def get_emotional_vector(self, text: str, context: str | None = None) -> list[float]:
     prompt = f"""evaluate how the text moves emotions along each of the five axes with a number within 20 steps -10 to 10.
@@ -146,9 +195,8 @@ extreme evaluations are not preferable.
 text:{text}
 evaluation:"""
     try:
-      resp = cast(
-        dict,
-        await oai.Completion.acreate(
+      with metrics.span('emotion'):
+        resp = await self.openai.completion(
           model="text-davinci-003",
           prompt=prompt,
           temperature=0.2,
@@ -159,43 +207,102 @@ evaluation:"""
           presence_penalty=0,
           request_timeout=10.0,
           timeout=5.0,
-        ),
-      )
+        )
+      self.count_tokens('emotion', resp.get('usage'))
       vec: list[int] = json.loads(resp["choices"][0]["text"].strip().split('\n')[0])
-    except:
+    except Exception as e:
+      metrics.inc('openai_timeouts_total' if isinstance(e, Timeout) else 'emotion_fallbacks_total', endpoint='emotion')
       return [0.0, 0.0, 0.0, 0.0, 0.0]
 
     return [i / 10 * self.emotion_delta for i in vec]
 
-  def create_context_for_reply(self, c: Conversation, search_vec: str) -> list[ContextItem]:
+  async def summarize(self, texts: list[str]) -> str:
+    with metrics.span('summarize'):
+      resp = await self.openai.chat(
+        model='gpt-3.5-turbo',
+        messages=[
+          {'role': 'system', 'content': res.summary_prompt},
+          {'role': 'user', 'content': LF.join(texts)},
+        ],
+        temperature=0.2,
+        max_tokens=256,
+        request_timeout=(3.0, 30.0),
+        timeout=20.0,
+      )
+    self.count_tokens('summary', resp.get('usage'))
+    return resp["choices"][0]["message"]["content"].strip()
+
+  async def compact_memory(self) -> int:
+    with shard(self.cid):
+      return await self.memory.compact()
+
+  def create_context_for_reply(
+    self,
+    c: Conversation,
+    search_vec: str,
+    space: str,
+    query: str | None = None,
+  ) -> list[ContextItem]:
     context = self.context.copy()
+    # yapf: disable
     recent = [
-      *select(m for m in Message if m.role != 'system' and m.conversation == c).order_by(desc(Message.index))[:10]
+      *select(
+        m for m in Message if m.role != 'system' and m.conversation == c
+      ).order_by(desc(Message.index))[:self.memory.config.recent]
     ]
+    # yapf: enable
     recent.reverse()
     context.extend({'role': cast(RoleType, msg.role), 'content': msg.text} for msg in recent)
     oldest_recent_index = recent[0].index if recent else 0
 
-    # yapf: disable
-    ctx = select(
-      (m, raw_sql('similarity(m.embeddings, $search_vec) as "sim"', result_type=float))
-      for m in Message if m.embeddings is not None and m.index < oldest_recent_index and m.conversation == c
-    ).order_by(
-      lambda m, s: desc(raw_sql('"sim"'))
-    )[:10]
-    # yapf: enable
+    with metrics.span('recall'):
+      recollections = self.memory.recall(c, search_vec, space, oldest_recent_index, query)
 
-    for m, similarity in ctx:
-      context.append({'role': 'system', 'content': f'過去にこんな会話をした:{m.text}'})
-      logger.debug(f'related message (similarity: {similarity}): {m.text}')
+    for text, similarity, summary in recollections:
+      if summary:
+        context.append({'role': 'system', 'content': f'過去の会話の要約:{text}'})
+        logger.debug(f'related summary (similarity: {similarity}): {text}')
+      else:
+        context.append({'role': 'system', 'content': f'過去にこんな会話をした:{text}'})
+        logger.debug(f'related message (similarity: {similarity}): {text}')
 
     return context
 
   async def update_emotion(self, message: str, emotion_context: str | None) -> None:
-    em = await self.get_emotional_vector(message, emotion_context)
-    logger.debug(f'emotion delta: {em}')
-    self.emotion += em
-    logger.debug(f'current emotion: {repr(self.emotion)}')
+    # the delta is requested before waiting for earlier turns, so that a burst of turns shares one batch, while deltas
+    # are still applied in the order the turns arrived.
+    delta = self.batcher.submit(self, message, emotion_context)
+    async with self.emotion_lock:
+      em = await delta
+      logger.debug(f'emotion delta: {em}')
+      if any(em):
+        self.emotion += em
+        checkpointer.mark_dirty(self)
+      logger.debug(f'current emotion: {repr(self.emotion)}')
+
+  def add_message(self, role: RoleType, text: str, vec: list[float], space: str) -> None:
+    """
+    Append an embedded message to the conversation and commit it.
+    """
+    with shard(self.cid), db_session:
+      c = Conversation[self.cid]
+      # old messages may have been pruned, so that the count of messages can collide with an existing index.
+      latest = orm_max(m.index for m in Message if m.conversation == c)
+      msg = Message(
+        index=latest + 1 if latest is not None else 0,
+        role=role,
+        text=text,
+        embeddings=str(vec),
+        space=space,
+        created_at=datetime.now(),
+        conversation=c,
+      )
+      self.memory.index_message(msg, vec)
+
+      if role == 'assistant':
+        c.last_interact_at = datetime.now()
+      with metrics.span('db_commit'):
+        commit()
 
   async def talk(
     self,
@@ -204,16 +311,15 @@ evaluation:"""
     need_response: bool = True,
     emotion_context: str | None = None,
   ) -> str:
-    with db_session:
-      c = Conversation.get(id=self.cid)
-
-      vec1 = await self.get_embedding_vector(message)
-      context = self.create_context_for_reply(c, str(vec1))
+    metrics.inc('messages_total', conversation=self.cid, need_response=need_response)
+    # db_sessions are kept short and never span an await, so that interleaved turns of other channels neither share
+    # them nor wait for a write lock held across OpenAI calls.
+    with metrics.span('talk', need_response=need_response), shard(self.cid):
+      vec1, space1 = await self.get_embedding_vector(message)
+      with metrics.span('context'), db_session:
+        context = self.create_context_for_reply(Conversation[self.cid], str(vec1), space1, message)
       await self.update_emotion(message, emotion_context)
 
-      s_emo = SavedEmotion.get(id=self.cid)
-      s_emo.emotion_set = json.dumps(self.emotion.json())
-
       context.append({'role': 'system', 'content': f'あなたの今の心情は{self.emotion}である。'})
 
       if injected_system_message is not None:
@@ -221,14 +327,7 @@ evaluation:"""
 
       context.append({'role': 'user', 'content': message})
 
-      msg = Message(
-        index=len(c.messages),
-        role='user',
-        text=message,
-        embeddings=str(vec1),
-        created_at=datetime.now(),
-        conversation=c,
-      )
+      self.add_message('user', message, vec1, space1)
 
       if not need_response:
         logger.debug('no response needed')
@@ -236,21 +335,24 @@ evaluation:"""
 
       logger.debug(json.dumps(context, indent=2, ensure_ascii=False))
 
+      attempt = 0
       while True:
+        if attempt:
+          metrics.inc('openai_retries_total', endpoint='chat')
+        attempt += 1
         try:
-          response = cast(
-            dict,
-            await oai.ChatCompletion.acreate(
+          with metrics.span('chat_completion'):
+            response = await self.openai.chat(
               model='gpt-3.5-turbo',
               messages=context,
               temperature=0.8,
               max_tokens=256,
               request_timeout=(3.0, 20.0),
               timeout=10.0,
-            ),
-          )
+            )
           break
         except Timeout as e:
+          metrics.inc('openai_timeouts_total', endpoint='chat')
           logger.warn(f'read error: {type(e)}: {e}')
           pass
         except Exception as e:
@@ -260,17 +362,8 @@ evaluation:"""
       text = response["choices"][0]["message"]["content"]
 
       logger.debug(f'tokens consumed: {response["usage"]["total_tokens"]}')
+      self.count_tokens('chat', response['usage'])
 
-      vec2 = await self.get_embedding_vector(text)
-
-      msg = Message(
-        index=len(c.messages),
-        role='assistant',
-        text=text,
-        embeddings=str(vec2),
-        created_at=datetime.now(),
-        conversation=c
-      )
-
-      c.last_interact_at = datetime.now()
-      return msg.text
+      vec2, space2 = await self.get_embedding_vector(text)
+      self.add_message('assistant', text, vec2, space2)
+      return text
@@ -0,0 +1,75 @@
+from argparse import ArgumentParser, Namespace
+from typing import Any
+
+from openai_secretary.client import ClientConfig
+from openai_secretary.embedding import EmbeddingBackend, create_backend
+
+_client_options: dict[str, tuple[str, dict[str, Any]]] = {
+  'http_limit': ('limit', {'type': int, 'help': 'maximum number of open connections to OpenAI.'}),
+  'http_limit_per_host': ('limit_per_host', {'type': int, 'help': 'maximum number of open connections to a host.'}),
+  'dns_ttl': ('ttl_dns_cache', {'type': int, 'help': 'seconds for which DNS lookups are cached.'}),
+  'keepalive': ('keepalive_timeout', {'type': float, 'help': 'seconds for which an idle connection is kept open.'}),
+}
+"""
+Options of the OpenAI connection pool, and the `ClientConfig` fields they set. Omitted options keep the defaults of
+`ClientConfig`.
+"""
+
+
+def add_client_arguments(parser: ArgumentParser) -> None:
+  group = parser.add_argument_group('http')
+  for name, (_, options) in _client_options.items():
+    group.add_argument(f'--{name.replace("_", "-")}', dest=name, default=None, **options)
+
+
+def _given(args: Namespace) -> dict[str, Any]:
+  values = {name: getattr(args, name) for name in _client_options}
+  return {name: value for name, value in values.items() if value is not None}
+
+
+def client_config(args: Namespace) -> ClientConfig:
+  """
+  Build a `ClientConfig` from options added by `add_client_arguments`.
+  """
+  return ClientConfig(**{_client_options[name][0]: value for name, value in _given(args).items()})
+
+
+def client_argv(args: Namespace) -> list[str]:
+  """
+  Format options added by `add_client_arguments` back into arguments, to be passed on to worker processes.
+  """
+  argv: list[str] = []
+  for name, value in _given(args).items():
+    argv += [f'--{name.replace("_", "-")}', str(value)]
+  return argv
+
+
+def add_embedding_arguments(parser: ArgumentParser) -> None:
+  group = parser.add_argument_group('embedding')
+  group.add_argument('--embedding', choices=['openai', 'hashed'], default=None, help='embedding backend.')
+  group.add_argument(
+    '--local-embedding', action='store_const', dest='embedding', const='hashed', help='same as --embedding hashed.'
+  )
+  group.add_argument('--embedding-dims', type=int, default=None, help='dimension of the hashed backend.')
+  group.add_argument('--embedding-idf', default=None, help='IDF table of the hashed backend.')
+
+
+def embedding_backend(args: Namespace) -> EmbeddingBackend | None:
+  """
+  Create the backend chosen by options added by `add_embedding_arguments`. None leaves the OpenAI backend to agents,
+  which embed with their own API key.
+  """
+  if args.embedding in (None, 'openai'):
+    return None
+  return create_backend(args.embedding, dims=args.embedding_dims, idf_path=args.embedding_idf)
+
+
+def embedding_argv(args: Namespace) -> list[str]:
+  """
+  Format options added by `add_embedding_arguments` back into arguments, to be passed on to worker processes.
+  """
+  argv: list[str] = []
+  for name in ('embedding', 'embedding_dims', 'embedding_idf'):
+    if (value := getattr(args, name)) is not None:
+      argv += [f'--{name.replace("_", "-")}', str(value)]
+  return argv
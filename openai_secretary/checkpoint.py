@@ -0,0 +1,112 @@
+import asyncio
+from datetime import datetime
+import json
+from logging import getLogger
+from typing import TYPE_CHECKING
+
+from pony.orm import commit, db_session
+
+from openai_secretary.database.models import EmotionCheckpoint, SavedEmotion
+from openai_secretary.database.sharding import location, shard
+from openai_secretary.metrics import metrics
+from openai_secretary.resource.emotion import Emotion
+
+if TYPE_CHECKING:
+  from openai_secretary.agent import Agent
+
+logger = getLogger('oai_chatbot.checkpoint')
+
+
+class EmotionCheckpointer:
+  """
+  EmotionCheckpointer persists emotions of live agents in batches instead of on every turn.
+
+  Agents mark their emotion dirty when it changes, and dirty emotions are written in a single transaction per
+  database file by `flush`, which runs periodically, when an agent is evicted and at shutdown.
+  """
+  agents: dict[int, 'Agent']
+  dirty: set[int]
+
+  def __init__(self) -> None:
+    self.agents = {}
+    self.dirty = set()
+
+  @db_session
+  def attach(self, agent: 'Agent') -> None:
+    """
+    Restore the emotion of the agent's conversation and start tracking the agent.
+    """
+    self.agents[agent.cid] = agent
+
+    if (checkpoint := EmotionCheckpoint.get(id=agent.cid)) is not None:
+      agent.emotion = Emotion.from_bytes(checkpoint.state)
+      return
+
+    # emotions saved before checkpointing have no decay origin, so the decay restarts from now.
+    if (saved := SavedEmotion.get(id=agent.cid)) is not None:
+      agent.emotion = Emotion(*json.loads(saved.emotion_set))
+    else:
+      agent.emotion = Emotion.random_emotion()
+    self.dirty.add(agent.cid)
+
+  def mark_dirty(self, agent: 'Agent') -> None:
+    self.dirty.add(agent.cid)
+
+  def _write(self, cids: list[int]) -> None:
+    with shard(cids[0]), db_session:
+      now = datetime.now()
+      for cid in cids:
+        state = self.agents[cid].emotion.to_bytes()
+        if (checkpoint := EmotionCheckpoint.get(id=cid)) is None:
+          EmotionCheckpoint(id=cid, state=state, updated_at=now)
+        else:
+          checkpoint.set(state=state, updated_at=now)
+      commit()
+
+  def flush(self) -> int:
+    """
+    Write every dirty emotion, in one transaction per database file.
+
+    Returns:
+      int: Number of written emotions.
+    """
+    cids = [cid for cid in self.dirty if cid in self.agents]
+    if not cids:
+      return 0
+
+    groups: dict[str, list[int]] = {}
+    for cid in cids:
+      with shard(cid):
+        groups.setdefault(location(), []).append(cid)
+
+    with metrics.span('emotion_flush'):
+      for group in groups.values():
+        self._write(group)
+
+    self.dirty.difference_update(cids)
+    metrics.inc('emotion_checkpoints_total', len(cids))
+    return len(cids)
+
+  def evict(self, agent: 'Agent') -> None:
+    """
+    Flush and stop tracking the agent.
+    """
+    self.flush()
+    if self.agents.get(agent.cid) is agent:
+      del self.agents[agent.cid]
+
+  async def run(self, interval: float) -> None:
+    logger.info('emotion checkpointer has been started.')
+    while True:
+      await asyncio.sleep(interval)
+      try:
+        if written := self.flush():
+          logger.debug(f'{written} emotions are checkpointed.')
+      except Exception as e:
+        logger.error(f'failed to checkpoint emotions: {type(e)}: {e}')
+
+
+checkpointer = EmotionCheckpointer()
+"""
+Process wide emotion checkpointer.
+"""
@@ -0,0 +1,89 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, cast
+
+from aiohttp import ClientSession, TCPConnector
+import openai as oai
+
+from openai_secretary.metrics import metrics
+
+
+@dataclass(frozen=True)
+class ClientConfig:
+  """
+  ClientConfig controls the connection pool shared by every OpenAI request of the process.
+  """
+  limit: int = 100
+  """Maximum number of open connections. Requests beyond it wait for a free connection."""
+  limit_per_host: int = 32
+  """Maximum number of open connections to a single host, which bounds concurrent OpenAI requests."""
+  ttl_dns_cache: int | None = 300
+  """Seconds for which DNS lookups are cached. None caches them forever."""
+  keepalive_timeout: float = 30.0
+  """Seconds for which an idle connection is kept open."""
+
+
+class OpenAIClient:
+  """
+  OpenAIClient sends OpenAI requests through one keep-alive connection pool.
+
+  Without a shared session, the openai library opens a new session, and thus a new TLS connection, for every request.
+  The pool is created lazily on the running event loop, and is recreated when the loop changes.
+  """
+  config: ClientConfig
+  _session: ClientSession | None = None
+  _loop: asyncio.AbstractEventLoop | None = None
+
+  def __init__(self, config: ClientConfig | None = None) -> None:
+    self.config = config or ClientConfig()
+
+  def configure(self, config: ClientConfig) -> None:
+    """
+    Replace the configuration. It takes effect when the next pool is created.
+    """
+    self.config = config
+
+  def session(self) -> ClientSession:
+    loop = asyncio.get_running_loop()
+    if self._session is None or self._session.closed or self._loop is not loop:
+      cfg = self.config
+      connector = TCPConnector(
+        limit=cfg.limit,
+        limit_per_host=cfg.limit_per_host,
+        ttl_dns_cache=cfg.ttl_dns_cache,
+        keepalive_timeout=cfg.keepalive_timeout,
+      )
+      self._session = ClientSession(connector=connector)
+      self._loop = loop
+      metrics.inc('openai_sessions_total')
+    return self._session
+
+  async def _request(self, create: Callable[..., Awaitable[Any]], **params: Any) -> dict:
+    token = oai.aiosession.set(self.session())
+    try:
+      return cast(dict, await create(**params))
+    finally:
+      oai.aiosession.reset(token)
+
+  async def embedding(self, **params: Any) -> dict:
+    return await self._request(oai.Embedding.acreate, **params)
+
+  async def completion(self, **params: Any) -> dict:
+    return await self._request(oai.Completion.acreate, **params)
+
+  async def chat(self, **params: Any) -> dict:
+    return await self._request(oai.ChatCompletion.acreate, **params)
+
+  async def close(self) -> None:
+    """
+    Close the pool. A new one is created on the next request.
+    """
+    session, self._session, self._loop = self._session, None, None
+    if session is not None and not session.closed:
+      await session.close()
+
+
+openai_client = OpenAIClient()
+"""
+Process wide OpenAI client.
+"""
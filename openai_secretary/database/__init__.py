@@ -1,8 +1,18 @@
-from openai_secretary.database.connection import db
+from contextlib import closing
+import sqlite3
+
+from openai_secretary.database.connection import db, db_path
+from openai_secretary.database.migrations import create_fts, migrate
 from openai_secretary.database.models import Master, Conversation, Message
 
+migrate()
 db.generate_mapping(create_tables=True)
 
+# the full-text index is kept in sync by triggers from the start, so that hybrid recall never has to build it.
+with closing(sqlite3.connect(db_path)) as connection:
+  if create_fts(connection):
+    connection.commit()
+
 __all__ = [
   'Master',
   'Conversation',
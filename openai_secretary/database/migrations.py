@@ -0,0 +1,94 @@
+import sqlite3
+from typing import Literal, TypeAlias
+
+from openai_secretary.database.connection import db_path
+
+FtsTokenizer: TypeAlias = Literal['trigram', 'unicode61']
+
+fts_table = 'message_fts'
+
+_legacy_space = "'openai:text-search-ada-doc-001:'"
+_dims = 'LENGTH("embeddings") - LENGTH(REPLACE("embeddings", \',\', \'\')) + 1'
+
+columns: list[tuple[str, str, str, str | None]] = [
+  ('Message', 'space', 'TEXT', f'"space" = {_legacy_space} || ({_dims}) WHERE "embeddings" IS NOT NULL'),
+  ('Summary', 'space', 'TEXT', f'"space" = {_legacy_space} || ({_dims}) WHERE "embeddings" IS NOT NULL'),
+  ('Reducer', 'space', 'TEXT', f'"space" = {_legacy_space} || "source_dims"'),
+]
+"""
+Columns added after their tables were first created, as `(table, column, type, backfill)`.
+
+`generate_mapping` only creates missing tables, so these columns are added to existing tables by `migrate`. Rows
+which exist when a column is added are updated by the `backfill` assignment. Embeddings stored before they were
+tagged with their space all came from the OpenAI backend.
+"""
+
+dropped_columns: list[tuple[str, str]] = [
+  ('QuantizedEmbedding', 'bits_scale'),
+]
+"""
+Columns removed from their entities as `(table, column)`. They are dropped from existing tables by `migrate`, since
+pony would not fill them in.
+"""
+
+
+def migrate(path: str = db_path) -> list[str]:
+  """
+  Configure incremental auto-vacuum of new files, add missing columns to existing tables and drop removed ones. Must
+  run before `generate_mapping`.
+
+  Returns:
+    list[str]: Added and dropped columns as `table.column`.
+  """
+  changed: list[str] = []
+  with sqlite3.connect(path) as connection:
+    # takes effect only while the file has no tables. existing files are converted by `retention vacuum --convert`.
+    connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    for table, column, kind, backfill in columns:
+      existing = [row[1] for row in connection.execute(f'PRAGMA table_info("{table}")')]
+      if not existing or column in existing:
+        continue
+      connection.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {kind}')
+      if backfill is not None:
+        connection.execute(f'UPDATE "{table}" SET {backfill}')
+      changed.append(f'{table}.{column}')
+    for table, column in dropped_columns:
+      existing = [row[1] for row in connection.execute(f'PRAGMA table_info("{table}")')]
+      if column in existing:
+        connection.execute(f'ALTER TABLE "{table}" DROP COLUMN "{column}"')
+        changed.append(f'{table}.{column}')
+  connection.close()
+  return changed
+
+
+def create_fts(connection: sqlite3.Connection, tokenizer: FtsTokenizer = 'trigram') -> bool:
+  """
+  Create the full-text index of messages unless it exists, indexing every existing message. Triggers keep it in sync
+  with `Message` from then on. Must run after `Message` is created.
+
+  Returns:
+    bool: Whether the index has been created.
+  """
+  exists = f'SELECT 1 FROM sqlite_master WHERE "type" = \'table\' AND "name" = \'{fts_table}\''
+  if connection.execute(exists).fetchone():
+    return False
+
+  connection.execute(
+    f'CREATE VIRTUAL TABLE "{fts_table}" '
+    f'USING fts5(text, content=\'Message\', content_rowid=\'id\', tokenize=\'{tokenizer}\')'
+  )
+  connection.execute(
+    f'CREATE TRIGGER "{fts_table}_ai" AFTER INSERT ON "Message" BEGIN '
+    f'INSERT INTO "{fts_table}"(rowid, text) VALUES (new."id", new."text"); END'
+  )
+  connection.execute(
+    f'CREATE TRIGGER "{fts_table}_ad" AFTER DELETE ON "Message" BEGIN '
+    f'INSERT INTO "{fts_table}"("{fts_table}", rowid, text) VALUES (\'delete\', old."id", old."text"); END'
+  )
+  connection.execute(
+    f'CREATE TRIGGER "{fts_table}_au" AFTER UPDATE OF "text" ON "Message" BEGIN '
+    f'INSERT INTO "{fts_table}"("{fts_table}", rowid, text) VALUES (\'delete\', old."id", old."text"); '
+    f'INSERT INTO "{fts_table}"(rowid, text) VALUES (new."id", new."text"); END'
+  )
+  connection.execute(f'INSERT INTO "{fts_table}"("{fts_table}") VALUES (\'rebuild\')')
+  return True
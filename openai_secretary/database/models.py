@@ -13,15 +13,32 @@ class Conversation(db.Entity):
   name = orm.Optional(str)
   description = orm.Optional(str)
   messages = orm.Set(lambda: Message)
+  summaries = orm.Set(lambda: Summary)
+  reducers = orm.Set(lambda: Reducer)
   created_at = orm.Required(datetime)
   last_interact_at = orm.Required(datetime)
 
+  def latest_space(self) -> str | None:
+    """
+    Embedding space of the latest embedded message.
+    """
+    msg = Message.select(lambda m: m.conversation == self and m.embeddings is not None).order_by(
+      orm.desc(Message.index)
+    ).first()
+    return None if msg is None else msg.space
+
 
 class SavedEmotion(db.Entity):
   id = orm.PrimaryKey(int, auto=True, size=64)
   emotion_set = orm.Required(str)
 
 
+class EmotionCheckpoint(db.Entity):
+  id = orm.PrimaryKey(int, size=64)
+  state = orm.Required(bytes)
+  updated_at = orm.Required(datetime)
+
+
 class Intimacy(db.Entity):
   id = orm.PrimaryKey(int, auto=True)
   channel_id = orm.Required(int, size=64)
@@ -61,8 +78,51 @@ class Message(db.Entity):
   role = orm.Required(str)
   text = orm.Required(str)
   embeddings = orm.Optional(str, nullable=True)
+  space = orm.Optional(str, nullable=True)
+  created_at = orm.Required(datetime)
+  conversation = orm.Required(Conversation)
+  quantized = orm.Optional(lambda: QuantizedEmbedding)
+  reduced = orm.Optional(lambda: ReducedEmbedding)
+
+
+class QuantizedEmbedding(db.Entity):
+  message = orm.PrimaryKey(Message)
+  int8 = orm.Required(bytes)
+  int8_scale = orm.Required(float)
+  bits = orm.Required(bytes)
+
+
+class Reducer(db.Entity):
+  id = orm.PrimaryKey(int, auto=True, size=64)
+  method = orm.Required(str)
+  space = orm.Optional(str, nullable=True)
+  dims = orm.Required(int)
+  source_dims = orm.Required(int)
+  mean = orm.Required(bytes)
+  matrix = orm.Required(bytes)
+  created_at = orm.Required(datetime)
+  conversation = orm.Required(Conversation)
+  embeddings = orm.Set(lambda: ReducedEmbedding)
+
+
+class ReducedEmbedding(db.Entity):
+  message = orm.PrimaryKey(Message)
+  reducer = orm.Required(Reducer)
+  vector = orm.Required(str)
+
+
+class Summary(db.Entity):
+  id = orm.PrimaryKey(int, auto=True, size=64)
+  tier = orm.Required(int)
+  first_index = orm.Required(int)
+  last_index = orm.Required(int)
+  text = orm.Required(str)
+  embeddings = orm.Optional(str, nullable=True)
+  space = orm.Optional(str, nullable=True)
   created_at = orm.Required(datetime)
   conversation = orm.Required(Conversation)
+  parent = orm.Optional(lambda: Summary, reverse='children')
+  children = orm.Set(lambda: Summary, reverse='parent')
 
 
 class Settings(db.Entity):
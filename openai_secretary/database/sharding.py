@@ -0,0 +1,221 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from os import makedirs
+from os.path import expanduser, join
+import sqlite3
+from threading import local
+from time import monotonic
+from typing import Any, Iterator
+
+from pony.orm.dbproviders.sqlite import SQLitePool
+
+from openai_secretary.database.connection import db, db_path
+from openai_secretary.database.migrations import create_fts, migrate
+from openai_secretary.metrics import metrics
+
+shard_tables: tuple[str, ...] = (
+  'Conversation',
+  'Message',
+  'Summary',
+  'Reducer',
+  'ReducedEmbedding',
+  'QuantizedEmbedding',
+  'EmotionCheckpoint',
+  'SavedEmotion',
+)
+"""
+Tables stored in shards. Other tables, such as `Master`, `Settings` and `Intimacy`, stay in the global database, and
+must be accessed in db_sessions outside of a shard context.
+"""
+
+current_shard: ContextVar[int | None] = ContextVar('oai_secretary_shard', default=None)
+
+
+@dataclass(frozen=True)
+class ShardLayout:
+  """
+  ShardLayout places conversations into database files.
+  """
+  directory: str = expanduser('~/.oai_secretary/shards')
+  """Directory of shard files."""
+  buckets: int | None = None
+  """Number of shard files conversations are hashed into. None gives every conversation its own file."""
+  max_open: int = 32
+  """Number of shard connections kept open per thread. The least recently used idle ones are closed beyond it."""
+  idle_timeout: float = 300.0
+  """Seconds after which an unused shard connection is closed by `close_idle`."""
+
+  def path(self, conversation_id: int) -> str:
+    if self.buckets is None:
+      return join(self.directory, f'conversation-{conversation_id}.db')
+    return join(self.directory, f'bucket-{conversation_id % self.buckets:04d}.db')
+
+
+def create_shard_tables(connection: sqlite3.Connection, source: str = 'global') -> None:
+  """
+  Create shard tables missing in the main database of `connection`, copying their schema from the attached
+  `source` database.
+  """
+  names = ', '.join(f"'{t}'" for t in shard_tables)
+  rows = connection.execute(
+    f'SELECT "type", "name", "sql" FROM "{source}".sqlite_master '
+    f'WHERE "tbl_name" IN ({names}) AND "type" IN (\'table\', \'index\') AND "sql" IS NOT NULL '
+    'ORDER BY "type" DESC'
+  ).fetchall()
+  existing = {name for name, in connection.execute('SELECT "name" FROM main.sqlite_master')}
+  for _, name, sql in rows:
+    if name not in existing:
+      connection.execute(sql)
+
+
+class _Handle:
+  pool: SQLitePool
+  in_use: bool
+  used_at: float
+
+  def __init__(self, pool: SQLitePool) -> None:
+    self.pool = pool
+    self.in_use = False
+    self.used_at = monotonic()
+
+
+class ShardPool(local):
+  """
+  ShardPool replaces the connection pool of `db`, routing each db_session to the shard of `current_shard`.
+
+  Sessions opened without a current shard use the global database. Like pony's own pools, each thread has its own
+  connections, which are opened lazily and kept in an LRU.
+  """
+  layout: ShardLayout
+  fallback: Any
+  handles: OrderedDict[str, _Handle]
+
+  def __init__(self, layout: ShardLayout, fallback: Any) -> None:
+    self.layout = layout
+    self.fallback = fallback
+    self.handles = OrderedDict()
+
+  def _find(self, con: sqlite3.Connection) -> tuple[str, _Handle] | None:
+    for path, handle in self.handles.items():
+      if handle.pool.con is con:
+        return path, handle
+    return None
+
+  def _open(self, path: str) -> _Handle:
+    makedirs(self.layout.directory, exist_ok=True)
+    migrate(path)
+    pool = SQLitePool(False, path, True)
+    pool._connect()
+    pool.con.execute('ATTACH DATABASE ? AS "global"', (db_path, ))
+    try:
+      create_shard_tables(pool.con)
+    finally:
+      pool.con.execute('DETACH DATABASE "global"')
+    create_fts(pool.con)
+    pool.con.commit()
+    metrics.inc('shard_connections_opened_total')
+    return _Handle(pool)
+
+  def _close(self, path: str) -> None:
+    handle = self.handles.pop(path)
+    handle.pool.con.close()
+    handle.pool.con = None
+    metrics.inc('shard_connections_closed_total')
+
+  def _evict(self) -> None:
+    idle = [path for path, handle in self.handles.items() if not handle.in_use]
+    for path in idle[:max(0, len(self.handles) - self.layout.max_open)]:
+      self._close(path)
+
+  def connect(self) -> tuple[sqlite3.Connection, bool]:
+    if (cid := current_shard.get()) is None:
+      return self.fallback.connect()
+
+    path = self.layout.path(cid)
+    is_new = path not in self.handles
+    if is_new:
+      self.handles[path] = self._open(path)
+    self.handles.move_to_end(path)
+
+    handle = self.handles[path]
+    handle.in_use = True
+    handle.used_at = monotonic()
+    self._evict()
+    return handle.pool.con, is_new
+
+  def release(self, con: sqlite3.Connection) -> None:
+    if (found := self._find(con)) is None:
+      return self.fallback.release(con)
+    path, handle = found
+    handle.in_use = False
+    try:
+      con.rollback()
+    except:
+      self._close(path)
+      raise
+
+  def drop(self, con: sqlite3.Connection) -> None:
+    if (found := self._find(con)) is None:
+      return self.fallback.drop(con)
+    self._close(found[0])
+
+  def disconnect(self) -> None:
+    for path in list(self.handles):
+      self._close(path)
+    self.fallback.disconnect()
+
+  def close_idle(self) -> int:
+    deadline = monotonic() - self.layout.idle_timeout
+    idle = [path for path, handle in self.handles.items() if not handle.in_use and handle.used_at < deadline]
+    for path in idle:
+      self._close(path)
+    return len(idle)
+
+
+def enable_sharding(layout: ShardLayout | None = None) -> ShardLayout:
+  """
+  Store conversations in shard files from now on. Conversations already in the global database must be moved with
+  `python -m openai_secretary.tools shard split` to stay visible.
+  """
+  layout = layout or ShardLayout()
+  pool = db.provider.pool
+  if isinstance(pool, ShardPool):
+    pool = pool.fallback
+  db.provider.pool = ShardPool(layout, pool)
+  return layout
+
+
+def close_idle() -> int:
+  """
+  Close shard connections of the calling thread which have been unused for `idle_timeout`.
+
+  Returns:
+    int: Number of closed connections.
+  """
+  pool = db.provider.pool
+  return pool.close_idle() if isinstance(pool, ShardPool) else 0
+
+
+def location() -> str:
+  """
+  Path of the database file db_sessions of the current context use.
+  """
+  pool = db.provider.pool
+  if isinstance(pool, ShardPool) and (cid := current_shard.get()) is not None:
+    return pool.layout.path(cid)
+  return db_path
+
+
+@contextmanager
+def shard(conversation_id: int | None) -> Iterator[None]:
+  """
+  Route db_sessions started within the context to the shard of a conversation. It has no effect unless sharding is
+  enabled, and a db_session which has already connected keeps its connection.
+  """
+  token = current_shard.set(conversation_id)
+  try:
+    yield
+  finally:
+    current_shard.reset(token)
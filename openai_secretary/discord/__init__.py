@@ -1,3 +1,4 @@
 from openai_secretary.discord.bot import OpenAIChatBot
+from openai_secretary.discord.workers import WorkerChatBot
 
-__all__ = ['OpenAIChatBot']
+__all__ = ['OpenAIChatBot', 'WorkerChatBot']
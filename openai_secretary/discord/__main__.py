@@ -1,9 +1,47 @@
+from argparse import ArgumentParser
 from os.path import dirname, join
-from openai_secretary.discord import OpenAIChatBot
+from openai_secretary.arguments import (
+  add_client_arguments, add_embedding_arguments, client_argv, client_config, embedding_argv, embedding_backend
+)
+from openai_secretary.database.sharding import ShardLayout
+from openai_secretary.discord import OpenAIChatBot, WorkerChatBot
+from openai_secretary.memory.arguments import add_memory_arguments, memory_argv, memory_config
+
+parser = ArgumentParser(prog='python -m openai_secretary.discord', description='run the Discord bot.')
+parser.add_argument('--workers', type=int, default=0, help='handle channels in this many worker processes.')
+parser.add_argument('--shards', default=None, help='directory of conversation databases.')
+parser.add_argument('--buckets', type=int, default=None, help='number of conversation database files.')
+add_memory_arguments(parser)
+add_client_arguments(parser)
+add_embedding_arguments(parser)
+args = parser.parse_args()
+if args.workers > 1 and args.shards is None:
+  # workers would otherwise write every conversation to the same database file.
+  parser.error('--workers needs --shards')
+if args.buckets is not None and args.shards is None:
+  parser.error('--buckets needs --shards')
 
 with open(join(dirname(__file__), '..', '..', '.discord.secret')) as f:
   key = f.read().strip()
 
-bot = OpenAIChatBot(key, response_ratio=0.9)
+if args.workers:
+  worker_args = ['--response-ratio', '0.9', '--metrics-port', '9465', '--stats-interval', str(15 * 60)]
+  if args.shards is not None:
+    worker_args += ['--shards', args.shards]
+  if args.buckets is not None:
+    worker_args += ['--buckets', str(args.buckets)]
+  worker_args += memory_argv(args) + client_argv(args) + embedding_argv(args)
+  bot = WorkerChatBot(key, workers=args.workers, worker_args=worker_args)
+else:
+  bot = OpenAIChatBot(
+    key,
+    response_ratio=0.9,
+    metrics_port=9464,
+    stats_interval=15 * 60,
+    http=client_config(args),
+    embedding=embedding_backend(args),
+    shards=ShardLayout(args.shards, args.buckets) if args.shards is not None else None,
+    memory=memory_config(args),
+  )
 
 bot.start()
@@ -1,22 +1,34 @@
 import asyncio
+from datetime import timedelta
 from json import dumps, loads
 from logging import getLogger
 from random import random
-from typing import Any, Required, TypedDict
+from time import monotonic
+from typing import Any, Callable, NotRequired, Required, TypedDict
 from discord.flags import Intents
 from discord.client import Client
 from discord.message import Message
+from discord.utils import setup_logging
 from openai_secretary import Agent, init_agent
+from openai_secretary.checkpoint import checkpointer
+from openai_secretary.client import ClientConfig, openai_client
+from openai_secretary.embedding import EmbeddingBackend
 from pony.orm import db_session
 from openai_secretary.database.models import Settings, Intimacy
+from openai_secretary.database.sharding import ShardLayout, close_idle, enable_sharding
+from openai_secretary.discord.outbox import Outbox
+from openai_secretary.memory import MemoryConfig, Pruner, RetentionPolicy
+from openai_secretary.metrics import metrics
 from openai_secretary.resource.emotion import EmotionDelta
 from openai_secretary.resource.resources import compute_intimacy_delta, intimacy_prompt
+from openai_secretary.scoring import emotion_batcher
 
 
 class SettingsDict(TypedDict):
   response_ratio: Required[float]
   cmd_prefix: Required[str]
   _debug: Required[bool]
+  retention: NotRequired[dict[str, Any] | None]
 
 
 def registerHandlers(impl: Any, client: Client) -> None:
@@ -36,10 +48,48 @@ class OpenAIChatBot:
   settings: dict[int, SettingsDict]
   agents: dict[int, Agent]
   latest_message_id: dict[int, int]
+  last_active: dict[int, float]
+  in_flight: dict[int, int]
+  agent_idle: float = 30 * 60.0
+  """Seconds without messages after which the agent of a channel is checkpointed and released."""
   emotion_delta: dict[int, dict[int, EmotionDelta]]
   task: asyncio.Task[None]
-
-  def __init__(self, secret: str, *, response_ratio=0.2) -> None:
+  memory_task: asyncio.Task[None]
+  checkpoint_task: asyncio.Task[None] | None = None
+  checkpoint_interval: float = 60.0
+  metrics_port: int | None
+  stats_interval: float | None
+  metrics_server: asyncio.Server | None = None
+  stats_task: asyncio.Task[None] | None = None
+  embedding: EmbeddingBackend | None
+  memory: MemoryConfig | None
+  api_key: str | None
+  outbox: Outbox
+  shards: ShardLayout | None
+  shard_task: asyncio.Task[None] | None = None
+  pruner: Pruner
+  owns: Callable[[int], bool] | None
+  """Whether a channel is handled by this bot, when it shares its databases with other workers."""
+  retention_task: asyncio.Task[None] | None = None
+  retention_interval: float = 300.0
+
+  def __init__(
+    self,
+    secret: str,
+    *,
+    response_ratio=0.2,
+    metrics_port: int | None = None,
+    stats_interval: float | None = None,
+    http: ClientConfig | None = None,
+    embedding: EmbeddingBackend | None = None,
+    shards: ShardLayout | None = None,
+    emotion_window: float | None = None,
+    api_key: str | None = None,
+    outbox: Outbox | None = None,
+    retention: RetentionPolicy | None = None,
+    memory: MemoryConfig | None = None,
+    owns: Callable[[int], bool] | None = None,
+  ) -> None:
     intents = Intents.default()
     intents.message_content = True
 
@@ -49,7 +99,24 @@ class OpenAIChatBot:
     self.agents = {}
     self.settings = {}
     self.latest_message_id = {}
+    self.last_active = {}
+    self.in_flight = {}
     self.emotion_delta = {}
+    self.metrics_port = metrics_port
+    self.stats_interval = stats_interval
+    self.embedding = embedding
+    self.memory = memory
+    self.api_key = api_key
+    self.outbox = outbox or Outbox()
+    self.pruner = Pruner(retention)
+    self.owns = owns
+    self.shards = shards
+    if shards is not None:
+      enable_sharding(shards)
+    if http is not None:
+      openai_client.configure(http)
+    if emotion_window is not None:
+      emotion_batcher.configure(window=emotion_window)
     registerHandlers(self, self.client)
 
   def prefix(self, channel_id: int) -> str:
@@ -63,6 +130,8 @@ class OpenAIChatBot:
       settings = Settings.get(id=channel_id)
       if settings:
         self.settings[channel_id] = loads(settings.settings)
+        if 'retention' in self.settings[channel_id]:
+          self.set_retention(channel_id, self.settings[channel_id]['retention'])
       else:
         self.settings[channel_id] = {
           'cmd_prefix': self.default_cmd_prefix,
@@ -76,11 +145,47 @@ class OpenAIChatBot:
       settings = Settings.get(id=channel_id)
       settings.settings = dumps(self.settings[channel_id])
 
+  def set_retention(self, channel_id: int, policy: dict[str, Any] | None) -> None:
+    self.pruner.policies[channel_id] = RetentionPolicy.from_dict(policy) if policy is not None else None
+
+  async def run(self) -> None:
+    try:
+      async with self.client:
+        await self.client.start(self.__secret)
+    finally:
+      await self.outbox.close()
+      await openai_client.close()
+
   def start(self) -> None:
-    self.client.run(self.__secret, root_logger=True)
+    setup_logging(root=True)
+    try:
+      asyncio.run(self.run())
+    except KeyboardInterrupt:
+      pass
+    finally:
+      self.flush_intimacy()
+      checkpointer.flush()
 
   async def on_ready(self) -> None:
+    if self.metrics_port is not None and self.metrics_server is None:
+      self.metrics_server = await metrics.serve(self.metrics_port)
+    if self.stats_interval is not None and self.stats_task is None:
+      self.stats_task = asyncio.get_event_loop().create_task(metrics.log_periodically(self.stats_interval))
+
+    if self.checkpoint_task is None:
+      self.checkpoint_task = asyncio.get_event_loop().create_task(checkpointer.run(self.checkpoint_interval))
+
+    if self.shards is not None and self.shard_task is None:
+      self.shard_task = asyncio.get_event_loop().create_task(self.close_idle_shards())
+
+    if self.retention_task is None:
+      # conversations idle since before a restart are pruned too.
+      seeded = self.pruner.seed(self.shards, self.owns)
+      logger.info(f'{seeded} stored conversations are tracked for retention.')
+      self.retention_task = asyncio.get_event_loop().create_task(self.pruner.run(self.retention_interval))
+
     self.task = asyncio.get_event_loop().create_task(self.update_intimacy())
+    self.memory_task = asyncio.get_event_loop().create_task(self.compact_memories())
     logger.info(f'Logged in as {self.client.user}')
     await self.task
 
@@ -90,48 +195,141 @@ class OpenAIChatBot:
       # update intimacy every 15 minutes
       await asyncio.sleep(15*60)
       logger.info('updating intimacy...')
-      for cid, deltas in self.emotion_delta.items():
-        for uid, delta in deltas.items():
-          value = compute_intimacy_delta(delta)
-          Intimacy.add_value(channel_id=cid, user_id=uid, value=value)
-          logger.info(f'intimacy for user {uid} in channel {cid} is updated by {value}.')
-        deltas.clear()
+      self.flush_intimacy()
+
+  def flush_intimacy(self) -> None:
+    """
+    Add the emotion changes accumulated since the last update to the intimacy of their users.
+    """
+    for cid, deltas in self.emotion_delta.items():
+      for uid, delta in deltas.items():
+        value = compute_intimacy_delta(delta)
+        Intimacy.add_value(channel_id=cid, user_id=uid, value=value)
+        logger.info(f'intimacy for user {uid} in channel {cid} is updated by {value}.')
+      deltas.clear()
+
+  async def close_idle_shards(self) -> None:
+    assert self.shards is not None
+    while True:
+      await asyncio.sleep(self.shards.idle_timeout / 2)
+      if closed := close_idle():
+        logger.debug(f'{closed} idle shard connections are closed.')
+
+  async def compact_memories(self) -> None:
+    logger.info('memory compactor has been started.')
+    while True:
+      # summarize old conversation spans every 10 minutes
+      await asyncio.sleep(10*60)
+      for cid, agent in list(self.agents.items()):
+        try:
+          created = await agent.compact_memory()
+        except Exception as e:
+          logger.error(f'failed to compact memory of channel {cid}: {type(e)}: {e}')
+          continue
+        if created:
+          logger.info(f'{created} summaries are created for channel {cid}.')
+      if evicted := self.evict_idle_agents():
+        logger.info(f'{evicted} idle agents are released.')
+
+  def evict_idle_agents(self) -> int:
+    """
+    Checkpoint and release agents of channels which have been idle for `agent_idle` seconds and handle no message.
+    They are created again from the database by the next message.
+
+    Returns:
+      int: Number of released agents.
+    """
+    now = monotonic()
+    idle = [
+      cid for cid in self.agents
+      if cid not in self.in_flight and now - self.last_active.get(cid, 0.0) >= self.agent_idle
+    ]
+    for cid in idle:
+      self.agents.pop(cid).close()
+    return len(idle)
 
   async def cmd_response_ratio(self, message: Message, args: str) -> None:
     cid = message.channel.id
     if not args:
-      await message.channel.send(f'`[SYSTEM]` 現在の返答率は{self.response_ratio(cid)}です。')
+      self.outbox.system(message.channel, f'`[SYSTEM]` 現在の返答率は{self.response_ratio(cid)}です。')
       return
 
     self.settings[cid]['response_ratio'] = float(args)
     self.update_settings(cid)
-    await message.channel.send(f'`[SYSTEM]` 返答率を{self.response_ratio(cid)}に更新しました。')
+    self.outbox.system(message.channel, f'`[SYSTEM]` 返答率を{self.response_ratio(cid)}に更新しました。')
 
   async def cmd_initial_prompt(self, message: Message, args: str) -> None:
     if not args:
-      await message.channel.send(
+      self.outbox.system(
+        message.channel,
         f'`[SYSTEM]` 現在の初期プロンプトは「{self.agents[message.channel.id].initial_message}」です。',
       )
       return
 
     self.agents[message.channel.id].initial_message = args
-    await message.channel.send(f'`[SYSTEM]` 初期プロンプトを「{self.agents[message.channel.id].initial_message}」に更新しました。')
+    self.outbox.system(message.channel, f'`[SYSTEM]` 初期プロンプトを「{self.agents[message.channel.id].initial_message}」に更新しました。')
 
   async def cmd_prefix(self, message: Message, args: str) -> None:
     cid = message.channel.id
 
     if not args:
-      await message.channel.send(f'`[SYSTEM]` 現在のコマンドプレフィックスは `{self.prefix(cid)}` です。')
+      self.outbox.system(message.channel, f'`[SYSTEM]` 現在のコマンドプレフィックスは `{self.prefix(cid)}` です。')
       return
 
     self.settings[cid]['cmd_prefix'] = args.strip()
     self.update_settings(cid)
-    await message.channel.send(f'`[SYSTEM]` コマンドプレフィックスを `{self.prefix(cid)}` に更新しました。')
+    self.outbox.system(message.channel, f'`[SYSTEM]` コマンドプレフィックスを `{self.prefix(cid)}` に更新しました。')
+
+  async def cmd_retention(self, message: Message, args: str) -> None:
+    cid = message.channel.id
+    match args.split():
+      case []:
+        policy = self.pruner.policy(cid)
+        current = f'`{policy.describe()}`' if policy is not None else '無効'
+        self.outbox.system(message.channel, f'`[SYSTEM]` 現在のメッセージの保存期間は{current}です。')
+        return
+      case ['off']:
+        self.settings[cid]['retention'] = None
+      case ['default']:
+        self.settings[cid].pop('retention', None)
+        self.pruner.policies.pop(cid, None)
+      case terms:
+        kwargs: dict[str, Any] = {}
+        try:
+          for term in terms:
+            key, value = term.split('=', 1)
+            match key:
+              case 'max_age':
+                kwargs['max_age'] = timedelta(days=float(value.removesuffix('d')))
+              case 'max_rows':
+                kwargs['max_rows'] = int(value)
+              case 'summarized':
+                kwargs['summarized'] = value == 'on'
+              case _:
+                raise ValueError(key)
+        except ValueError:
+          self.outbox.system(
+            message.channel,
+            f"[SYSTEM] `{self.prefix(cid)}retention` 使用法:\n"
+            f"・`{self.prefix(cid)}retention [max_age=<日数>] [max_rows=<件数>] [summarized=(on | off)]` - "
+            "保存期間を設定します。\n"
+            f"・`{self.prefix(cid)}retention (off | default)` - 削除を無効にするか、既定の設定に戻します。\n",
+          )
+          return
+        self.settings[cid]['retention'] = RetentionPolicy(**kwargs).to_dict()
+
+    if 'retention' in self.settings[cid]:
+      self.set_retention(cid, self.settings[cid]['retention'])
+    self.update_settings(cid)
+    policy = self.pruner.policy(cid)
+    current = f'`{policy.describe()}`' if policy is not None else '無効'
+    self.outbox.system(message.channel, f'`[SYSTEM]` メッセージの保存期間を{current}に更新しました。')
 
   async def cmd_debug(self, message: Message, args: str) -> None:
     cid = message.channel.id
     if not args:
-      await message.channel.send(
+      self.outbox.system(
+        message.channel,
         f"[SYSTEM] `{self.prefix(cid)}debug` 使用法:\n"
         f"・`{self.prefix(cid)}debug console (on | off)` - コンソールデバッグを有効または無効にします。\n"
         f"・`{self.prefix(cid)}debug emotion` - 現在の感情値を表示します。\n"
@@ -143,41 +341,43 @@ class OpenAIChatBot:
       case ['console', 'on']:
         self.settings[cid]['_debug'] = self.agents[cid]._debug = True
         self.update_settings(cid)
-        await message.channel.send(f'`[SYSTEM]` コンソールデバッグを有効に切り替えました。')
+        self.outbox.system(message.channel, f'`[SYSTEM]` コンソールデバッグを有効に切り替えました。')
       case ['console', 'off']:
         self.settings[cid]['_debug'] = self.agents[cid]._debug = False
         self.update_settings(cid)
-        await message.channel.send(f'`[SYSTEM]` コンソールデバッグを無効に切り替えました。')
+        self.outbox.system(message.channel, f'`[SYSTEM]` コンソールデバッグを無効に切り替えました。')
       case ['console']:
-        await message.channel.send(
+        self.outbox.system(
+          message.channel,
           f'`[SYSTEM]` 現在のデバッグモードは{"有効" if self.agents[cid]._debug else "無効"}です。',
         )
       case ['emotion']:
-        await message.channel.send(f'`[SYSTEM]` 現在の感情は{repr(self.agents[cid].emotion)}です。')
+        self.outbox.system(message.channel, f'`[SYSTEM]` 現在の感情は{repr(self.agents[cid].emotion)}です。')
       case ['intimacy']:
         value = Intimacy.get_value(channel_id=cid, user_id=message.author.id)
         prompt = intimacy_prompt(value, message.author.display_name, descriptive=True)
-        await message.channel.send(f'`[SYSTEM]` 現在のあなたに対する親密度は{value}です。({prompt})')
+        self.outbox.system(message.channel, f'`[SYSTEM]` 現在のあなたに対する親密度は{value}です。({prompt})')
       case ['intimacy', 'set', value, *_]:
         value = float(value)
         if not message.mentions:
           Intimacy.set_value(channel_id=cid, user_id=message.author.id, value=value)
           prompt = intimacy_prompt(value, message.author.display_name, descriptive=True)
-          await message.channel.send(f'`[SYSTEM]` あなたに対する親密度を{value}({prompt})に更新しました。')
+          self.outbox.system(message.channel, f'`[SYSTEM]` あなたに対する親密度を{value}({prompt})に更新しました。')
         else:
           for mention in message.mentions:
             Intimacy.set_value(channel_id=cid, user_id=mention.id, value=value)
             prompt = intimacy_prompt(value, mention.display_name, descriptive=True)
-            await message.channel.send(f'`[SYSTEM]` <@!{mention.id}> に対する親密度を{value}({prompt})に更新しました。')
+            self.outbox.system(message.channel, f'`[SYSTEM]` <@!{mention.id}> に対する親密度を{value}({prompt})に更新しました。')
       case ['intimacy', _]:
         if not message.mentions:
-          await message.channel.send(f'`[SYSTEM]` ユーザーを指定してください。')
+          self.outbox.system(message.channel, f'`[SYSTEM]` ユーザーを指定してください。')
         mention = message.mentions[0]
         value = Intimacy.get_value(channel_id=cid, user_id=mention.id)
         prompt = intimacy_prompt(value, mention.display_name, descriptive=True)
-        await message.channel.send(f'`[SYSTEM]` 現在の <@!{mention.id}> に対する親密度は{value}です。({prompt})')
+        self.outbox.system(message.channel, f'`[SYSTEM]` 現在の <@!{mention.id}> に対する親密度は{value}です。({prompt})')
       case _:
-        await message.channel.send(
+        self.outbox.system(
+          message.channel,
           f"[SYSTEM] `{self.prefix(cid)}debug` 使用法:\n"
           f"・`{self.prefix(cid)}debug console (on | off)` - コンソールデバッグを有効または無効にします。\n"
           f"・`{self.prefix(cid)}debug emotion` - 現在の感情値を表示します。\n"
@@ -190,7 +390,7 @@ class OpenAIChatBot:
     if hasattr(self, name):
       await getattr(self, name)(message, (args or [''])[0])
     else:
-      await message.channel.send(f'`[SYSTEM]` コマンド「{cmd}」は存在しません。')
+      self.outbox.system(message.channel, f'`[SYSTEM]` コマンド「{cmd}」は存在しません。')
     return
   
   def is_mentioned(self, message: Message) -> bool:
@@ -199,15 +399,31 @@ class OpenAIChatBot:
     )
 
   async def on_message(self, message: Message) -> None:
+    cid = message.channel.id
+    self.in_flight[cid] = self.in_flight.get(cid, 0) + 1
+    try:
+      with metrics.span('on_message'):
+        await self.handle_message(message)
+    finally:
+      self.last_active[cid] = monotonic()
+      if (count := self.in_flight.pop(cid) - 1) > 0:
+        self.in_flight[cid] = count
+
+  async def handle_message(self, message: Message) -> None:
     cid = message.channel.id
     self.latest_message_id[cid] = message.id
+    self.pruner.touch(cid)
 
     if cid not in self.agents:
       self.init_settings(cid)
-      self.emotion_delta[cid] = {}
+      # deltas of a released agent wait for the next intimacy update.
+      self.emotion_delta.setdefault(cid, {})
       self.agents[message.channel.id] = init_agent(
         debug=self.settings[cid]['_debug'],
         conversation_id=cid,
+        embedding=self.embedding,
+        memory=self.memory,
+        api_key=self.api_key,
       )
 
     # 自分のメッセージは無視
@@ -230,7 +446,7 @@ class OpenAIChatBot:
     prev = self.agents[cid].emotion.frozen
 
     if random() < self.response_ratio(cid) or mentioned:
-      async with message.channel.typing():
+      async with self.outbox.typing(message.channel):
         text = await self.agents[cid].talk(
           f"{message.author.display_name}:{message.clean_content}",
           injected_system_message=intimacy_prompt(
@@ -241,9 +457,10 @@ class OpenAIChatBot:
         )
 
       if mentioned or message.reference:
-        await message.reply(text)
-      elif self.latest_message_id[cid] == message.id:
-        await message.channel.send(text)
+        self.outbox.reply(message, text)
+      else:
+        # a reply sent to the channel only makes sense until someone else speaks.
+        self.outbox.send(message.channel, text, wanted=lambda: self.latest_message_id[cid] == message.id)
     else:
       await self.agents[cid].talk(
         f"{message.author.display_name}「{message.clean_content}」",
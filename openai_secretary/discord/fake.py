@@ -0,0 +1,74 @@
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Protocol
+
+from discord.client import Client
+
+
+class Sink(Protocol):
+  """
+  Sink receives what the bot does to fake channels.
+  """
+
+  async def typing(self, channel: 'FakeChannel', active: bool) -> None:
+    ...
+
+  async def send(self, channel: 'FakeChannel', reply_to: 'FakeMessage | None', content: str) -> None:
+    ...
+
+
+@dataclass(frozen=True)
+class FakeUser:
+  id: int
+  display_name: str
+
+
+def impersonate(client: Client, user: FakeUser) -> None:
+  """
+  Make `client.user` return `user` without logging in, so that a bot can tell its own messages and mentions apart.
+  """
+  client._connection.user = user  # type: ignore
+
+
+class FakeChannel:
+  """
+  FakeChannel stands in for a Discord text channel, forwarding what the bot does to a sink.
+  """
+  id: int
+  sink: Sink
+
+  def __init__(self, id: int, sink: Sink) -> None:
+    self.id = id
+    self.sink = sink
+
+  @asynccontextmanager
+  async def typing(self) -> AsyncIterator[None]:
+    await self.sink.typing(self, True)
+    try:
+      yield
+    finally:
+      await self.sink.typing(self, False)
+
+  async def send(self, content: str) -> None:
+    await self.sink.send(self, None, content)
+
+
+@dataclass
+class FakeMessage:
+  """
+  FakeMessage stands in for a Discord message, with the attributes `OpenAIChatBot` uses.
+  """
+  id: int
+  channel: FakeChannel
+  author: FakeUser
+  content: str
+  mentions: list[FakeUser] = field(default_factory=list)
+  reference: object | None = None
+  clean_content: str = ''
+  role_mentions: list = field(default_factory=list)
+
+  def __post_init__(self) -> None:
+    self.clean_content = self.clean_content or self.content
+
+  async def reply(self, content: str) -> None:
+    await self.channel.sink.send(self.channel, self, content)
@@ -0,0 +1,186 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from logging import getLogger
+from time import monotonic
+from typing import Any, AsyncIterator, Callable
+
+from openai_secretary.metrics import metrics
+
+logger = getLogger('oai_chatbot.outbox')
+
+message_limit = 2000
+"""
+Maximum number of characters of a Discord message.
+"""
+
+
+@dataclass
+class Outgoing:
+  content: str
+  system: bool = False
+  reply_to: Any | None = None
+  """Message to reply to, or None to send to the channel."""
+  wanted: Callable[[], bool] | None = None
+  """Checked right before sending. The message is dropped if it returns False."""
+  queued_at: float = field(default_factory=monotonic)
+
+
+@dataclass
+class _Channel:
+  channel: Any
+  queue: deque[Outgoing] = field(default_factory=deque)
+  sent: deque[float] = field(default_factory=deque)
+  """Times of the sends within the last window."""
+  sender: asyncio.Task[None] | None = None
+  typists: int = 0
+  typer: asyncio.Task[None] | None = None
+
+
+class Outbox:
+  """
+  Outbox sends messages of the bot through a queue per channel, paced below Discord's per-channel rate limit.
+
+  Handlers only enqueue messages and return, so that neither rate limits nor slow requests stall them. Right before
+  sending, consecutive system messages are merged into one message, and replies which are no longer wanted or have
+  waited longer than `max_age` are dropped.
+  """
+  burst: int
+  """Number of messages a channel can send within `window`."""
+  window: float
+  """Seconds of the sliding window the rate limit applies to."""
+  max_age: float
+  """Seconds after which a queued reply is dropped. System messages are never dropped."""
+  typing_interval: float
+  """Seconds between typing indicators, which Discord shows for 10 seconds or until a message is sent."""
+  channels: dict[int, _Channel]
+
+  def __init__(
+    self,
+    *,
+    burst: int = 5,
+    window: float = 5.0,
+    max_age: float = 60.0,
+    typing_interval: float = 8.0,
+  ) -> None:
+    self.burst = burst
+    self.window = window
+    self.max_age = max_age
+    self.typing_interval = typing_interval
+    self.channels = {}
+
+  def _channel(self, channel: Any) -> _Channel:
+    if (state := self.channels.get(channel.id)) is None:
+      state = self.channels[channel.id] = _Channel(channel)
+    return state
+
+  def _release(self, state: _Channel) -> None:
+    if not state.queue and state.sender is None and not state.typists:
+      self.channels.pop(state.channel.id, None)
+
+  def post(self, channel: Any, item: Outgoing) -> None:
+    state = self._channel(channel)
+    state.queue.append(item)
+    metrics.inc('outbox_queued_total', system=item.system)
+    if state.sender is None:
+      state.sender = asyncio.get_running_loop().create_task(self._send_all(state))
+
+  def system(self, channel: Any, content: str) -> None:
+    self.post(channel, Outgoing(content, system=True))
+
+  def reply(self, message: Any, content: str) -> None:
+    self.post(message.channel, Outgoing(content, reply_to=message))
+
+  def send(self, channel: Any, content: str, wanted: Callable[[], bool] | None = None) -> None:
+    self.post(channel, Outgoing(content, wanted=wanted))
+
+  async def _wait(self, state: _Channel) -> None:
+    """
+    Wait until fewer than `burst` messages have been sent within the last `window` seconds.
+    """
+    while True:
+      now = monotonic()
+      while state.sent and state.sent[0] <= now - self.window:
+        state.sent.popleft()
+      if len(state.sent) < self.burst:
+        return
+      metrics.inc('outbox_throttled_total')
+      await asyncio.sleep(state.sent[0] + self.window - now)
+
+  def _next(self, state: _Channel) -> Outgoing | None:
+    """
+    Take the next message to send, merging consecutive system messages and dropping unwanted replies.
+    """
+    while state.queue:
+      item = state.queue.popleft()
+      if item.system:
+        while (
+          state.queue and state.queue[0].system
+          and len(item.content) + 1 + len(state.queue[0].content) <= message_limit
+        ):
+          item.content += '\n' + state.queue.popleft().content
+          metrics.inc('outbox_merged_total')
+        return item
+      if monotonic() - item.queued_at > self.max_age or (item.wanted is not None and not item.wanted()):
+        metrics.inc('replies_dropped_total', channel=state.channel.id)
+        continue
+      return item
+    return None
+
+  async def _send_all(self, state: _Channel) -> None:
+    try:
+      while state.queue:
+        await self._wait(state)
+        if (item := self._next(state)) is None:
+          break
+        # the send counts from when it starts, since Discord may receive it at any moment after that.
+        state.sent.append(monotonic())
+        try:
+          with metrics.span('discord_send'):
+            if item.reply_to is not None:
+              await item.reply_to.reply(item.content)
+            else:
+              await state.channel.send(item.content)
+        except Exception as e:
+          metrics.inc('outbox_errors_total')
+          logger.error(f'failed to send a message to channel {state.channel.id}: {type(e)}: {e}')
+    finally:
+      state.sender = None
+      self._release(state)
+
+  async def _keep_typing(self, channel: Any) -> None:
+    while True:
+      try:
+        # entering triggers the indicator once; the rest of the context would refresh it every 5 seconds.
+        async with channel.typing():
+          pass
+      except Exception as e:
+        logger.debug(f'failed to trigger typing in channel {channel.id}: {type(e)}: {e}')
+      await asyncio.sleep(self.typing_interval)
+
+  @asynccontextmanager
+  async def typing(self, channel: Any) -> AsyncIterator[None]:
+    """
+    Show the typing indicator while any handler of the channel is within the context, without waiting for Discord.
+    """
+    state = self._channel(channel)
+    state.typists += 1
+    if state.typer is None:
+      state.typer = asyncio.get_running_loop().create_task(self._keep_typing(channel))
+    try:
+      yield
+    finally:
+      state.typists -= 1
+      if not state.typists and state.typer is not None:
+        state.typer.cancel()
+        state.typer = None
+        self._release(state)
+
+  async def close(self, timeout: float = 10.0) -> None:
+    """
+    Wait for queued messages to be sent.
+    """
+    senders = [state.sender for state in self.channels.values() if state.sender is not None]
+    if senders:
+      await asyncio.wait(senders, timeout=timeout)
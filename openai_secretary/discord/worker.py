@@ -0,0 +1,164 @@
+"""
+Worker process of `WorkerChatBot`.
+
+A worker runs `OpenAIChatBot` for the channels its front process assigns to it. It reads events as JSON lines from
+stdin and writes what the bot does to the channels as JSON lines to stdout:
+
+- `{"type": "message", "id", "channel", "author": {"id", "name"}, "content", "clean_content", "mentions", "reference"}`
+  is handled as a Discord message, and is answered by `{"type": "done", "id"}` when it has been handled.
+- `{"type": "stop"}`, or the end of stdin, makes the worker finish the messages in progress, update intimacy,
+  checkpoint emotions and exit.
+
+The worker writes `{"type": "ready"}` once it accepts messages, `{"type": "send", "channel", "reply_to", "content"}`
+for every message the bot sends, and `{"type": "typing", "channel", "active"}` around generating replies.
+"""
+from argparse import ArgumentParser
+import asyncio
+import json
+from logging import getLogger
+import os
+import signal
+import sys
+from typing import Any, BinaryIO
+
+from discord.utils import setup_logging
+import openai as oai
+
+from openai_secretary.arguments import add_client_arguments, add_embedding_arguments, client_config, embedding_backend
+from openai_secretary.checkpoint import checkpointer
+from openai_secretary.client import openai_client
+from openai_secretary.database.sharding import ShardLayout
+from openai_secretary.discord.bot import OpenAIChatBot
+from openai_secretary.discord.fake import FakeChannel, FakeMessage, FakeUser, impersonate
+from openai_secretary.discord.workers import HashRing
+from openai_secretary.memory.arguments import add_memory_arguments, memory_config
+
+logger = getLogger('oai_chatbot.worker')
+
+
+class Worker:
+  """
+  Worker handles messages of a front process with an `OpenAIChatBot` whose channels are fakes reporting back to the
+  front.
+  """
+  bot: OpenAIChatBot
+  out: BinaryIO
+  channels: dict[int, FakeChannel]
+  tasks: set[asyncio.Task[None]]
+
+  def __init__(self, bot: OpenAIChatBot, out: BinaryIO) -> None:
+    self.bot = bot
+    self.out = out
+    self.channels = {}
+    self.tasks = set()
+
+  def write(self, event: dict[str, Any]) -> None:
+    self.out.write(json.dumps(event, ensure_ascii=False).encode() + b'\n')
+    self.out.flush()
+
+  async def typing(self, channel: FakeChannel, active: bool) -> None:
+    self.write({'type': 'typing', 'channel': channel.id, 'active': active})
+
+  async def send(self, channel: FakeChannel, reply_to: FakeMessage | None, content: str) -> None:
+    self.write({
+      'type': 'send',
+      'channel': channel.id,
+      'reply_to': reply_to.id if reply_to is not None else None,
+      'content': content,
+    })
+
+  async def handle(self, event: dict[str, Any]) -> None:
+    cid = event['channel']
+    channel = self.channels.get(cid) or self.channels.setdefault(cid, FakeChannel(cid, self))
+    message = FakeMessage(
+      event['id'],
+      channel,
+      FakeUser(event['author']['id'], event['author']['name']),
+      event['content'],
+      mentions=[FakeUser(m['id'], m['name']) for m in event['mentions']],
+      reference=True if event['reference'] else None,
+      clean_content=event['clean_content'],
+    )
+    try:
+      await self.bot.on_message(message)
+    except Exception as e:
+      logger.error(f'failed to handle message {message.id} of channel {cid}: {type(e)}: {e}')
+    finally:
+      self.write({'type': 'done', 'id': message.id})
+
+  async def run(self) -> None:
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=2**20)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    background = loop.create_task(self.bot.on_ready())
+    self.write({'type': 'ready'})
+
+    while line := await reader.readline():
+      event = json.loads(line)
+      if event['type'] == 'stop':
+        break
+      if event['type'] == 'message':
+        task = loop.create_task(self.handle(event))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    if self.tasks:
+      await asyncio.wait(self.tasks)
+    await self.bot.outbox.close()
+    background.cancel()
+    self.bot.flush_intimacy()
+    checkpointer.flush()
+    await openai_client.close()
+
+
+def main(argv: list[str]) -> None:
+  parser = ArgumentParser(prog='python -m openai_secretary.discord.worker', description='run a worker process.')
+  parser.add_argument('--index', type=int, default=0, help='index of the worker in its pool.')
+  parser.add_argument('--workers', type=int, default=1, help='number of workers in the pool.')
+  parser.add_argument('--bot-id', type=int, required=True, help='user id of the bot.')
+  parser.add_argument('--bot-name', default='secretary', help='display name of the bot.')
+  parser.add_argument('--response-ratio', type=float, default=0.2, help='default response ratio of channels.')
+  parser.add_argument('--api-key', default=None, help='OpenAI API key. read from .secret by default.')
+  parser.add_argument('--api-base', default=None, help='OpenAI API base URL.')
+  parser.add_argument('--shards', default=None, help='directory of conversation databases.')
+  parser.add_argument('--buckets', type=int, default=None, help='number of conversation database files.')
+  parser.add_argument('--metrics-port', type=int, default=None, help='metrics port of the first worker.')
+  parser.add_argument('--stats-interval', type=float, default=None, help='seconds between stats logs.')
+  add_memory_arguments(parser)
+  add_client_arguments(parser)
+  add_embedding_arguments(parser)
+  args = parser.parse_args(argv)
+
+  # Ctrl-C reaches the whole process group, but workers are stopped by their front to finish messages in progress.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  # stdout carries the protocol, so that anything else printed goes to stderr.
+  out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+  os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+  setup_logging(root=True)
+  if args.api_base is not None:
+    oai.api_base = args.api_base
+
+  ring = HashRing(args.workers)
+  bot = OpenAIChatBot(
+    '',
+    response_ratio=args.response_ratio,
+    metrics_port=args.metrics_port + args.index if args.metrics_port is not None else None,
+    stats_interval=args.stats_interval,
+    http=client_config(args),
+    embedding=embedding_backend(args),
+    shards=ShardLayout(args.shards, args.buckets) if args.shards is not None else None,
+    api_key=args.api_key,
+    memory=memory_config(args),
+    owns=lambda cid: ring.owner(cid) == args.index,
+  )
+  impersonate(bot.client, FakeUser(args.bot_id, args.bot_name))
+
+  try:
+    asyncio.run(Worker(bot, out).run())
+  finally:
+    checkpointer.flush()
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
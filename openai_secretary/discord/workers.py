@@ -0,0 +1,356 @@
+import asyncio
+from bisect import bisect
+from collections import OrderedDict
+from hashlib import blake2b
+import json
+from logging import getLogger
+import signal
+import sys
+from time import monotonic
+from typing import IO, Any, Callable
+
+from discord.client import Client
+from discord.flags import Intents
+from discord.message import Message
+from discord.utils import setup_logging
+
+from openai_secretary.discord.bot import registerHandlers
+from openai_secretary.metrics import metrics
+
+logger = getLogger('oai_chatbot.workers')
+
+EventHandler = Callable[['WorkerProcess', dict[str, Any]], None]
+
+
+def _hash(key: str) -> int:
+  return int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+  """
+  HashRing assigns channels to workers by consistent hashing.
+
+  Each worker owns `replicas` points of the ring, and a channel belongs to the worker of the first point after the
+  channel's hash. Changing the number of workers moves only the channels of the points which appear or disappear.
+  """
+  points: list[int]
+  owners: list[int]
+
+  def __init__(self, workers: int, replicas: int = 64) -> None:
+    ring = sorted((_hash(f'worker-{w}-{r}'), w) for w in range(workers) for r in range(replicas))
+    self.points = [p for p, _ in ring]
+    self.owners = [w for _, w in ring]
+
+  def owner(self, channel_id: int) -> int:
+    return self.owners[bisect(self.points, _hash(str(channel_id))) % len(self.points)]
+
+
+class WorkerProcess:
+  """
+  WorkerProcess supervises one worker process and the messages assigned to it.
+
+  Messages are kept until the worker reports them done, so that messages sent to a worker which crashed are sent again
+  to its replacement, and messages arriving while a worker restarts wait for it. A conversation's state lives in the
+  database and emotion checkpoints, so a restarted worker resumes where the previous one stopped; emotions changed
+  after the last checkpoint of a crashed worker are lost.
+  """
+  index: int
+  argv: list[str]
+  env: dict[str, str] | None
+  stderr: IO | int | None
+  on_event: EventHandler
+  process: asyncio.subprocess.Process | None = None
+  pending: dict[int, dict[str, Any]]
+  ready: asyncio.Event
+  closing: bool = False
+  restarting: bool = False
+  task: asyncio.Task[None] | None = None
+
+  def __init__(
+    self,
+    index: int,
+    argv: list[str],
+    on_event: EventHandler,
+    *,
+    env: dict[str, str] | None = None,
+    stderr: IO | int | None = None,
+  ) -> None:
+    self.index = index
+    self.argv = argv
+    self.on_event = on_event
+    self.env = env
+    self.stderr = stderr
+    self.pending = {}
+    self.ready = asyncio.Event()
+
+  def _write(self, event: dict[str, Any]) -> None:
+    assert self.process is not None and self.process.stdin is not None
+    self.process.stdin.write(json.dumps(event, ensure_ascii=False).encode() + b'\n')
+
+  def submit(self, event: dict[str, Any]) -> None:
+    self.pending[event['id']] = event
+    if self.ready.is_set():
+      self._write(event)
+
+  async def _read(self) -> None:
+    assert self.process is not None and self.process.stdout is not None
+    while line := await self.process.stdout.readline():
+      try:
+        event = json.loads(line)
+      except ValueError:
+        logger.warning(f'worker {self.index} wrote a malformed event: {line!r}')
+        continue
+      if event['type'] == 'ready':
+        for pending in self.pending.values():
+          self._write(pending)
+        self.ready.set()
+      elif event['type'] == 'done':
+        self.pending.pop(event['id'], None)
+        self.on_event(self, event)
+      else:
+        self.on_event(self, event)
+
+  async def _supervise(self) -> None:
+    delay = 1.0
+    while not self.closing:
+      started = monotonic()
+      self.process = await asyncio.create_subprocess_exec(
+        sys.executable,
+        '-m',
+        'openai_secretary.discord.worker',
+        '--index',
+        str(self.index),
+        *self.argv,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=self.stderr,
+        env=self.env,
+        limit=2**20,
+      )
+      metrics.inc('worker_starts_total', worker=self.index)
+      try:
+        await self._read()
+      except Exception as e:
+        # the worker cannot be followed any more, so that it is replaced like a crashed one.
+        logger.error(f'failed to read events of worker {self.index}: {type(e)}: {e}')
+        if self.process.returncode is None:
+          self.process.kill()
+        self.restarting = False
+      code = await self.process.wait()
+      self.ready.clear()
+
+      if self.closing:
+        break
+      if self.restarting:
+        self.restarting = False
+        logger.info(f'worker {self.index} has been restarted.')
+        continue
+
+      if monotonic() - started > 60.0:
+        delay = 1.0
+      logger.warning(f'worker {self.index} exited with {code}, restarting in {delay} seconds.')
+      metrics.inc('worker_crashes_total', worker=self.index)
+      await asyncio.sleep(delay)
+      delay = min(delay * 2, 30.0)
+
+  async def start(self) -> None:
+    self.task = asyncio.get_running_loop().create_task(self._supervise())
+    await self.ready.wait()
+
+  async def _stop(self) -> None:
+    # the worker finishes the messages in progress, so that only messages which arrive meanwhile wait in `pending`.
+    self.ready.clear()
+    if self.process is not None and self.process.returncode is None:
+      self._write({'type': 'stop'})
+
+  async def restart(self) -> None:
+    """
+    Replace the worker with a new process after it has finished the messages in progress.
+    """
+    self.restarting = True
+    await self._stop()
+    await self.ready.wait()
+
+  async def close(self, timeout: float = 30.0) -> None:
+    self.closing = True
+    if self.process is None or self.process.returncode is not None:
+      # the worker is waiting to be restarted after a crash.
+      if self.task is not None:
+        self.task.cancel()
+      return
+
+    await self._stop()
+    try:
+      await asyncio.wait_for(self.process.wait(), timeout)
+    except asyncio.TimeoutError:
+      self.process.kill()
+    if self.task is not None:
+      await self.task
+
+
+class WorkerPool:
+  """
+  WorkerPool dispatches messages to worker processes, so that channels are handled on several cores.
+
+  Every channel is owned by a single worker chosen by a `HashRing`, so that a conversation is never handled by two
+  processes at once.
+  """
+  ring: HashRing
+  workers: list[WorkerProcess]
+
+  def __init__(
+    self,
+    workers: int,
+    argv: list[str],
+    on_event: EventHandler,
+    *,
+    env: dict[str, str] | None = None,
+    stderr: IO | int | None = None,
+  ) -> None:
+    self.ring = HashRing(workers)
+    # workers rebuild the ring to tell which stored conversations are theirs.
+    argv = [*argv, '--workers', str(workers)]
+    self.workers = [WorkerProcess(i, argv, on_event, env=env, stderr=stderr) for i in range(workers)]
+
+  async def start(self) -> None:
+    await asyncio.gather(*(w.start() for w in self.workers))
+
+  def owner(self, channel_id: int) -> WorkerProcess:
+    return self.workers[self.ring.owner(channel_id)]
+
+  def dispatch(self, event: dict[str, Any]) -> None:
+    worker = self.owner(event['channel'])
+    metrics.inc('worker_messages_total', worker=worker.index)
+    worker.submit(event)
+
+  async def restart(self) -> None:
+    """
+    Restart workers one by one, so that the other workers keep handling their channels.
+    """
+    for worker in self.workers:
+      await worker.restart()
+
+  async def close(self) -> None:
+    await asyncio.gather(*(w.close() for w in self.workers))
+
+
+class WorkerChatBot:
+  """
+  WorkerChatBot receives Discord events in the front process and lets a `WorkerPool` run `OpenAIChatBot` for them.
+
+  Workers handle messages with the same logic as a single process bot, and send replies back to the front, which
+  delivers them to Discord. SIGHUP restarts workers one by one.
+  """
+  client: Client
+  __secret: str
+  workers: int
+  worker_args: list[str]
+  pool: WorkerPool | None = None
+  messages: OrderedDict[int, Message]
+  max_messages: int = 4096
+  typing: dict[int, int]
+  typing_done: dict[int, asyncio.Event]
+
+  def __init__(self, secret: str, *, workers: int = 2, worker_args: list[str] | None = None) -> None:
+    intents = Intents.default()
+    intents.message_content = True
+
+    self.client = Client(intents=intents)
+    self.__secret = secret
+    self.workers = workers
+    self.worker_args = worker_args or []
+    self.messages = OrderedDict()
+    self.typing = {}
+    self.typing_done = {}
+    registerHandlers(self, self.client)
+
+  async def run(self) -> None:
+    try:
+      async with self.client:
+        await self.client.start(self.__secret)
+    finally:
+      if self.pool is not None:
+        await self.pool.close()
+
+  def start(self) -> None:
+    setup_logging(root=True)
+    try:
+      asyncio.run(self.run())
+    except KeyboardInterrupt:
+      pass
+
+  async def on_ready(self) -> None:
+    if self.pool is not None:
+      return
+    user = self.client.user
+    assert user is not None
+    argv = ['--bot-id', str(user.id), '--bot-name', user.display_name, *self.worker_args]
+    self.pool = WorkerPool(self.workers, argv, self.on_worker_event)
+    await self.pool.start()
+
+    loop = asyncio.get_running_loop()
+    if hasattr(signal, 'SIGHUP'):
+      loop.add_signal_handler(signal.SIGHUP, lambda: loop.create_task(self.restart()))
+    logger.info(f'Logged in as {user} with {self.workers} workers')
+
+  async def restart(self) -> None:
+    assert self.pool is not None
+    logger.info('restarting workers...')
+    await self.pool.restart()
+
+  def serialize(self, message: Message) -> dict[str, Any]:
+    mentions = [{'id': m.id, 'name': m.display_name} for m in message.mentions]
+    user = self.client.user
+    # workers have no roles, so that a mention of one of the bot's roles is sent as a mention of the bot.
+    if user not in message.mentions and any(user == m._user for r in message.role_mentions for m in r.members):
+      mentions.append({'id': user.id, 'name': user.display_name})
+    return {
+      'type': 'message',
+      'id': message.id,
+      'channel': message.channel.id,
+      'author': {'id': message.author.id, 'name': message.author.display_name},
+      'content': message.content,
+      'clean_content': message.clean_content,
+      'mentions': mentions,
+      'reference': message.reference is not None,
+    }
+
+  async def on_message(self, message: Message) -> None:
+    if self.pool is None or message.author == self.client.user:
+      return
+    # messages are kept for a while after they are handled, since workers send replies through their outboxes.
+    self.messages[message.id] = message
+    while len(self.messages) > self.max_messages:
+      self.messages.popitem(last=False)
+    self.pool.dispatch(self.serialize(message))
+
+  async def _type(self, channel: Any, done: asyncio.Event) -> None:
+    async with channel.typing():
+      await done.wait()
+
+  async def _send(self, target: Any, content: str, reply: bool) -> None:
+    try:
+      with metrics.span('discord_send'):
+        await (target.reply(content) if reply else target.send(content))
+    except Exception as e:
+      logger.error(f'failed to send a message: {type(e)}: {e}')
+
+  def on_worker_event(self, worker: WorkerProcess, event: dict[str, Any]) -> None:
+    loop = asyncio.get_running_loop()
+    match event['type']:
+      case 'send':
+        if (message := self.messages.get(event['reply_to'])) is not None:
+          loop.create_task(self._send(message, event['content'], True))
+        elif (channel := self.client.get_channel(event['channel'])) is not None:
+          loop.create_task(self._send(channel, event['content'], False))
+      case 'typing':
+        # replies of a channel may be generated concurrently, and the indicator lasts until the last one is sent.
+        cid = event['channel']
+        self.typing[cid] = self.typing.get(cid, 0) + (1 if event['active'] else -1)
+        if self.typing[cid] == 1 and event['active'] and (channel := self.client.get_channel(cid)) is not None:
+          done = self.typing_done[cid] = asyncio.Event()
+          loop.create_task(self._type(channel, done))
+        elif self.typing[cid] <= 0:
+          del self.typing[cid]
+          if (done := self.typing_done.pop(cid, None)) is not None:
+            done.set()
@@ -0,0 +1,39 @@
+from typing import Any
+
+import numpy as np
+
+from openai_secretary.embedding.backend import EmbeddingBackend, Embeddings, OpenAIEmbedding, embedding_model
+from openai_secretary.embedding.hashed import HashedNgramEmbedding, fit_idf
+
+
+def create_backend(name: str, *, dims: int | None = None, idf_path: str | None = None) -> EmbeddingBackend:
+  """
+  Create an embedding backend by its name, `openai` or `hashed`.
+
+  Args:
+    dims (int | None): Dimension of the `hashed` backend.
+    idf_path (str | None): `.npy` file of an IDF table fitted by `fit_idf`, used by the `hashed` backend.
+  """
+  match name:
+    case 'openai':
+      return OpenAIEmbedding()
+    case 'hashed':
+      options: dict[str, Any] = {}
+      if dims is not None:
+        options['dims'] = dims
+      if idf_path is not None:
+        options['idf'] = np.load(idf_path)
+      return HashedNgramEmbedding(**options)
+    case _:
+      raise ValueError(f'unknown embedding backend: {name}')
+
+
+__all__ = [
+  'EmbeddingBackend',
+  'Embeddings',
+  'HashedNgramEmbedding',
+  'OpenAIEmbedding',
+  'create_backend',
+  'embedding_model',
+  'fit_idf',
+]
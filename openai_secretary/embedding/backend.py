@@ -0,0 +1,55 @@
+from abc import ABC, abstractmethod
+from typing import ClassVar, NamedTuple
+
+from openai_secretary.client import OpenAIClient, openai_client
+
+embedding_model = 'text-search-ada-doc-001'
+
+
+class Embeddings(NamedTuple):
+  vectors: list[list[float]]
+  space: str
+  usage: dict | None = None
+
+
+class EmbeddingBackend(ABC):
+  """
+  EmbeddingBackend turns texts into vectors of a single embedding space.
+
+  Vectors are only comparable within a space, so every stored vector is tagged with `space(dims)`, and recall only
+  scores vectors of the query's space.
+  """
+  name: ClassVar[str]
+  model: str
+  dims: int | None
+  """Dimension of vectors, or None if it is only known from the model's responses."""
+
+  def space(self, dims: int) -> str:
+    return f'{self.name}:{self.model}:{dims}'
+
+  @property
+  def known_space(self) -> str | None:
+    return None if self.dims is None else self.space(self.dims)
+
+  @abstractmethod
+  async def embed(self, texts: list[str]) -> Embeddings:
+    ...
+
+
+class OpenAIEmbedding(EmbeddingBackend):
+  """
+  OpenAIEmbedding embeds texts with the OpenAI embedding API.
+  """
+  name = 'openai'
+  client: OpenAIClient
+
+  def __init__(self, model: str = embedding_model, client: OpenAIClient | None = None) -> None:
+    self.model = model
+    self.dims = None
+    self.client = client or openai_client
+
+  async def embed(self, texts: list[str]) -> Embeddings:
+    resp = await self.client.embedding(model=self.model, input=texts)
+    data = sorted(resp['data'], key=lambda d: d['index'])
+    vectors = [d['embedding'] for d in data]
+    return Embeddings(vectors, self.space(len(vectors[0])), resp.get('usage'))
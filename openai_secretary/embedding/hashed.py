@@ -0,0 +1,101 @@
+from hashlib import blake2b
+from typing import Iterable
+import unicodedata
+
+import numpy as np
+
+from openai_secretary.embedding.backend import EmbeddingBackend, Embeddings
+
+_mask = np.uint64(2**32 - 1)
+_prime = np.uint64(1_000_003)
+_mix = np.uint64(0x9E3779B1)
+
+
+def _normalize(text: str) -> str:
+  return ' ' + unicodedata.normalize('NFKC', text).lower() + ' '
+
+
+def ngram_hashes(text: str, ngrams: tuple[int, int], seed: int) -> np.ndarray:
+  """
+  32 bit hashes of every character n-gram of `text`, whose length is within `ngrams`.
+  """
+  chars = np.frombuffer(_normalize(text).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+  hashes = []
+  for n in range(ngrams[0], ngrams[1] + 1):
+    if len(chars) < n:
+      break
+    h = np.full(len(chars) - n + 1, np.uint64(seed * 31 + n), dtype=np.uint64)
+    for k in range(n):
+      h = (h * _prime + chars[k:len(chars) - n + 1 + k]) & _mask
+    hashes.append(((h * _mix) & _mask) ^ (h >> np.uint64(15)))
+  return np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint64)
+
+
+def fit_idf(texts: Iterable[str], buckets: int = 2**16, ngrams: tuple[int, int] = (2, 3), seed: int = 0) -> np.ndarray:
+  """
+  Fit smoothed inverse document frequencies of hashed n-grams on a corpus.
+  """
+  df = np.zeros(buckets, dtype=np.int64)
+  n = 0
+  for text in texts:
+    df[np.unique(ngram_hashes(text, ngrams, seed) % np.uint64(buckets)).astype(np.int64)] += 1
+    n += 1
+  return (np.log((1 + n) / (1 + df)) + 1).astype(np.float32)
+
+
+class HashedNgramEmbedding(EmbeddingBackend):
+  """
+  HashedNgramEmbedding embeds texts locally with hashed character n-gram TF-IDF.
+
+  Each n-gram is hashed, weighted by its sublinear term frequency and optionally by a fitted IDF table, and added to
+  one of `dims` dimensions with a hashed sign, which is a fixed sparse random projection. Vectors are L2 normalized.
+  It needs no network and the same text always maps to the same vector.
+  """
+  name = 'hashed'
+  ngrams: tuple[int, int]
+  seed: int
+  idf: np.ndarray | None
+
+  def __init__(
+    self,
+    dims: int = 256,
+    *,
+    ngrams: tuple[int, int] = (2, 3),
+    seed: int = 0,
+    idf: np.ndarray | None = None,
+  ) -> None:
+    self.dims = dims
+    self.ngrams = ngrams
+    self.seed = seed
+    self.idf = idf
+    self.model = f'char{ngrams[0]}-{ngrams[1]}gram-s{seed}'
+    if idf is not None:
+      self.model += '-idf' + blake2b(idf.tobytes(), digest_size=4).hexdigest()
+
+  def encode(self, texts: list[str]) -> np.ndarray:
+    """
+    Encode texts into a `(len(texts), dims)` matrix.
+    """
+    dims = self.dims
+    assert dims is not None
+    if not texts:
+      return np.zeros((0, dims), dtype=np.float32)
+
+    hashes = [ngram_hashes(text, self.ngrams, self.seed) for text in texts]
+    rows = np.repeat(np.arange(len(texts), dtype=np.uint64), [len(h) for h in hashes])
+    keys, counts = np.unique((rows << np.uint64(32)) | np.concatenate(hashes), return_counts=True)
+    rows, h = (keys >> np.uint64(32)).astype(np.int64), keys & _mask
+
+    weights = 1 + np.log(counts.astype(np.float32))
+    if self.idf is not None:
+      weights *= self.idf[(h % np.uint64(len(self.idf))).astype(np.int64)]
+    signs = np.where((h >> np.uint64(31)) & np.uint64(1), -1.0, 1.0).astype(np.float32)
+
+    out = np.zeros((len(texts), dims), dtype=np.float32)
+    np.add.at(out, (rows, (h % np.uint64(dims)).astype(np.int64)), signs * weights)
+    norms = np.linalg.norm(out, axis=1, keepdims=True)
+    return out / np.maximum(norms, 1e-12)
+
+  async def embed(self, texts: list[str]) -> Embeddings:
+    assert self.dims is not None
+    return Embeddings(self.encode(texts).tolist(), self.space(self.dims))
@@ -0,0 +1,10 @@
+from openai_secretary.memory.retention import Pruner, RetentionPolicy
+from openai_secretary.memory.tiers import MemoryConfig, Recollection, TieredMemory
+
+__all__ = [
+  'MemoryConfig',
+  'Pruner',
+  'Recollection',
+  'RetentionPolicy',
+  'TieredMemory',
+]
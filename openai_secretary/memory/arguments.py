@@ -0,0 +1,51 @@
+from argparse import ArgumentParser, Namespace
+from typing import Any
+
+from openai_secretary.memory.tiers import MemoryConfig
+
+_options: dict[str, dict[str, Any]] = {
+  'recent': {'type': int, 'help': 'latest messages always put into the context.'},
+  'recall': {'type': int, 'help': 'recollections put into the context.'},
+  'keep_recent': {'type': int, 'help': 'latest messages which are never summarized.'},
+  'span': {'type': int, 'help': 'messages folded into a tier 0 summary.'},
+  'fanout': {'type': int, 'help': 'summaries folded into a summary of the next tier.'},
+  'quantization': {'choices': ['int8', 'binary'], 'help': 'preselect recalled messages by quantized codes.'},
+  'reduction': {'action': 'store_true', 'help': 'preselect recalled messages in the reduced space.'},
+  'rerank': {'type': int, 'help': 'preselected messages scored exactly.'},
+  'hybrid': {'action': 'store_true', 'help': 'fuse full-text matches with vector similarity.'},
+}
+"""
+`MemoryConfig` fields settable from the command line, and their argparse options. Omitted options keep the defaults
+of `MemoryConfig`.
+"""
+
+
+def add_memory_arguments(parser: ArgumentParser) -> None:
+  group = parser.add_argument_group('memory')
+  for name, options in _options.items():
+    default = False if options.get('action') == 'store_true' else None
+    group.add_argument(f'--{name.replace("_", "-")}', dest=f'memory_{name}', default=default, **options)
+
+
+def _given(args: Namespace) -> dict[str, Any]:
+  values = {name: getattr(args, f'memory_{name}') for name in _options}
+  return {name: value for name, value in values.items() if value not in (None, False)}
+
+
+def memory_config(args: Namespace) -> MemoryConfig:
+  """
+  Build a `MemoryConfig` from options added by `add_memory_arguments`.
+  """
+  return MemoryConfig(**_given(args))
+
+
+def memory_argv(args: Namespace) -> list[str]:
+  """
+  Format options added by `add_memory_arguments` back into arguments, to be passed on to worker processes.
+  """
+  argv: list[str] = []
+  for name, value in _given(args).items():
+    argv.append(f'--{name.replace("_", "-")}')
+    if value is not True:
+      argv.append(str(value))
+  return argv
@@ -0,0 +1,130 @@
+import json
+import re
+from typing import Iterable, NamedTuple
+
+from pony.orm import db_session
+
+from openai_secretary.database import db
+from openai_secretary.database.migrations import FtsTokenizer, create_fts, fts_table
+from openai_secretary.database.models import Conversation
+from openai_secretary.database.sharding import location
+
+_term = re.compile(r'[一-龯々〆ヵヶ]+|[ァ-ヴー]+|[ぁ-ゖ]+|\w+')
+_hiragana = re.compile(r'[ぁ-ゖ]+')
+_tokenize = re.compile(r"tokenize\s*=\s*'(\w+)")
+
+_tokenizers: dict[str, FtsTokenizer] = {}
+"""
+Tokenizers of the indexes of database files known to exist.
+"""
+
+
+class LexicalQuery(NamedTuple):
+  match: str | None
+  """FTS5 query of the terms the index can match."""
+  short: tuple[str, ...]
+  """Terms too short for the trigram tokenizer, which are matched as substrings instead."""
+
+
+@db_session
+def rebuild_index(tokenizer: FtsTokenizer = 'trigram') -> None:
+  """
+  Drop and recreate the full-text index of messages, indexing every existing message.
+  """
+  for trigger in ('ai', 'ad', 'au'):
+    db.execute(f'DROP TRIGGER IF EXISTS "{fts_table}_{trigger}"')
+  db.execute(f'DROP TABLE IF EXISTS "{fts_table}"')
+  connection = db.get_connection()
+  create_fts(connection, tokenizer)
+  connection.commit()
+  _tokenizers[location()] = tokenizer
+
+
+@db_session
+def ensure_index() -> FtsTokenizer:
+  """
+  Create the full-text index of messages with the trigram tokenizer unless it exists. Databases create it when they
+  are opened, so that this only matters for databases changed by other means.
+
+  Returns:
+    FtsTokenizer: Tokenizer of the index, which queries must be built for. Indexes rebuilt by `rebuild_index` with
+    another tokenizer keep it.
+  """
+  if (tokenizer := _tokenizers.get(location())) is not None:
+    return tokenizer
+  connection = db.get_connection()
+  if create_fts(connection):
+    connection.commit()
+  sql = connection.execute(f'SELECT "sql" FROM sqlite_master WHERE "name" = \'{fts_table}\'').fetchone()[0]
+  found = _tokenize.search(sql)
+  tokenizer = _tokenizers[location()] = 'trigram' if found is not None and found[1] == 'trigram' else 'unicode61'
+  return tokenizer
+
+
+def match_query(text: str, tokenizer: FtsTokenizer, limit: int = 16) -> LexicalQuery | None:
+  """
+  Build a query matching any distinctive term of `text`.
+
+  Text is split into runs of kanji, katakana, hiragana and other word characters. Hiragana runs, which are mostly
+  particles and inflections, are dropped. The longest terms are kept. The trigram tokenizer cannot match terms shorter
+  than 3 characters, such as most Japanese words written in two kanji, so that they are matched as substrings.
+  """
+  terms = sorted({t for t in _term.findall(text) if not _hiragana.fullmatch(t)}, key=len, reverse=True)[:limit]
+  if not terms:
+    return None
+  minimum = 3 if tokenizer == 'trigram' else 1
+  indexed = [t for t in terms if len(t) >= minimum]
+  match = ' OR '.join('"' + t.replace('"', '""') + '"' for t in indexed) if indexed else None
+  return LexicalQuery(match, tuple(t for t in terms if len(t) < minimum))
+
+
+def lexical_candidates(
+  c: Conversation,
+  space: str,
+  query: LexicalQuery,
+  lower: int,
+  upper: int,
+  limit: int,
+) -> list[tuple[int, int]]:
+  """
+  Select messages embedded in `space` in `(lower, upper)` matching `query`, as `(id, index)`. Full-text matches come
+  first in the order of their bm25 rank, followed by the latest substring matches of short terms.
+  """
+  cid = c.id
+  rows: list[tuple[int, int]] = []
+  if query.match is not None:
+    match = query.match
+    rows = list(
+      db.select(
+        f'SELECT m."id", m."index" FROM "{fts_table}" f JOIN "Message" m ON m."id" = f.rowid '
+        f'WHERE f."{fts_table}" MATCH $match AND m."conversation" = $cid AND m."index" > $lower AND m."index" < $upper '
+        'AND m."embeddings" IS NOT NULL AND m."space" = $space '
+        'ORDER BY f.rank LIMIT $limit'
+      )
+    )
+
+  if query.short and len(rows) < limit:
+    terms = json.dumps(query.short, ensure_ascii=False)
+    found = {i for i, _ in rows}
+    rest = limit - len(rows)
+    substrings = db.select(
+      'SELECT m."id", m."index" FROM "Message" m '
+      'WHERE m."conversation" = $cid AND m."index" > $lower AND m."index" < $upper '
+      'AND m."embeddings" IS NOT NULL AND m."space" = $space '
+      'AND EXISTS (SELECT 1 FROM json_each($terms) t WHERE instr(m."text", t."value") > 0) '
+      'ORDER BY m."index" DESC LIMIT $limit'
+    )
+    rows += [r for r in substrings if r[0] not in found][:rest]
+
+  return [(i, index) for i, index in rows]
+
+
+def fuse(rankings: Iterable[list[int]], k: int = 60) -> list[int]:
+  """
+  Fuse rankings with the reciprocal rank fusion.
+  """
+  scores: dict[int, float] = {}
+  for ranking in rankings:
+    for rank, i in enumerate(ranking):
+      scores[i] = scores.get(i, 0.0) + 1.0 / (k + rank + 1)
+  return sorted(scores, key=lambda i: scores[i], reverse=True)
@@ -0,0 +1,88 @@
+from typing import Literal, Sequence, TypeAlias
+
+import numpy as np
+from pony.orm import desc, raw_sql, select
+
+from openai_secretary.database.models import Conversation, Message, QuantizedEmbedding
+
+Quantization: TypeAlias = Literal['int8', 'binary']
+
+
+def _unit(vec: Sequence[float] | np.ndarray) -> np.ndarray:
+  v = np.asarray(vec, dtype=np.float32)
+  norm = float(np.linalg.norm(v))
+  return v / norm if norm > 0.0 else v
+
+
+def quantize_int8(vec: Sequence[float] | np.ndarray) -> tuple[bytes, float]:
+  """
+  Quantize a vector into int8 after normalizing it to unit length.
+
+  Returns:
+    tuple[bytes, float]: Quantized vector and its scale. `code * scale` approximates the unit vector.
+  """
+  v = _unit(vec)
+  peak = float(np.abs(v).max()) if v.size else 0.0
+  scale = peak / 127 if peak > 0.0 else 1.0
+  return np.clip(np.rint(v / scale), -127, 127).astype(np.int8).tobytes(), scale
+
+
+def quantize_binary(vec: Sequence[float] | np.ndarray) -> bytes:
+  """
+  Quantize a vector into its packed sign bits. Candidates are ranked by Hamming distance, which no scale affects.
+  """
+  return np.packbits(np.asarray(vec, dtype=np.float32) > 0.0).tobytes()
+
+
+def quantize_query(vec: Sequence[float] | np.ndarray, kind: Quantization) -> bytes:
+  return quantize_int8(vec)[0] if kind == 'int8' else quantize_binary(vec)
+
+
+def store_quantized(message: Message, vec: Sequence[float] | np.ndarray) -> QuantizedEmbedding:
+  """
+  Store the codes of a message, replacing its existing codes.
+  """
+  int8, int8_scale = quantize_int8(vec)
+  bits = quantize_binary(vec)
+  if message.quantized is not None:
+    message.quantized.set(int8=int8, int8_scale=int8_scale, bits=bits)
+    return message.quantized
+  return QuantizedEmbedding(message=message, int8=int8, int8_scale=int8_scale, bits=bits)
+
+
+def quantized_candidates(
+  c: Conversation,
+  space: str,
+  code: bytes,
+  kind: Quantization,
+  lower: int,
+  upper: int,
+  limit: int,
+) -> list[int]:
+  """
+  Select ids of the messages embedded in `space` closest to the quantized query `code` in `(lower, upper)`.
+
+  Binary codes are ranked by the hamming distance, and int8 codes by the approximate dot product.
+  Embedded messages without codes are always selected, so that they are still scored exactly.
+  """
+  # yapf: disable
+  query = select(
+    q.message.id for q in QuantizedEmbedding
+    if q.message.conversation == c and q.message.space == space and q.message.index > lower
+    and q.message.index < upper
+  )
+
+  if kind == 'binary':
+    ids = query.order_by(lambda: raw_sql('hamming_distance(q.bits, $code)'))[:limit]
+  else:
+    ids = query.order_by(lambda: desc(raw_sql('int8_dot(q.int8, $code) * q.int8_scale')))[:limit]
+
+  return [
+    *ids,
+    *select(
+      m.id for m in Message
+      if m.conversation == c and m.embeddings is not None and m.space == space and m.quantized is None
+      and m.index > lower and m.index < upper
+    ),
+  ]
+  # yapf: enable
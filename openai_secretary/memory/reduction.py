@@ -0,0 +1,206 @@
+from dataclasses import dataclass
+from datetime import datetime
+import json
+from typing import Literal, Sequence, TypeAlias
+
+import numpy as np
+from pony.orm import commit, db_session, desc, raw_sql, select
+
+from openai_secretary.database.models import Conversation, Message, ReducedEmbedding, Reducer
+
+ReductionMethod: TypeAlias = Literal['pca', 'random']
+
+
+@dataclass(frozen=True)
+class Projection:
+  """
+  Projection is a loaded reducer, mapping full embeddings into the reduced space.
+  """
+  id: int
+  mean: np.ndarray
+  matrix: np.ndarray
+
+  @property
+  def dims(self) -> int:
+    return self.matrix.shape[0]
+
+  @property
+  def source_dims(self) -> int:
+    return self.matrix.shape[1]
+
+  def project(self, vecs: Sequence[float] | Sequence[Sequence[float]] | np.ndarray) -> np.ndarray:
+    return (np.asarray(vecs, dtype=np.float32) - self.mean) @ self.matrix.T
+
+  @classmethod
+  def load(cls, reducer: Reducer) -> 'Projection':
+    mean = np.frombuffer(reducer.mean, dtype=np.float32)
+    matrix = np.frombuffer(reducer.matrix, dtype=np.float32).reshape(reducer.dims, reducer.source_dims)
+    return cls(reducer.id, mean, matrix)
+
+
+def format_vector(vec: np.ndarray) -> str:
+  """
+  Format a vector in the literal format understood by `similarity()`.
+  """
+  return '[' + ','.join(f'{x:.6g}' for x in vec.tolist()) + ']'
+
+
+def fit(samples: np.ndarray, dims: int, method: ReductionMethod, *, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+  """
+  Fit a linear reducer on embeddings.
+
+  Args:
+    samples (np.ndarray): Embeddings in shape `(n, source_dims)`.
+    dims (int): Target dimension. PCA is capped at the number of samples.
+    method (ReductionMethod): `pca` for principal components, or `random` for a gaussian random projection.
+
+  Returns:
+    tuple[np.ndarray, np.ndarray]: Mean in shape `(source_dims,)` and matrix in shape `(dims, source_dims)`.
+  """
+  samples = np.asarray(samples, dtype=np.float32)
+
+  if method == 'random':
+    rng = np.random.default_rng(seed)
+    matrix = rng.standard_normal((dims, samples.shape[1]), dtype=np.float32) / np.float32(np.sqrt(dims))
+    return np.zeros(samples.shape[1], dtype=np.float32), matrix
+
+  mean = samples.mean(axis=0)
+  _, _, vt = np.linalg.svd(samples - mean, full_matrices=False)
+  return mean.astype(np.float32), np.ascontiguousarray(vt[:dims], dtype=np.float32)
+
+
+def load_samples(c: Conversation, space: str, limit: int | None = None) -> np.ndarray:
+  query = select(m.embeddings for m in Message if m.conversation == c and m.embeddings is not None and m.space == space)
+  rows = query.random(limit) if limit is not None else query[:]
+  return np.array([json.loads(r) for r in rows], dtype=np.float32)
+
+
+def active_reducer(c: Conversation, space: str) -> Reducer | None:
+  return select(r for r in Reducer if r.conversation == c and r.space == space).order_by(desc(Reducer.id)).first()
+
+
+@db_session
+def create_reducer(conversation_id: int, dims: int, method: ReductionMethod, samples: int | None = None) -> int:
+  """
+  Fit a new reducer on the stored embeddings of a conversation and make it active. It is fitted in the embedding
+  space of the latest embedded message.
+
+  Returns:
+    int: Id of the new reducer.
+  """
+  c = Conversation[conversation_id]
+  if (space := c.latest_space()) is None:
+    raise ValueError(f'conversation {conversation_id} has no embedded messages.')
+  data = load_samples(c, space, samples)
+
+  mean, matrix = fit(data, dims, method)
+  reducer = Reducer(
+    method=method,
+    space=space,
+    dims=matrix.shape[0],
+    source_dims=matrix.shape[1],
+    mean=mean.tobytes(),
+    matrix=matrix.tobytes(),
+    created_at=datetime.now(),
+    conversation=c,
+  )
+  commit()
+  return reducer.id
+
+
+def _store(message: Message, reducer_id: int, reduced: np.ndarray) -> None:
+  vector = format_vector(reduced)
+  if message.reduced is None:
+    ReducedEmbedding(message=message, reducer=reducer_id, vector=vector)
+  else:
+    message.reduced.set(reducer=reducer_id, vector=vector)
+
+
+def store_reduced(message: Message, projection: Projection, vec: Sequence[float] | np.ndarray) -> None:
+  _store(message, projection.id, projection.project(vec))
+
+
+def reproject(conversation_id: int, batch: int) -> int:
+  """
+  Project every message of a conversation in the latest embedding space which is not projected by the active
+  reducer, `batch` rows per transaction. Older reducers of that space are removed afterwards, while reducers of other
+  spaces are kept.
+
+  Returns:
+    int: Number of projected messages.
+  """
+  done = 0
+
+  with db_session:
+    c = Conversation[conversation_id]
+    if (space := c.latest_space()) is None or (reducer := active_reducer(c, space)) is None:
+      return 0
+    projection = Projection.load(reducer)
+    rid = projection.id
+
+  while True:
+    with db_session:
+      # yapf: disable
+      msgs = select(
+        m for m in Message
+        if m.conversation.id == conversation_id and m.embeddings is not None and m.space == space
+        and (m.reduced is None or m.reduced.reducer.id != rid)
+      )[:batch]
+      # yapf: enable
+
+      if msgs:
+        for m, reduced in zip(msgs, projection.project([json.loads(m.embeddings) for m in msgs])):
+          _store(m, rid, reduced)
+      commit()
+
+    done += len(msgs)
+    if len(msgs) < batch:
+      break
+
+  with db_session:
+    # yapf: disable
+    select(
+      e for e in ReducedEmbedding
+      if e.reducer.conversation.id == conversation_id and e.reducer.space == space and e.reducer.id != rid
+    ).delete(bulk=True)
+    select(
+      r for r in Reducer if r.conversation.id == conversation_id and r.space == space and r.id != rid
+    ).delete(bulk=True)
+    # yapf: enable
+
+  return done
+
+
+def reduced_candidates(
+  c: Conversation,
+  space: str,
+  projection: Projection,
+  reduced_vec: str,
+  lower: int,
+  upper: int,
+  limit: int,
+) -> list[int]:
+  """
+  Select ids of the messages closest to `reduced_vec` in the reduced space in `(lower, upper)`.
+
+  Messages embedded in `space` which are not projected by `projection` are always selected, so that they are still
+  scored exactly.
+  """
+  rid = projection.id
+  # yapf: disable
+  ids = select(
+    r.message.id for r in ReducedEmbedding
+    if r.reducer.id == rid and r.message.conversation == c and r.message.index > lower and r.message.index < upper
+  ).order_by(
+    lambda: desc(raw_sql('similarity(r.vector, $reduced_vec)'))
+  )[:limit]
+
+  return [
+    *ids,
+    *select(
+      m.id for m in Message
+      if m.conversation == c and m.embeddings is not None and m.space == space
+      and (m.reduced is None or m.reduced.reducer.id != rid) and m.index > lower and m.index < upper
+    ),
+  ]
+  # yapf: enable
@@ -0,0 +1,295 @@
+import asyncio
+from contextlib import closing
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from glob import glob
+from logging import getLogger
+from os.path import join
+import sqlite3
+from time import monotonic
+from typing import Any, Callable
+
+from pony.orm import commit, db_session, max as orm_max, select
+
+from openai_secretary.database import db
+from openai_secretary.database.connection import db_path
+from openai_secretary.database.models import Conversation, Message, Summary
+from openai_secretary.database.sharding import ShardLayout, location, shard
+from openai_secretary.metrics import metrics
+
+logger = getLogger('oai_chatbot.retention')
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+  """
+  RetentionPolicy decides which old messages of a conversation are deleted. System messages are always kept.
+  """
+  max_age: timedelta | None = None
+  """Messages older than this are pruned."""
+  max_rows: int | None = None
+  """Number of latest messages kept. Older ones are pruned."""
+  summarized: bool = True
+  """
+  Only prune messages covered by a tier 0 summary, so that old turns are still recalled through their summaries.
+  Without `max_age` and `max_rows`, every summarized message is pruned.
+  """
+
+  def to_dict(self) -> dict[str, Any]:
+    return {
+      'max_age_days': self.max_age / timedelta(days=1) if self.max_age is not None else None,
+      'max_rows': self.max_rows,
+      'summarized': self.summarized,
+    }
+
+  @classmethod
+  def from_dict(cls, value: dict[str, Any]) -> 'RetentionPolicy':
+    days = value.get('max_age_days')
+    return cls(
+      max_age=timedelta(days=days) if days is not None else None,
+      max_rows=value.get('max_rows'),
+      summarized=value.get('summarized', True),
+    )
+
+  def describe(self) -> str:
+    terms = []
+    if self.max_age is not None:
+      terms.append(f'max_age={self.max_age / timedelta(days=1):g}d')
+    if self.max_rows is not None:
+      terms.append(f'max_rows={self.max_rows}')
+    terms.append(f'summarized={"on" if self.summarized else "off"}')
+    return ' '.join(terms)
+
+
+def prunable_upto(c: Conversation, policy: RetentionPolicy) -> int | None:
+  """
+  Index of the latest message the policy prunes, or None if nothing is pruned. Must be called within a db_session.
+  """
+  cutoff: int | None = None
+
+  if policy.max_rows is not None:
+    # yapf: disable
+    kept = select(
+      m.index for m in Message if m.conversation == c and m.role != 'system'
+    ).order_by(-1)[policy.max_rows:policy.max_rows + 1]
+    # yapf: enable
+    if kept:
+      cutoff = kept[0]
+
+  if policy.max_age is not None:
+    deadline = datetime.now() - policy.max_age
+    aged = orm_max(m.index for m in Message if m.conversation == c and m.role != 'system' and m.created_at <= deadline)
+    if aged is not None:
+      cutoff = aged if cutoff is None else max(cutoff, aged)
+
+  if policy.summarized:
+    upto = orm_max(s.last_index for s in Summary if s.conversation == c and s.tier == 0)
+    if upto is None:
+      return None
+    if policy.max_age is None and policy.max_rows is None:
+      return upto
+    return None if cutoff is None else min(cutoff, upto)
+
+  return cutoff
+
+
+def prune_batch(conversation_id: int, policy: RetentionPolicy, batch: int = 200) -> int:
+  """
+  Delete up to `batch` of the oldest messages the policy prunes, with their search codes, in one transaction.
+
+  Returns:
+    int: Number of deleted messages. Less than `batch` once nothing is left to prune.
+  """
+  with shard(conversation_id), db_session:
+    c = Conversation.get(id=conversation_id)
+    if c is None or (cutoff := prunable_upto(c, policy)) is None:
+      return 0
+
+    ids = db.select(
+      'SELECT "id" FROM "Message" '
+      'WHERE "conversation" = $conversation_id AND "role" != \'system\' AND "index" <= $cutoff '
+      'ORDER BY "index" LIMIT $batch'
+    )
+    if not ids:
+      return 0
+
+    # ids are integers read from the database, so that they are safe to inline.
+    marks = ', '.join(str(i) for i in ids)
+    with metrics.span('retention_prune'):
+      db.execute(f'DELETE FROM "QuantizedEmbedding" WHERE "message" IN ({marks})')
+      db.execute(f'DELETE FROM "ReducedEmbedding" WHERE "message" IN ({marks})')
+      # the full-text index is updated by its delete trigger.
+      db.execute(f'DELETE FROM "Message" WHERE "id" IN ({marks})')
+      commit()
+
+  metrics.inc('retention_pruned_messages_total', len(ids))
+  return len(ids)
+
+
+def databases(layout: ShardLayout | None) -> list[str]:
+  """
+  Paths of the global database and, with a layout, of every shard file.
+  """
+  if layout is None:
+    return [db_path]
+  return [db_path, *sorted(glob(join(layout.directory, '*.db')))]
+
+
+def conversation_ids(paths: list[str]) -> list[int]:
+  """
+  Ids of the conversations stored in database files.
+  """
+  cids: set[int] = set()
+  for path in paths:
+    with closing(sqlite3.connect(path)) as connection:
+      if connection.execute('SELECT 1 FROM sqlite_master WHERE "name" = \'Conversation\'').fetchone():
+        cids.update(cid for cid, in connection.execute('SELECT "id" FROM "Conversation"'))
+  return sorted(cids)
+
+
+def file_stats(path: str) -> dict[str, int]:
+  """
+  Page statistics of a database file: `page_size`, `page_count`, `freelist_count` and `auto_vacuum`, which is 2 when
+  incremental vacuum is available.
+  """
+  with closing(sqlite3.connect(path)) as connection:
+    return {
+      name: connection.execute(f'PRAGMA {name}').fetchone()[0]
+      for name in ('page_size', 'page_count', 'freelist_count', 'auto_vacuum')
+    }
+
+
+def incremental_vacuum(path: str, pages: int | None = None) -> int:
+  """
+  Return up to `pages` free pages of a database file to the file system, or every free page if None. Does nothing
+  unless the file is in the incremental auto-vacuum mode.
+
+  Returns:
+    int: Number of released pages.
+  """
+  with closing(sqlite3.connect(path, timeout=30.0, isolation_level=None)) as connection:
+    if connection.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+      return 0
+    before = connection.execute('PRAGMA freelist_count').fetchone()[0]
+    # `execute` steps a statement without result columns only once, which releases a single page.
+    connection.executescript(f'PRAGMA incremental_vacuum({pages if pages is not None else 0});')
+    released = before - connection.execute('PRAGMA freelist_count').fetchone()[0]
+
+  metrics.inc('retention_vacuumed_pages_total', released)
+  return released
+
+
+class Pruner:
+  """
+  Pruner keeps conversations within their retention policies while they are idle.
+
+  Messages are deleted in small transactions with pauses in between, so that a conversation which becomes active
+  again is neither blocked nor pruned further. Freed pages are then released by incremental vacuum in small steps
+  too. Databases created before auto-vacuum was configured keep their free pages for reuse until they are converted
+  with `python -m openai_secretary.tools retention vacuum --convert`.
+  """
+  default: RetentionPolicy | None
+  policies: dict[int, RetentionPolicy | None]
+  """Policies of conversations overriding `default`. None disables pruning of the conversation."""
+  active: dict[int, float]
+  """
+  Last activity of every conversation known, in monotonic seconds. Conversations stored before the process started
+  are added by `seed`.
+  """
+  idle: float = 120.0
+  """Seconds without activity after which a conversation is pruned."""
+  batch: int = 200
+  """Number of messages deleted per transaction."""
+  pause: float = 0.05
+  """Seconds between transactions."""
+  vacuum_pages: int = 256
+  """Number of pages released per incremental vacuum step."""
+
+  def __init__(self, default: RetentionPolicy | None = None) -> None:
+    self.default = default
+    self.policies = {}
+    self.active = {}
+
+  def policy(self, conversation_id: int) -> RetentionPolicy | None:
+    return self.policies.get(conversation_id, self.default)
+
+  def touch(self, conversation_id: int) -> None:
+    self.active[conversation_id] = monotonic()
+
+  def seed(self, layout: ShardLayout | None = None, owns: Callable[[int], bool] | None = None) -> int:
+    """
+    Track the conversations stored in the databases as if they were active now, so that conversations idle since
+    before a restart are pruned too. `owns` restricts them to the conversations handled by this process.
+
+    Returns:
+      int: Number of conversations newly tracked.
+    """
+    now = monotonic()
+    seeded = 0
+    for cid in conversation_ids(databases(layout)):
+      if cid not in self.active and (owns is None or owns(cid)):
+        self.active[cid] = now
+        seeded += 1
+    return seeded
+
+  def is_idle(self, conversation_id: int) -> bool:
+    return monotonic() - self.active.get(conversation_id, 0.0) >= self.idle
+
+  async def prune(self, conversation_id: int) -> int:
+    """
+    Prune a conversation batch by batch until nothing is left or it becomes active.
+
+    Returns:
+      int: Number of deleted messages.
+    """
+    if (policy := self.policy(conversation_id)) is None:
+      return 0
+    pruned = 0
+    while self.is_idle(conversation_id):
+      deleted = prune_batch(conversation_id, policy, self.batch)
+      pruned += deleted
+      if deleted < self.batch:
+        break
+      await asyncio.sleep(self.pause)
+    return pruned
+
+  async def vacuum(self, path: str) -> int:
+    released = 0
+    while (step := incremental_vacuum(path, self.vacuum_pages)) > 0:
+      released += step
+      await asyncio.sleep(self.pause)
+    return released
+
+  async def prune_idle(self) -> int:
+    """
+    Prune every idle conversation, then release the freed pages of their database files.
+
+    Returns:
+      int: Number of deleted messages.
+    """
+    pruned = 0
+    paths: set[str] = set()
+    for cid in list(self.active):
+      if not self.is_idle(cid):
+        continue
+      if deleted := await self.prune(cid):
+        pruned += deleted
+        with shard(cid):
+          paths.add(location())
+        logger.info(f'{deleted} messages of channel {cid} are pruned.')
+
+    for path in paths:
+      page_size = file_stats(path)['page_size']
+      if released := await self.vacuum(path):
+        metrics.inc('retention_reclaimed_bytes_total', released * page_size)
+        logger.info(f'{released * page_size} bytes of {path} are reclaimed.')
+    return pruned
+
+  async def run(self, interval: float) -> None:
+    logger.info('message pruner has been started.')
+    while True:
+      await asyncio.sleep(interval)
+      try:
+        await self.prune_idle()
+      except Exception as e:
+        logger.error(f'failed to prune messages: {type(e)}: {e}')
@@ -0,0 +1,385 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from heapq import heappop, heappush
+import json
+from itertools import count
+from logging import getLogger
+from typing import TYPE_CHECKING, Callable, NamedTuple, TypeAlias
+
+from pony.orm import commit, db_session, desc, max as orm_max, raw_sql, select
+
+from openai_secretary.database.models import Conversation, Message, Summary
+from openai_secretary.memory.lexical import ensure_index, fuse, lexical_candidates, match_query
+from openai_secretary.memory.quantize import Quantization, quantize_query, quantized_candidates, store_quantized
+from openai_secretary.memory.reduction import (
+  Projection,
+  active_reducer,
+  format_vector,
+  reduced_candidates,
+  store_reduced,
+)
+from openai_secretary.metrics import metrics
+
+if TYPE_CHECKING:
+  from openai_secretary.agent import Agent
+
+logger = getLogger('oai_chatbot.memory')
+
+Prefilter: TypeAlias = Callable[[int, int], list[int]]
+
+
+@dataclass(frozen=True)
+class MemoryConfig:
+  """
+  MemoryConfig controls how old turns are folded into summaries and recalled.
+  """
+  recent: int = 10
+  """Number of latest messages always put into the context verbatim."""
+  recall: int = 10
+  """Number of recollections put into the context."""
+  keep_recent: int = 50
+  """Number of latest messages which are never summarized."""
+  max_age: timedelta | None = None
+  """Messages older than this are summarized even if they are within `keep_recent`."""
+  span: int = 20
+  """Number of messages folded into a tier 0 summary."""
+  fanout: int = 4
+  """Number of summaries folded into a summary of the next tier."""
+  max_expansions: int = 4
+  """Number of summaries recall may drill into per query."""
+  drop_embeddings_from_tier: int | None = None
+  """Drop raw message embeddings once they are covered by a summary of this tier or above."""
+  quantization: Quantization | None = None
+  """Quantized codes used to preselect messages before exact scoring. None scores every message exactly."""
+  reduction: bool = False
+  """Preselect messages in the space of the conversation's fitted reducer. Ignored when `quantization` is set."""
+  rerank: int = 300
+  """Number of preselected messages scored exactly."""
+  hybrid: bool = False
+  """Fuse full-text matches of the query with vector similarity when recalling raw messages."""
+  lexical_candidates: int = 50
+  """Number of full-text matches considered per query in hybrid recall."""
+  vector_window: int = 200
+  """Number of latest messages scored by vectors in hybrid recall when no prefilter is configured."""
+
+
+class Recollection(NamedTuple):
+  text: str
+  similarity: float
+  summary: bool
+
+
+class TieredMemory:
+  """
+  TieredMemory keeps a conversation searchable in roughly logarithmic size.
+
+  Spans of old messages are summarized into tier 0 summaries, and every `fanout` summaries of a tier are summarized
+  again into a summary of the next tier. Only summaries without a parent ("frontier" summaries) and messages not yet
+  summarized are scored on each query. The best candidates are then expanded into their children on demand.
+  """
+  agent: 'Agent | None'
+  """Agent which summarizes and embeds spans. None for a memory which only recalls, such as in tools."""
+  config: MemoryConfig
+  _projection: Projection | None = None
+
+  def __init__(self, agent: 'Agent | None' = None, config: MemoryConfig | None = None) -> None:
+    self.agent = agent
+    self.config = config or MemoryConfig()
+
+  def _owner(self) -> 'Agent':
+    if self.agent is None:
+      raise ValueError('a memory without an agent can only recall.')
+    return self.agent
+
+  def projection(self, c: Conversation, space: str) -> Projection | None:
+    """
+    Load the active reducer of the conversation for an embedding space, which may be refitted by another process at
+    any time.
+    """
+    reducer = active_reducer(c, space)
+    if reducer is None:
+      return None
+    if self._projection is None or self._projection.id != reducer.id:
+      self._projection = Projection.load(reducer)
+    return self._projection
+
+  def index_message(self, message: Message, vec: list[float]) -> None:
+    """
+    Store search codes of a newly embedded message.
+    """
+    if self.config.quantization is not None:
+      store_quantized(message, vec)
+    elif self.config.reduction and message.space is not None:
+      if (projection := self.projection(message.conversation, message.space)) is not None:
+        store_reduced(message, projection, vec)
+
+  def summarized_upto(self, c: Conversation) -> int:
+    upto = orm_max(s.last_index for s in Summary if s.conversation == c and s.tier == 0)
+    return -1 if upto is None else upto
+
+  @db_session
+  def next_span(self) -> tuple[int, int, int, list[str], list[int]] | None:
+    """
+    Find the next span to be summarized.
+
+    Returns:
+      tuple | None: `(tier, first_index, last_index, texts, child_summary_ids)`, or None if nothing is to be done.
+    """
+    cfg = self.config
+    c = Conversation[self._owner().cid]
+
+    latest = orm_max(m.index for m in Message if m.conversation == c)
+    if latest is None:
+      return None
+
+    cutoff = latest - cfg.keep_recent
+    if cfg.max_age is not None:
+      deadline = datetime.now() - cfg.max_age
+      aged = orm_max(m.index for m in Message if m.conversation == c and m.created_at <= deadline)
+      if aged is not None:
+        cutoff = max(cutoff, min(aged, latest - cfg.recent))
+
+    start = self.summarized_upto(c)
+    # yapf: disable
+    msgs = select(
+      m for m in Message
+      if m.conversation == c and m.role != 'system' and m.index > start and m.index <= cutoff
+    ).order_by(Message.index)[:cfg.span]
+    # yapf: enable
+
+    if len(msgs) == cfg.span:
+      return 0, msgs[0].index, msgs[-1].index, [f'{m.role}: {m.text}' for m in msgs], []
+
+    top = orm_max(s.tier for s in Summary if s.conversation == c)
+    for tier in range(top + 1 if top is not None else 0):
+      # yapf: disable
+      orphans = select(
+        s for s in Summary if s.conversation == c and s.tier == tier and s.parent is None
+      ).order_by(Summary.first_index)[:cfg.fanout]
+      # yapf: enable
+
+      if len(orphans) == cfg.fanout:
+        return tier + 1, orphans[0].first_index, orphans[-1].last_index, [s.text for s in orphans], [
+          s.id for s in orphans
+        ]
+
+    return None
+
+  async def compact(self) -> int:
+    """
+    Summarize every span which became old enough.
+
+    Returns:
+      int: Number of summaries created.
+    """
+    agent = self._owner()
+    created = 0
+
+    while (span := self.next_span()) is not None:
+      tier, first, last, texts, children = span
+      text = await agent.summarize(texts)
+      vec, space = await agent.get_embedding_vector(text)
+
+      with metrics.span('memory_write'), db_session:
+        c = Conversation[agent.cid]
+        summary = Summary(
+          tier=tier,
+          first_index=first,
+          last_index=last,
+          text=text,
+          embeddings=str(vec),
+          space=space,
+          created_at=datetime.now(),
+          conversation=c,
+        )
+
+        for sid in children:
+          Summary[sid].parent = summary
+
+        threshold = self.config.drop_embeddings_from_tier
+        if threshold is not None and tier >= threshold:
+          for m in select(m for m in Message if m.conversation == c and m.index >= first and m.index <= last):
+            m.embeddings = None
+
+        commit()
+
+      created += 1
+      metrics.inc('summaries_created_total', tier=tier)
+      logger.debug(f'summarized messages {first}..{last} into a tier {tier} summary.')
+
+    return created
+
+  def _prefilter(self, c: Conversation, search_vec: str, space: str) -> Prefilter | None:
+    cfg = self.config
+
+    if cfg.quantization is not None:
+      kind = cfg.quantization
+      code = quantize_query(json.loads(search_vec), kind)
+      return lambda lower, upper: quantized_candidates(c, space, code, kind, lower, upper, cfg.rerank)
+
+    if cfg.reduction and (projection := self.projection(c, space)) is not None:
+      reduced = format_vector(projection.project(json.loads(search_vec)))
+      return lambda lower, upper: reduced_candidates(c, space, projection, reduced, lower, upper, cfg.rerank)
+
+    return None
+
+  def _score(
+    self,
+    c: Conversation,
+    search_vec: str,
+    space: str,
+    lower: int,
+    upper: int,
+    ids: list[int] | None,
+    limit: int,
+  ) -> list[tuple[Message, float]]:
+    # yapf: disable
+    if ids is None:
+      return select(
+        (m, raw_sql('similarity(m.embeddings, $search_vec) as "sim"', result_type=float))
+        for m in Message
+        if m.embeddings is not None and m.space == space and m.index > lower and m.index < upper
+        and m.conversation == c
+      ).order_by(
+        lambda m, s: desc(raw_sql('"sim"'))
+      )[:limit]
+
+    return select(
+      (m, raw_sql('similarity(m.embeddings, $search_vec) as "sim"', result_type=float))
+      for m in Message
+      if m.id in ids and m.embeddings is not None and m.space == space and m.index > lower and m.index < upper
+      and m.conversation == c
+    ).order_by(
+      lambda m, s: desc(raw_sql('"sim"'))
+    )[:limit]
+    # yapf: enable
+
+  def _hybrid(
+    self,
+    c: Conversation,
+    search_vec: str,
+    space: str,
+    lower: int,
+    upper: int,
+    prefilter: Prefilter | None,
+    lexical: list[tuple[int, int]],
+  ) -> list[tuple[Message, float]]:
+    cfg = self.config
+    lexical_ids = [i for i, index in lexical if lower < index < upper]
+
+    if prefilter is not None:
+      with metrics.span('recall_prefilter'):
+        vector = prefilter(lower, upper)
+    else:
+      # yapf: disable
+      vector = [i for i, _ in select(
+        (m.id, m.index) for m in Message
+        if m.embeddings is not None and m.space == space and m.index > lower and m.index < upper
+        and m.conversation == c
+      ).order_by(-2)[:cfg.vector_window]]
+      # yapf: enable
+
+    candidates = list({*lexical_ids, *vector})
+    scored = self._score(c, search_vec, space, lower, upper, candidates, len(candidates))
+    metrics.inc('recall_candidates_total', len(candidates), mode='hybrid')
+
+    # the fused ranks pick the messages, which keep their own similarities to be compared with summaries.
+    by_id = {m.id: (m, sim) for m, sim in scored}
+    return [by_id[i] for i in fuse([lexical_ids, [m.id for m, _ in scored]]) if i in by_id][:cfg.recall]
+
+  def _raw(
+    self,
+    c: Conversation,
+    search_vec: str,
+    space: str,
+    lower: int,
+    upper: int,
+    prefilter: Prefilter | None = None,
+    lexical: list[tuple[int, int]] | None = None,
+  ) -> list[tuple[Message, float]]:
+    if lexical is not None:
+      return self._hybrid(c, search_vec, space, lower, upper, prefilter, lexical)
+
+    if prefilter is not None:
+      with metrics.span('recall_prefilter'):
+        ids = prefilter(lower, upper)
+      return self._score(c, search_vec, space, lower, upper, ids, self.config.recall)
+
+    return self._score(c, search_vec, space, lower, upper, None, self.config.recall)
+
+  def _frontier(self, c: Conversation, search_vec: str, space: str, before_index: int) -> list[tuple[Summary, float]]:
+    # yapf: disable
+    return select(
+      (s, raw_sql('similarity(s.embeddings, $search_vec) as "sim"', result_type=float))
+      for s in Summary
+      if s.embeddings is not None and s.space == space and s.parent is None and s.first_index < before_index
+      and s.conversation == c
+    ).order_by(
+      lambda s, sim: desc(raw_sql('"sim"'))
+    )[:self.config.recall]
+    # yapf: enable
+
+  def _children(self, parent: Summary, search_vec: str, space: str) -> list[tuple[Summary, float]]:
+    # yapf: disable
+    return select(
+      (s, raw_sql('similarity(s.embeddings, $search_vec) as "sim"', result_type=float))
+      for s in Summary if s.embeddings is not None and s.space == space and s.parent == parent
+    ).order_by(
+      lambda s, sim: desc(raw_sql('"sim"'))
+    )[:self.config.recall]
+    # yapf: enable
+
+  def recall(
+    self,
+    c: Conversation,
+    search_vec: str,
+    space: str,
+    before_index: int,
+    text: str | None = None,
+  ) -> list[Recollection]:
+    """
+    Recall memories related to `search_vec` from messages older than `before_index`.
+
+    Only messages and summaries embedded in `space`, the embedding space of `search_vec`, are recalled.
+
+    When `hybrid` is enabled, raw messages are ranked by fusing full-text matches of `text` with vector similarity.
+    Must be called within a db_session.
+    """
+    cfg = self.config
+    heap: list[tuple[float, int, Message | Summary]] = []
+    result: list[Recollection] = []
+    order = count()
+    prefilter = self._prefilter(c, search_vec, space)
+    # full-text matches are searched once, and are split into the ranges of raw messages and expanded summaries.
+    lexical = None
+    if cfg.hybrid and text is not None and (query := match_query(text, ensure_index())) is not None:
+      with metrics.span('recall_lexical'):
+        lexical = lexical_candidates(c, space, query, -1, before_index, cfg.lexical_candidates)
+
+    def push(items: list[tuple[Message, float]] | list[tuple[Summary, float]]) -> None:
+      for item, sim in items:
+        heappush(heap, (-sim, next(order), item))
+
+    push(self._raw(c, search_vec, space, self.summarized_upto(c), before_index, prefilter, lexical))
+    push(self._frontier(c, search_vec, space, before_index))
+
+    expansions = 0
+    while heap and len(result) < cfg.recall:
+      sim, _, item = heappop(heap)
+
+      if isinstance(item, Summary) and expansions < cfg.max_expansions:
+        expansions += 1
+        if item.tier == 0:
+          lower, upper = item.first_index - 1, min(item.last_index + 1, before_index)
+          children = self._raw(c, search_vec, space, lower, upper, prefilter, lexical)
+        else:
+          children = self._children(item, search_vec, space)
+
+        if children:
+          push(children)
+          continue
+
+      result.append(Recollection(item.text, -sim, isinstance(item, Summary)))
+
+    metrics.inc('memory_expansions_total', expansions)
+    return result
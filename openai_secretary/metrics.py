@@ -0,0 +1,180 @@
+import asyncio
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from logging import getLogger
+from time import perf_counter
+from typing import Iterator, TypeAlias
+
+logger = getLogger('oai_chatbot.metrics')
+
+LabelSet: TypeAlias = tuple[tuple[str, str], ...]
+
+latency_buckets: tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+"""
+Upper bounds (in seconds) of the latency histogram buckets.
+"""
+
+
+@dataclass
+class Timing:
+  """
+  Timing is an aggregated latency histogram of a single stage.
+  """
+  count: int = 0
+  total: float = 0.0
+  max: float = 0.0
+  buckets: list[int] = field(default_factory=lambda: [0] * (len(latency_buckets) + 1))
+
+  def observe(self, seconds: float) -> None:
+    self.count += 1
+    self.total += seconds
+    if seconds > self.max:
+      self.max = seconds
+    self.buckets[bisect_left(latency_buckets, seconds)] += 1
+
+
+def _labels(labels: dict[str, object]) -> LabelSet:
+  return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: LabelSet, extra: tuple[str, str] | None = None) -> str:
+  items = [*labels, extra] if extra is not None else labels
+  if not items:
+    return ''
+  return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in items) + '}'
+
+
+class Metrics:
+  """
+  Metrics is an in-process registry of counters and stage latencies.
+
+  Recording is a couple of dict lookups and additions, so it is cheap enough to stay enabled in production.
+  """
+  namespace: str
+  counters: dict[str, dict[LabelSet, float]]
+  timings: dict[str, dict[LabelSet, Timing]]
+
+  def __init__(self, namespace: str = 'oai_secretary') -> None:
+    self.namespace = namespace
+    self.counters = {}
+    self.timings = {}
+
+  def inc(self, name: str, value: float = 1.0, **labels: object) -> None:
+    series = self.counters.setdefault(name, {})
+    key = _labels(labels)
+    series[key] = series.get(key, 0.0) + value
+
+  def observe(self, name: str, seconds: float, **labels: object) -> None:
+    series = self.timings.setdefault(name, {})
+    key = _labels(labels)
+    if (timing := series.get(key)) is None:
+      timing = series[key] = Timing()
+    timing.observe(seconds)
+
+  @contextmanager
+  def span(self, stage: str, **labels: object) -> Iterator[None]:
+    start = perf_counter()
+    try:
+      yield
+    except BaseException:
+      self.inc('stage_errors_total', stage=stage, **labels)
+      raise
+    finally:
+      self.observe('stage_seconds', perf_counter() - start, stage=stage, **labels)
+
+  def render(self) -> str:
+    """
+    Render all metrics in the Prometheus text exposition format. Latencies are histograms only, since the maximum
+    since the process started, which `summary` logs, cannot be aggregated by a scraper.
+    """
+    lines: list[str] = []
+
+    for name, series in sorted(self.counters.items()):
+      fullname = f'{self.namespace}_{name}'
+      lines.append(f'# TYPE {fullname} counter')
+      for labels, value in series.items():
+        lines.append(f'{fullname}{_format_labels(labels)} {value}')
+
+    for name, timings in sorted(self.timings.items()):
+      fullname = f'{self.namespace}_{name}'
+      lines.append(f'# TYPE {fullname} histogram')
+      for labels, timing in timings.items():
+        cumulative = 0
+        for bound, count in zip((*latency_buckets, float('inf')), timing.buckets):
+          cumulative += count
+          le = '+Inf' if bound == float('inf') else str(bound)
+          lines.append(f'{fullname}_bucket{_format_labels(labels, ("le", le))} {cumulative}')
+        lines.append(f'{fullname}_sum{_format_labels(labels)} {timing.total}')
+        lines.append(f'{fullname}_count{_format_labels(labels)} {timing.count}')
+
+    return '\n'.join(lines) + '\n'
+
+  def summary(self) -> str:
+    """
+    Render a compact human readable summary for the periodic stats log.
+    """
+    lines: list[str] = []
+
+    for name, timings in sorted(self.timings.items()):
+      for labels, timing in sorted(timings.items()):
+        if not timing.count:
+          continue
+        lines.append(
+          f'{name}{_format_labels(labels)}: n={timing.count} '
+          f'avg={timing.total / timing.count * 1000:.1f}ms max={timing.max * 1000:.1f}ms'
+        )
+
+    for name, series in sorted(self.counters.items()):
+      for labels, value in sorted(series.items()):
+        lines.append(f'{name}{_format_labels(labels)}: {value:g}')
+
+    return '\n'.join(lines)
+
+  async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+      request = await reader.readline()
+      while (await reader.readline()).strip():
+        pass
+
+      match request.decode('latin-1').split():
+        case ['GET', path, *_] if path.split('?')[0] in ('/', '/metrics'):
+          status, body = '200 OK', self.render().encode()
+        case _:
+          status, body = '404 Not Found', b'not found\n'
+
+      writer.write(
+        f'HTTP/1.1 {status}\r\n'
+        'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+        f'Content-Length: {len(body)}\r\n'
+        'Connection: close\r\n\r\n'.encode() + body
+      )
+      await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    finally:
+      writer.close()
+
+  async def serve(self, port: int, host: str = '127.0.0.1') -> asyncio.Server:
+    """
+    Start a local HTTP endpoint which exposes the metrics for Prometheus.
+    """
+    server = await asyncio.start_server(self._handle, host, port)
+    logger.info(f'metrics endpoint is listening on http://{host}:{port}/metrics')
+    return server
+
+  async def log_periodically(self, interval: float) -> None:
+    logger.info('stats logger has been started.')
+    while True:
+      await asyncio.sleep(interval)
+      logger.info(f'stats:\n{self.summary()}')
+
+
+metrics = Metrics()
+"""
+Process wide metrics registry.
+"""
@@ -1,6 +1,7 @@
 from dataclasses import dataclass, field
 from datetime import datetime
 from random import random
+from struct import Struct
 from typing import ClassVar, TypeAlias, overload
 
 floats5: TypeAlias = tuple[float, float, float, float, float] | list[float]
@@ -102,6 +103,7 @@ class Emotion:
     compare=False,
   )
   decrease_coefficient: ClassVar[float] = 0.999
+  _record: ClassVar[Struct] = Struct('<6d')
 
   @classmethod
   def random_emotion(cls, *, weights: floats5 = (0.1, 0.1, 0.1, 0.6, 0.1)):
@@ -137,6 +139,24 @@ class Emotion:
   def json(self) -> floats5:
     return (self.anger, self.disgust, self.fear, self.joy, self.sadness)
 
+  def to_bytes(self) -> bytes:
+    """
+    Pack the values before attenuation and the origin of the decay into a 48 bytes record.
+    """
+    return self._record.pack(
+      self._anger, self._disgust, self._fear, self._joy, self._sadness, self._created.timestamp()
+    )
+
+  @classmethod
+  def from_bytes(cls, data: bytes) -> 'Emotion':
+    """
+    Restore an emotion packed by `to_bytes`. The decay continues from the packed origin.
+    """
+    *values, created = cls._record.unpack(data)
+    emotion = cls(*values)
+    emotion._created = datetime.fromtimestamp(created)
+    return emotion
+
   @property
   def attenuation(self) -> float:
     if self._frozen:
@@ -22,6 +22,14 @@ initial_messages: list[tuple[RoleType, str]] = [
 Default initial prompts.
 """
 
+summary_prompt = (
+  'これから与える会話ログを、後から思い出せるように要約してください。'
+  '登場人物、話題、出来事、約束事は省略せず、日本語で簡潔に書いてください。'
+)
+"""
+Prompt used to summarize old conversation spans into long-term memory.
+"""
+
 def create_initial_context(conv: Conversation | None, agent: IAgent):
   agent.context.append({'role': 'system', 'content': f'あなたの今回の起動時刻は{datetime.now().strftime("%Y年%m月%d日 %H時%M分%S秒")}です'})
   if conv is not None:
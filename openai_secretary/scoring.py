@@ -0,0 +1,186 @@
+import asyncio
+from dataclasses import dataclass
+import json
+from logging import getLogger
+from os import linesep as LF
+import re
+from typing import TYPE_CHECKING
+
+from openai.error import Timeout
+
+from openai_secretary.client import OpenAIClient, openai_client
+from openai_secretary.metrics import metrics
+
+if TYPE_CHECKING:
+  from openai_secretary.agent import Agent
+
+logger = getLogger('oai_chatbot.scoring')
+
+_evaluation = re.compile(r'\[\s*-?\d+(?:\.\d+)?(?:\s*,\s*-?\d+(?:\.\d+)?){4}\s*\]')
+
+
+def batch_prompt(items: list[tuple[str, str | None]]) -> str:
+  texts = []
+  for i, (text, context) in enumerate(items, 1):
+    if context is not None:
+      texts.append(f'context {i}: {context}')
+    texts.append(f'text {i}: {text}')
+  return f"""evaluate how each text moves emotions along each of the five axes with a number within 20 steps -10 to 10.
+each evaluation must be in the format: `[<anger>, <disgust>, <fear>, <joy>, <sadness>]`.
+answer a JSON array of {len(items)} evaluations, one for each text in order.
+extreme evaluations are not preferable.
+
+{LF.join(texts)}
+evaluations:"""
+
+
+def parse_evaluations(text: str, count: int) -> list[list[float]] | None:
+  """
+  Extract `count` evaluations from a completion. Evaluations are taken in order wherever they appear, so that
+  surrounding prose or a missing outer array does not matter.
+
+  Returns:
+    list[list[float]] | None: The evaluations clamped to -10 to 10, or None if the number of evaluations differs.
+  """
+  found = _evaluation.findall(text)
+  if len(found) != count:
+    return None
+  return [[max(-10.0, min(10.0, float(v))) for v in json.loads(e)] for e in found]
+
+
+def split_tokens(tokens: int, weights: list[int]) -> list[int]:
+  """
+  Split a token count in proportion to weights, rounding by the largest remainders so that the parts add up to
+  `tokens`. Parts are even if every weight is 0.
+  """
+  total = sum(weights)
+  if total <= 0:
+    weights, total = [1] * len(weights), len(weights)
+  exact = [tokens * w / total for w in weights]
+  parts = [int(e) for e in exact]
+  by_remainder = sorted(range(len(weights)), key=lambda i: parts[i] - exact[i])
+  for i in by_remainder[:tokens - sum(parts)]:
+    parts[i] += 1
+  return parts
+
+
+@dataclass
+class _Pending:
+  agent: 'Agent'
+  text: str
+  context: str | None
+  future: asyncio.Future[list[float]]
+
+
+class EmotionBatcher:
+  """
+  EmotionBatcher scores emotions of messages from every agent in shared completion requests.
+
+  Messages submitted within `window` seconds of the first pending one are scored with a single prompt, which saves a
+  `best_of` completion per message when channels are busy. When the completion cannot be parsed into one evaluation
+  per message, the messages are scored one by one instead.
+  """
+  window: float
+  """Seconds to wait for more messages. 0 disables batching."""
+  max_batch: int
+  """Number of messages which triggers a request without waiting for the window."""
+  client: OpenAIClient
+  pending: list[_Pending]
+  _timer: asyncio.TimerHandle | None = None
+
+  def __init__(self, window: float = 0.05, max_batch: int = 16, client: OpenAIClient | None = None) -> None:
+    self.window = window
+    self.max_batch = max_batch
+    self.client = client or openai_client
+    self.pending = []
+
+  def configure(self, window: float | None = None, max_batch: int | None = None) -> None:
+    if window is not None:
+      self.window = window
+    if max_batch is not None:
+      self.max_batch = max_batch
+
+  def submit(self, agent: 'Agent', text: str, context: str | None = None) -> asyncio.Future[list[float]]:
+    """
+    Queue a message and return a future of its emotion delta, already scaled by the agent's `emotion_delta`.
+
+    Futures of a single agent may complete in any order, so callers must apply them in submission order.
+    """
+    loop = asyncio.get_running_loop()
+    if self.window <= 0:
+      return loop.create_task(agent.get_emotional_vector(text, context))
+
+    future: asyncio.Future[list[float]] = loop.create_future()
+    self.pending.append(_Pending(agent, text, context, future))
+    if len(self.pending) >= self.max_batch:
+      self._flush()
+    elif self._timer is None:
+      self._timer = loop.call_later(self.window, self._flush)
+    return future
+
+  def _flush(self) -> None:
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+    batch, self.pending = self.pending, []
+    if batch:
+      asyncio.get_running_loop().create_task(self._score(batch))
+
+  async def _score(self, batch: list[_Pending]) -> None:
+    try:
+      if len(batch) == 1:
+        deltas = [await batch[0].agent.get_emotional_vector(batch[0].text, batch[0].context)]
+      else:
+        deltas = await self._score_batch(batch)
+    except Exception as e:
+      for item in batch:
+        if not item.future.done():
+          item.future.set_exception(e)
+      return
+
+    for item, delta in zip(batch, deltas):
+      if not item.future.done():
+        item.future.set_result(delta)
+
+  async def _score_batch(self, batch: list[_Pending]) -> list[list[float]]:
+    metrics.inc('emotion_batches_total')
+    metrics.inc('emotion_batched_messages_total', len(batch))
+    try:
+      with metrics.span('emotion_batch'):
+        resp = await self.client.completion(
+          model="text-davinci-003",
+          prompt=batch_prompt([(item.text, item.context) for item in batch]),
+          temperature=0.2,
+          max_tokens=24 * len(batch) + 16,
+          top_p=1,
+          best_of=3,
+          frequency_penalty=0,
+          presence_penalty=0,
+          request_timeout=10.0,
+          timeout=5.0,
+        )
+    except Exception as e:
+      metrics.inc('openai_timeouts_total' if isinstance(e, Timeout) else 'emotion_fallbacks_total', endpoint='emotion')
+      return [[0.0, 0.0, 0.0, 0.0, 0.0] for _ in batch]
+
+    usage = resp.get('usage') or {}
+    # the prompt is shared in proportion to the texts, and the completion evenly as each text gets one evaluation.
+    prompt_weights = [len(item.text) + len(item.context or '') for item in batch]
+    for kind, weights in (('prompt', prompt_weights), ('completion', [1] * len(batch))):
+      for item, tokens in zip(batch, split_tokens(usage.get(f'{kind}_tokens', 0), weights)):
+        metrics.inc('openai_tokens_total', tokens, conversation=item.agent.cid, endpoint='emotion', kind=kind)
+
+    if (evaluations := parse_evaluations(resp['choices'][0]['text'], len(batch))) is None:
+      logger.debug(f'unparsable batch evaluation, scoring {len(batch)} messages one by one.')
+      metrics.inc('emotion_batch_fallbacks_total')
+      return list(
+        await asyncio.gather(*(item.agent.get_emotional_vector(item.text, item.context) for item in batch))
+      )
+
+    return [[v / 10 * item.agent.emotion_delta for v in vec] for item, vec in zip(batch, evaluations)]
+
+
+emotion_batcher = EmotionBatcher()
+"""
+Process wide emotion batcher.
+"""
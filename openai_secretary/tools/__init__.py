@@ -0,0 +1,14 @@
+commands: dict[str, str] = {
+  'quantize': 'openai_secretary.tools.quantize',
+  'backfill': 'openai_secretary.tools.backfill',
+  'reduce': 'openai_secretary.tools.reduce',
+  'fts': 'openai_secretary.tools.fts',
+  'standin': 'openai_secretary.tools.standin',
+  'httpbench': 'openai_secretary.tools.httpbench',
+  'shard': 'openai_secretary.tools.shard',
+  'loadtest': 'openai_secretary.tools.loadtest',
+  'retention': 'openai_secretary.tools.retention',
+}
+"""
+Maintenance commands runnable with `python -m openai_secretary.tools <command>`, and their modules.
+"""
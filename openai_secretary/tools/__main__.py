@@ -0,0 +1,9 @@
+import sys
+from importlib import import_module
+from openai_secretary.tools import commands
+
+if len(sys.argv) < 2 or sys.argv[1] not in commands:
+  print(f'usage: python -m openai_secretary.tools ({" | ".join(commands)}) [args...]', file=sys.stderr)
+  sys.exit(2)
+
+import_module(commands[sys.argv[1]]).main(sys.argv[2:])
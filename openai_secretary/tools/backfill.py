@@ -0,0 +1,440 @@
+from argparse import ArgumentParser
+import asyncio
+from datetime import datetime
+import json
+from logging import getLogger
+from os import remove
+from os.path import exists as exists_file, expanduser
+import sys
+from time import perf_counter
+from typing import Any, Iterator, TextIO
+
+import numpy as np
+import openai as oai
+from openai.error import APIConnectionError, APIError, RateLimitError, ServiceUnavailableError, Timeout
+from pony.orm import commit, db_session, exists, max as orm_max, select
+
+from openai_secretary import read_api_key
+from openai_secretary.agent import Agent
+from openai_secretary.client import openai_client
+from openai_secretary.embedding import EmbeddingBackend, Embeddings, create_backend, fit_idf
+from openai_secretary.database.models import Conversation, Message, QuantizedEmbedding
+from openai_secretary.database.sharding import ShardLayout, enable_sharding, shard
+from openai_secretary.memory.quantize import store_quantized
+from openai_secretary.memory.reduction import Projection, active_reducer, store_reduced
+from openai_secretary.memory.retention import conversation_ids, databases
+from openai_secretary.metrics import metrics
+
+logger = getLogger('oai_chatbot.backfill')
+
+checkpoint_path = expanduser('~/.oai_secretary/backfill.checkpoint')
+"""
+Default path of the embedding checkpoint, which records the id all messages up to which are processed, for each
+combination of the filters of a run.
+"""
+
+retryable_errors = (APIConnectionError, APIError, RateLimitError, ServiceUnavailableError, Timeout)
+
+
+class Progress:
+  label: str
+  rows: int
+  interval: float
+
+  def __init__(self, label: str, interval: float = 2.0) -> None:
+    self.label = label
+    self.rows = 0
+    self.interval = interval
+    self.started = self.reported = perf_counter()
+
+  def add(self, rows: int) -> None:
+    self.rows += rows
+    if (now := perf_counter()) - self.reported >= self.interval:
+      self.reported = now
+      self.report()
+
+  def report(self) -> None:
+    elapsed = perf_counter() - self.started
+    print(f'{self.label}: {self.rows} rows in {elapsed:.1f}s ({self.rows / max(elapsed, 1e-9):.1f} rows/s)', flush=True)
+
+
+def _write_records(
+  records: list[tuple[int, dict[str, Any]]],
+  default_conversation: int | None,
+  indices: dict[int, int],
+) -> None:
+  # records are written per conversation, since a transaction is bound to the shard of its conversation.
+  by_conversation: dict[int, list[tuple[str, str, str | None]]] = {}
+  for lineno, record in records:
+    cid = record.get('conversation', default_conversation)
+    text = record.get('text', record.get('content'))
+    role = record.get('role', 'user')
+
+    if cid is None:
+      raise ValueError(f'line {lineno}: conversation is not given.')
+    if role not in ('system', 'user', 'assistant') or not isinstance(text, str):
+      raise ValueError(f'line {lineno}: invalid record {record!r}.')
+    by_conversation.setdefault(cid, []).append((role, text, record.get('created_at')))
+
+  for cid, rows in by_conversation.items():
+    with shard(cid), db_session:
+      if (c := Conversation.get(id=cid)) is None:
+        c = Agent.init_conversation(cid)
+        commit()
+
+      if cid not in indices:
+        last = orm_max(m.index for m in Message if m.conversation == c)
+        indices[cid] = 0 if last is None else last + 1
+
+      for role, text, created_at in rows:
+        Message(
+          index=indices[cid],
+          role=role,
+          text=text,
+          created_at=datetime.fromisoformat(created_at) if created_at else datetime.now(),
+          embeddings=None,
+          conversation=c,
+        )
+        indices[cid] += 1
+
+      commit()
+
+
+def import_log(f: TextIO, conversation_id: int | None, batch: int) -> int:
+  """
+  Stream a JSONL chat log into messages, `batch` rows per transaction.
+
+  Each line is an object with `text` (or `content`), and optionally `role`, `conversation` and `created_at`.
+  """
+  progress = Progress('imported')
+  indices: dict[int, int] = {}
+  records: list[tuple[int, dict[str, Any]]] = []
+
+  for lineno, line in enumerate(f, 1):
+    if not line.strip():
+      continue
+    records.append((lineno, json.loads(line)))
+
+    if len(records) >= batch:
+      _write_records(records, conversation_id, indices)
+      progress.add(len(records))
+      records.clear()
+
+  if records:
+    _write_records(records, conversation_id, indices)
+    progress.add(len(records))
+
+  progress.report()
+  return progress.rows
+
+
+async def _embed(backend: EmbeddingBackend, texts: list[str], retries: int) -> Embeddings:
+  for attempt in range(retries + 1):
+    try:
+      with metrics.span('embedding', mode='bulk', backend=backend.name):
+        return await backend.embed(texts)
+    except retryable_errors as e:
+      if attempt == retries:
+        raise
+      metrics.inc('openai_retries_total', endpoint='embedding')
+      logger.warning(f'embedding request failed ({type(e).__name__}: {e}), retrying...')
+      await asyncio.sleep(2**attempt)
+
+  raise AssertionError('unreachable')
+
+
+def checkpoint_key(
+  conversation_id: int | None,
+  backend: EmbeddingBackend,
+  include_system: bool,
+  reembed: bool = False,
+) -> str:
+  """
+  Key of the checkpoint of a run, since a run with other filters selects other messages.
+  """
+  conversation = 'all' if conversation_id is None else str(conversation_id)
+  space = backend.known_space or backend.name
+  key = f'{conversation}:{space}:{"system" if include_system else "chat"}'
+  return f'{key}:reembed' if reembed else key
+
+
+def _read_checkpoints(path: str) -> dict[str, int]:
+  try:
+    with open(path) as f:
+      checkpoints = json.load(f)
+  except FileNotFoundError:
+    return {}
+  # checkpoints written before they were keyed do not tell which filters they were written with.
+  return {k: v for k, v in checkpoints.items() if k != 'last_id'}
+
+
+def _load_checkpoint(path: str, key: str) -> int:
+  return _read_checkpoints(path).get(key, 0)
+
+
+def _save_checkpoint(path: str, key: str, last_id: int | None) -> None:
+  checkpoints = _read_checkpoints(path)
+  if last_id is None:
+    checkpoints.pop(key, None)
+  else:
+    checkpoints[key] = last_id
+
+  if not checkpoints:
+    if exists_file(path):
+      remove(path)
+    return
+  with open(path, 'w') as f:
+    json.dump(checkpoints, f)
+
+
+def _flush(results: list[tuple[int, list[float], str]], quantize: bool) -> None:
+  """
+  Write embeddings back, and rebuild the search codes of the messages, so that prefilters keep selecting among them
+  instead of scoring every message without codes exactly.
+
+  Quantized codes are stored when `quantize` is set or the conversation already has them, and reduced codes when
+  the conversation has a reducer fitted in the embedding space.
+  """
+  projections: dict[tuple[int, str], Projection | None] = {}
+  quantized: dict[int, bool] = {}
+
+  with db_session:
+    for mid, vec, space in results:
+      m = Message[mid]
+      c = m.conversation
+      if m.space != space and m.reduced is not None:
+        # reduced codes are projected from embeddings of another space.
+        m.reduced.delete()
+      m.set(embeddings=str(vec), space=space)
+
+      if c.id not in quantized:
+        quantized[c.id] = quantize or exists(q for q in QuantizedEmbedding if q.message.conversation == c)
+      if quantized[c.id]:
+        store_quantized(m, vec)
+
+      if (c.id, space) not in projections:
+        reducer = active_reducer(c, space)
+        projections[c.id, space] = Projection.load(reducer) if reducer is not None else None
+      if (projection := projections[c.id, space]) is not None:
+        store_reduced(m, projection, vec)
+    commit()
+
+
+async def embed_missing(
+  conversation_id: int | None,
+  backend: EmbeddingBackend,
+  *,
+  include_system: bool,
+  batch: int,
+  concurrency: int,
+  flush_rows: int,
+  retries: int,
+  checkpoint: str,
+  quantize: bool = False,
+  reembed: bool = False,
+) -> int:
+  """
+  Embed every message without embeddings, in id order. With `reembed`, messages embedded in another space than the
+  backend's are embedded again as well, replacing their embeddings, which needs a backend whose space is known in
+  advance.
+
+  Up to `concurrency` requests of `batch` texts are in flight at once. Results are written back every `flush_rows`
+  rows together with their search codes, and the checkpoint records the id up to which every message has been
+  written, so that an interrupted run with the same filters resumes from there. The checkpoint of the run is removed
+  when it completes. If a request fails for good, the other requests are cancelled and the results written so far
+  are kept in the checkpoint.
+  """
+  if reembed and backend.known_space is None:
+    raise ValueError(f'the space of the {backend.name} backend is not known in advance, so it cannot re-embed.')
+
+  progress = Progress('embedded')
+  key = checkpoint_key(conversation_id, backend, include_system, reembed)
+  cursor = _load_checkpoint(checkpoint, key)
+  if cursor:
+    print(f'resuming after message {cursor}.')
+
+  queue: asyncio.Queue[tuple[int, list[int], list[str]] | None] = asyncio.Queue(maxsize=concurrency * 2)
+  done: dict[int, tuple[int, list[tuple[int, list[float], str]]]] = {}
+  pending: list[tuple[int, list[float], str]] = []
+  target = backend.known_space if reembed else None
+  watermark = cursor
+  next_seq = 0
+
+  def flush() -> None:
+    nonlocal watermark, next_seq
+    while next_seq in done:
+      last_id, results = done.pop(next_seq)
+      pending.extend(results)
+      watermark = last_id
+      next_seq += 1
+
+    if pending:
+      _flush(pending, quantize)
+      progress.add(len(pending))
+      pending.clear()
+    _save_checkpoint(checkpoint, key, watermark)
+
+  async def produce() -> None:
+    seq = 0
+    last = cursor
+    while True:
+      with db_session:
+        # yapf: disable
+        rows = select(
+          (m.id, m.text) for m in Message
+          if m.id > last and (m.embeddings is None or target is not None and m.space != target)
+          and (include_system or m.role != 'system')
+          and (conversation_id is None or m.conversation.id == conversation_id)
+        ).order_by(1)[:batch]
+        # yapf: enable
+
+      if not rows:
+        break
+
+      last = rows[-1][0]
+      await queue.put((seq, [i for i, _ in rows], [t for _, t in rows]))
+      seq += 1
+
+    for _ in range(concurrency):
+      await queue.put(None)
+
+  async def consume() -> None:
+    while (item := await queue.get()) is not None:
+      seq, ids, texts = item
+      vectors, space, _ = await _embed(backend, texts, retries)
+      done[seq] = (ids[-1], [(i, v, space) for i, v in zip(ids, vectors)])
+
+      if sum(len(r) for _, r in done.values()) >= flush_rows:
+        flush()
+
+  tasks = [asyncio.create_task(produce()), *(asyncio.create_task(consume()) for _ in range(concurrency))]
+  try:
+    await asyncio.gather(*tasks)
+  finally:
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    flush()
+    progress.report()
+
+  _save_checkpoint(checkpoint, key, None)
+  return progress.rows
+
+
+async def embed_conversations(
+  conversation_id: int | None,
+  layout: ShardLayout | None,
+  backend: EmbeddingBackend,
+  **options: Any,
+) -> int:
+  """
+  Run `embed_missing` over the global database, or over every conversation of the shard files with a layout, one
+  conversation at a time within its shard.
+  """
+  try:
+    if layout is None:
+      return await embed_missing(conversation_id, backend, **options)
+    embedded = 0
+    cids = [conversation_id] if conversation_id is not None else conversation_ids(databases(layout)[1:])
+    for cid in cids:
+      with shard(cid):
+        embedded += await embed_missing(cid, backend, **options)
+    return embedded
+  finally:
+    await openai_client.close()
+
+
+def stored_texts(conversation_id: int | None, layout: ShardLayout | None) -> Iterator[str]:
+  """
+  Texts of the stored messages, of every conversation of the shard files with a layout.
+  """
+  cids = [conversation_id] if layout is None or conversation_id is not None else conversation_ids(databases(layout)[1:])
+  for cid in cids:
+    with shard(cid), db_session:
+      yield from select(m.text for m in Message if cid is None or m.conversation.id == cid)
+
+
+def main(argv: list[str]) -> None:
+  parser = ArgumentParser(
+    prog='python -m openai_secretary.tools backfill',
+    description='import chat logs in bulk and embed messages which have no embeddings.',
+  )
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  import_parser = commands.add_parser('import', help='import a JSONL chat log.')
+  import_parser.add_argument('file', help='JSONL file to import. "-" reads the standard input.')
+  import_parser.add_argument('--conversation', type=int, default=None, help='conversation of lines without one.')
+  import_parser.add_argument('--batch', type=int, default=5000, help='rows written per transaction.')
+  import_parser.add_argument('--embed', action='store_true', help='embed the imported messages afterwards.')
+
+  embed_parser = commands.add_parser('embed', help='embed messages which have no embeddings.')
+  embed_parser.add_argument('--conversation', type=int, default=None, help='restrict to a conversation.')
+
+  for sub in (import_parser, embed_parser):
+    sub.add_argument('--include-system', action='store_true', help='embed system messages too.')
+    sub.add_argument('--embed-batch', type=int, default=100, help='texts per embedding request.')
+    sub.add_argument('--concurrency', type=int, default=4, help='embedding requests in flight.')
+    sub.add_argument('--flush', type=int, default=2000, help='embeddings written back per transaction.')
+    sub.add_argument('--retries', type=int, default=3, help='retries of a failed embedding request.')
+    sub.add_argument('--checkpoint', default=checkpoint_path, help='checkpoint file to resume from.')
+    sub.add_argument(
+      '--quantize', action='store_true', help='store quantized codes even in conversations which have none yet.'
+    )
+    sub.add_argument('--backend', choices=['openai', 'hashed'], default='openai', help='embedding backend.')
+    sub.add_argument('--dims', type=int, default=None, help='dimension of the hashed backend.')
+    sub.add_argument('--idf', default=None, help='IDF table of the hashed backend.')
+    sub.add_argument(
+      '--reembed',
+      action='store_true',
+      help='also replace embeddings of other spaces than the hashed backend\'s, clearing their reduced codes.',
+    )
+
+  idf_parser = commands.add_parser('fit-idf', help='fit an IDF table of the hashed backend on stored messages.')
+  idf_parser.add_argument('out', help='.npy file to write.')
+  idf_parser.add_argument('--conversation', type=int, default=None, help='restrict to a conversation.')
+
+  for sub in (import_parser, embed_parser, idf_parser):
+    sub.add_argument('--shards', default=None, help='directory of conversation databases.')
+    sub.add_argument('--buckets', type=int, default=None, help='number of conversation database files.')
+
+  args = parser.parse_args(argv)
+
+  layout = None
+  if args.shards is not None:
+    layout = enable_sharding(ShardLayout(args.shards, args.buckets))
+
+  if args.command == 'fit-idf':
+    np.save(args.out, fit_idf(stored_texts(args.conversation, layout)))
+    return
+
+  if args.reembed and args.backend == 'openai':
+    parser.error('--reembed needs the hashed backend, whose embedding space is known in advance.')
+
+  if args.command == 'import':
+    if args.file == '-':
+      import_log(sys.stdin, args.conversation, args.batch)
+    else:
+      with open(args.file, encoding='utf-8') as f:
+        import_log(f, args.conversation, args.batch)
+
+    if not args.embed:
+      return
+
+  backend = create_backend(args.backend, dims=args.dims, idf_path=args.idf)
+  if args.backend == 'openai':
+    oai.api_key = read_api_key()
+  asyncio.run(
+    embed_conversations(
+      args.conversation,
+      layout,
+      backend,
+      include_system=args.include_system,
+      batch=args.embed_batch,
+      concurrency=args.concurrency,
+      flush_rows=args.flush,
+      retries=args.retries,
+      checkpoint=args.checkpoint,
+      quantize=args.quantize,
+      reembed=args.reembed,
+    )
+  )
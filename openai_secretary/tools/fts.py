@@ -0,0 +1,59 @@
+from argparse import ArgumentParser
+from time import perf_counter
+
+from pony.orm import db_session
+
+from openai_secretary.database.models import Conversation, Message
+from openai_secretary.memory.lexical import ensure_index, lexical_candidates, match_query, rebuild_index
+
+
+@db_session
+def search(conversation_id: int, text: str, limit: int) -> None:
+  """
+  Print full-text matches of `text` in a conversation, to check what hybrid recall would pick up lexically.
+  """
+  tokenizer = ensure_index()
+  query = match_query(text, tokenizer)
+  if query is None:
+    print('no searchable terms.')
+    return
+
+  c = Conversation[conversation_id]
+  if (space := c.latest_space()) is None:
+    print(f'conversation {conversation_id} has no embedded messages.')
+    return
+
+  start = perf_counter()
+  rows = lexical_candidates(c, space, query, -1, 2**62, limit)
+  elapsed = perf_counter() - start
+
+  short = f', substrings {", ".join(query.short)}' if query.short else ''
+  print(f'query ({tokenizer}): {query.match}{short} ({len(rows)} hits in {elapsed * 1000:.2f}ms)')
+  for i, _ in rows:
+    print(f'{i:>8} {Message[i].text[:80]}')
+
+
+def main(argv: list[str]) -> None:
+  parser = ArgumentParser(
+    prog='python -m openai_secretary.tools fts',
+    description='maintain the full-text index of messages used by hybrid recall.',
+  )
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  rebuild_parser = commands.add_parser('rebuild', help='drop and recreate the index from every message.')
+  rebuild_parser.add_argument('--tokenizer', choices=['trigram', 'unicode61'], default='trigram')
+
+  search_parser = commands.add_parser('search', help='print full-text matches of a text.')
+  search_parser.add_argument('text')
+  search_parser.add_argument('--conversation', type=int, required=True, help='conversation to search.')
+  search_parser.add_argument('--limit', type=int, default=20, help='number of matches printed.')
+
+  args = parser.parse_args(argv)
+
+  match args.command:
+    case 'rebuild':
+      start = perf_counter()
+      rebuild_index(args.tokenizer)
+      print(f'the index is rebuilt in {perf_counter() - start:.2f}s.')
+    case 'search':
+      search(args.conversation, args.text, args.limit)
@@ -0,0 +1,76 @@
+from argparse import ArgumentParser
+import asyncio
+from statistics import mean, quantiles
+from time import perf_counter
+from typing import Any, Awaitable, Callable
+
+import openai as oai
+
+from openai_secretary.client import ClientConfig, OpenAIClient
+from openai_secretary.tools.standin import StandIn
+
+Request = Callable[..., Awaitable[Any]]
+
+
+async def measure(request: Request, requests: int, concurrency: int) -> tuple[list[float], float]:
+  """
+  Send `requests` embedding requests, `concurrency` at once.
+
+  Returns:
+    tuple[list[float], float]: Latency of each request and the wall time, in seconds.
+  """
+  latencies: list[float] = []
+  remaining = iter(range(requests))
+
+  async def worker() -> None:
+    for i in remaining:
+      start = perf_counter()
+      await request(model='text-search-ada-doc-001', input=f'benchmark {i}')
+      latencies.append(perf_counter() - start)
+
+  start = perf_counter()
+  await asyncio.gather(*(worker() for _ in range(concurrency)))
+  return latencies, perf_counter() - start
+
+
+async def bench(url: str | None, requests: int, concurrencies: list[int], latency: float) -> None:
+  standin = None
+  if url is None:
+    standin = StandIn(latency=latency, dims=256)
+    url = await standin.start()
+  oai.api_base = url
+  oai.api_key = oai.api_key or 'standin'
+
+  pooled = OpenAIClient(ClientConfig(limit_per_host=max(concurrencies)))
+  modes: dict[str, Request] = {'per-call': oai.Embedding.acreate, 'pooled': pooled.embedding}
+
+  print(f'endpoint: {url}, requests: {requests}')
+  print(f'{"mode":>9} {"conc":>5} {"mean ms":>9} {"p50 ms":>8} {"p95 ms":>8} {"req/s":>8}')
+  try:
+    for concurrency in concurrencies:
+      for mode, request in modes.items():
+        await measure(request, min(concurrency * 2, requests), concurrency)  # warm up
+        latencies, elapsed = await measure(request, requests, concurrency)
+        cuts = quantiles(latencies, n=20)
+        print(
+          f'{mode:>9} {concurrency:>5} {mean(latencies) * 1000:>9.2f} {cuts[9] * 1000:>8.2f} {cuts[18] * 1000:>8.2f} '
+          f'{requests / elapsed:>8.1f}'
+        )
+  finally:
+    await pooled.close()
+    if standin is not None:
+      await standin.stop()
+
+
+def main(argv: list[str]) -> None:
+  parser = ArgumentParser(
+    prog='python -m openai_secretary.tools httpbench',
+    description='compare OpenAI request latency with and without the pooled session.',
+  )
+  parser.add_argument('--url', default=None, help='API base URL. A local stand-in server is started by default.')
+  parser.add_argument('--requests', type=int, default=200, help='requests sent per run.')
+  parser.add_argument('--concurrency', default='1,8', help='comma separated numbers of requests in flight.')
+  parser.add_argument('--latency', type=float, default=0.0, help='response delay of the stand-in server in seconds.')
+  args = parser.parse_args(argv)
+
+  asyncio.run(bench(args.url, args.requests, [int(c) for c in args.concurrency.split(',')], args.latency))
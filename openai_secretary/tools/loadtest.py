@@ -0,0 +1,455 @@
+from abc import ABC, abstractmethod
+from argparse import ArgumentParser, Namespace
+import asyncio
+from dataclasses import dataclass
+import json
+import os
+from os import makedirs
+from os.path import abspath, join
+import random
+import resource
+from statistics import mean, quantiles
+import subprocess
+import sys
+from tempfile import mkdtemp
+from time import perf_counter
+from typing import Any
+
+import openai as oai
+
+from openai_secretary.agent import Agent
+from openai_secretary.client import openai_client
+from openai_secretary.database.connection import db_path
+from openai_secretary.database.sharding import ShardLayout
+from openai_secretary.discord.bot import OpenAIChatBot
+from openai_secretary.discord.fake import FakeChannel, FakeMessage, FakeUser, impersonate
+from openai_secretary.discord.workers import WorkerPool, WorkerProcess
+from openai_secretary.embedding import EmbeddingBackend, HashedNgramEmbedding
+from openai_secretary.memory import MemoryConfig
+from openai_secretary.memory.arguments import add_memory_arguments, memory_argv, memory_config
+from openai_secretary.metrics import metrics
+from openai_secretary.tools.standin import StandIn
+
+_topics = ('ラーメン', '天気', '映画', '週末の予定', '仕事', 'ゲーム', '音楽', '旅行', '猫', 'プログラミング')
+_phrases = ('について話そう', 'が気になる', 'ってどう思う?', 'の話を聞いて', 'が好きなんだよね', 'で困ってる')
+
+
+@dataclass(frozen=True)
+class Event:
+  """
+  A message posted to a channel `at` seconds after the start of the traffic.
+  """
+  at: float
+  channel: int
+  author: int
+  name: str
+  content: str
+  mention: bool = False
+
+
+def replay(path: str) -> list[Event]:
+  """
+  Load recorded traffic. Each line is a JSON object with `at`, `channel`, `author` and `content`, and optionally
+  `name` and `mention`.
+  """
+  events = []
+  with open(path, encoding='utf-8') as f:
+    for line in f:
+      if not line.strip():
+        continue
+      e = json.loads(line)
+      events.append(
+        Event(
+          float(e['at']),
+          int(e['channel']),
+          int(e['author']),
+          e.get('name', f'user{e["author"]}'),
+          e['content'],
+          bool(e.get('mention', False)),
+        )
+      )
+  return sorted(events, key=lambda e: e.at)
+
+
+def synthetic(
+  channels: int,
+  rate: float,
+  duration: float,
+  mention_ratio: float,
+  users: int,
+  seed: int = 0,
+) -> list[Event]:
+  """
+  Generate Poisson traffic of `rate` messages per second in total, spread uniformly over channels.
+  """
+  rng = random.Random(seed)
+  events = []
+  at = rng.expovariate(rate)
+  while at < duration:
+    author = rng.randrange(users) + 1
+    content = rng.choice(_topics) + rng.choice(_phrases)
+    channel = 9_000_000_000 + rng.randrange(channels)
+    events.append(Event(at, channel, author, f'user{author}', content, rng.random() < mention_ratio))
+    at += rng.expovariate(rate)
+  return events
+
+
+def rss(pid: int | str = 'self') -> int:
+  """
+  Resident set size of a process in bytes.
+  """
+  try:
+    with open(f'/proc/{pid}/statm') as f:
+      return int(f.read().split()[1]) * resource.getpagesize()
+  except OSError:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if pid == 'self' else 0
+
+
+class LoadTest(ABC):
+  """
+  LoadTest posts traffic to a bot without connecting to Discord, and measures how the bot keeps up with it.
+  """
+  user: FakeUser
+  response_ratio: float
+  channels: dict[int, FakeChannel]
+  created: dict[int, float]
+  latest: dict[int, int]
+  in_flight: dict[int, int]
+  reply_latencies: list[float]
+  handle_latencies: list[float]
+  samples: list[int]
+  peak_per_channel: dict[int, int]
+  errors: int
+  idle: asyncio.Event
+
+  def __init__(self, response_ratio: float) -> None:
+    self.user = FakeUser(0, 'secretary')
+    self.response_ratio = response_ratio
+    self.channels = {}
+    self.created = {}
+    self.latest = {}
+    self.in_flight = {}
+    self.reply_latencies = []
+    self.handle_latencies = []
+    self.samples = []
+    self.peak_per_channel = {}
+    self.errors = 0
+    # nothing is in flight until the first message is posted.
+    self.idle = asyncio.Event()
+    self.idle.set()
+
+  def open_channel(self, cid: int) -> FakeChannel:
+    self.channels[cid] = FakeChannel(cid, self)
+    self.in_flight[cid] = 0
+    return self.channels[cid]
+
+  async def typing(self, channel: FakeChannel, active: bool) -> None:
+    pass
+
+  async def send(self, channel: FakeChannel, reply_to: FakeMessage | None, content: str) -> None:
+    self.replied(channel.id, reply_to.id if reply_to is not None else None)
+
+  def replied(self, cid: int, message_id: int | None) -> None:
+    # the bot only sends to a channel without replying in response to the channel's latest message.
+    self.reply_latencies.append(perf_counter() - self.created[message_id or self.latest[cid]])
+
+  def started(self, message: FakeMessage) -> None:
+    cid = message.channel.id
+    self.created[message.id] = perf_counter()
+    self.latest[cid] = message.id
+    self.in_flight[cid] += 1
+    self.peak_per_channel[cid] = max(self.peak_per_channel.get(cid, 0), self.in_flight[cid])
+    self.idle.clear()
+
+  def finished(self, cid: int, message_id: int) -> None:
+    self.in_flight[cid] -= 1
+    self.handle_latencies.append(perf_counter() - self.created[message_id])
+    if not any(self.in_flight.values()):
+      self.idle.set()
+
+  @abstractmethod
+  def post(self, message: FakeMessage) -> None:
+    """
+    Hand a message to the bot without waiting for it to be handled.
+    """
+
+  def rss(self) -> int:
+    return rss()
+
+  async def sample(self, interval: float) -> None:
+    while True:
+      self.samples.append(sum(self.in_flight.values()))
+      await asyncio.sleep(interval)
+
+  async def run(self, events: list[Event], speed: float) -> float:
+    """
+    Post every event at its time and wait until all of them are handled.
+
+    Returns:
+      float: Wall time in seconds.
+    """
+    users: dict[int, FakeUser] = {}
+    sampler = asyncio.get_running_loop().create_task(self.sample(0.05))
+    start = perf_counter()
+    for i, e in enumerate(events, 1):
+      if (delay := e.at / speed - (perf_counter() - start)) > 0:
+        await asyncio.sleep(delay)
+      channel = self.channels.get(e.channel) or self.open_channel(e.channel)
+      author = users.setdefault(e.author, FakeUser(e.author, e.name))
+      message = FakeMessage(i, channel, author, e.content, mentions=[self.user] if e.mention else [])
+      self.started(message)
+      self.post(message)
+
+    await self.idle.wait()
+    elapsed = perf_counter() - start
+    sampler.cancel()
+    return elapsed
+
+  async def close(self) -> None:
+    pass
+
+
+class InProcessLoadTest(LoadTest):
+  """
+  InProcessLoadTest calls `OpenAIChatBot.on_message` in this process, in a task per message as Discord dispatches
+  them. The process must run with a temporary home directory, so that neither conversations nor the stand-in API key
+  are written to the real databases.
+  """
+  bot: OpenAIChatBot
+
+  def __init__(
+    self,
+    response_ratio: float,
+    *,
+    shards: str,
+    embedding: EmbeddingBackend | None,
+    memory: MemoryConfig | None = None,
+  ) -> None:
+    super().__init__(response_ratio)
+    self.bot = OpenAIChatBot('loadtest', embedding=embedding, shards=ShardLayout(shards), memory=memory)
+    impersonate(self.bot.client, self.user)
+
+  def open_channel(self, cid: int) -> FakeChannel:
+    # settings and agents are prepared here instead of by the bot, so that no settings are saved for fake channels.
+    self.bot.settings[cid] = {'cmd_prefix': '!', 'response_ratio': self.response_ratio, '_debug': False}
+    self.bot.emotion_delta[cid] = {}
+    self.bot.agents[cid] = Agent(
+      'standin', conversation_id=cid, embedding=self.bot.embedding, memory=self.bot.memory
+    )
+    return super().open_channel(cid)
+
+  async def handle(self, message: FakeMessage) -> None:
+    try:
+      await self.bot.on_message(message)
+    except Exception:
+      self.errors += 1
+    finally:
+      self.finished(message.channel.id, message.id)
+
+  def post(self, message: FakeMessage) -> None:
+    asyncio.get_running_loop().create_task(self.handle(message))
+
+  async def close(self) -> None:
+    await self.bot.outbox.close()
+    for agent in self.bot.agents.values():
+      agent.close()
+
+
+class WorkerLoadTest(LoadTest):
+  """
+  WorkerLoadTest dispatches messages to a `WorkerPool`, as `WorkerChatBot` does.
+
+  Workers use a temporary home directory, so that their global database is separate from the real one.
+  """
+  pool: WorkerPool
+  channel_of: dict[int, int]
+  log: str
+
+  def __init__(
+    self,
+    response_ratio: float,
+    *,
+    workers: int,
+    url: str,
+    local_embedding: bool,
+    home: str,
+    worker_args: list[str] | None = None,
+  ) -> None:
+    super().__init__(response_ratio)
+    self.channel_of = {}
+    argv = [
+      '--bot-id', str(self.user.id), '--bot-name', self.user.display_name,
+      '--response-ratio', str(response_ratio),
+      '--api-key', 'standin',
+      '--api-base', url,
+      '--shards', join(home, 'shards'),
+    ]  # yapf: disable
+    if local_embedding:
+      argv.append('--local-embedding')
+    argv += worker_args or []
+    makedirs(home, exist_ok=True)
+    self.log = join(home, 'workers.log')
+    self.pool = WorkerPool(
+      workers, argv, self.on_worker_event, env={**os.environ, 'HOME': home}, stderr=open(self.log, 'ab')
+    )
+
+  def on_worker_event(self, worker: WorkerProcess, event: dict[str, Any]) -> None:
+    if event['type'] == 'send':
+      self.replied(event['channel'], event['reply_to'])
+    elif event['type'] == 'done':
+      self.finished(self.channel_of.pop(event['id']), event['id'])
+
+  def post(self, message: FakeMessage) -> None:
+    self.channel_of[message.id] = message.channel.id
+    self.pool.dispatch({
+      'type': 'message',
+      'id': message.id,
+      'channel': message.channel.id,
+      'author': {'id': message.author.id, 'name': message.author.display_name},
+      'content': message.content,
+      'clean_content': message.clean_content,
+      'mentions': [{'id': u.id, 'name': u.display_name} for u in message.mentions],
+      'reference': False,
+    })
+
+  def rss(self) -> int:
+    return rss() + sum(rss(w.process.pid) for w in self.pool.workers if w.process is not None)
+
+  async def close(self) -> None:
+    await self.pool.close()
+
+
+def _percentiles(values: list[float]) -> str:
+  if not values:
+    return '-'
+  cuts = quantiles(values, n=100, method='inclusive') if len(values) > 1 else [values[0]] * 99
+  return (
+    f'p50 {cuts[49] * 1000:.1f} ms, p90 {cuts[89] * 1000:.1f} ms, p99 {cuts[98] * 1000:.1f} ms, '
+    f'max {max(values) * 1000:.1f} ms'
+  )
+
+
+async def loadtest(
+  events: list[Event],
+  *,
+  url: str | None,
+  latency: float,
+  response_ratio: float,
+  local_embedding: bool,
+  data: str,
+  workers: int,
+  speed: float,
+  stats: bool,
+  memory: Namespace,
+) -> None:
+  standin = None
+  if url is None:
+    standin = StandIn(latency=latency, dims=256)
+    url = await standin.start()
+  oai.api_base = url
+
+  test: LoadTest
+  if workers:
+    test = WorkerLoadTest(
+      response_ratio,
+      workers=workers,
+      url=url,
+      local_embedding=local_embedding,
+      home=data,
+      worker_args=memory_argv(memory),
+    )
+    await test.pool.start()
+  else:
+    embedding = HashedNgramEmbedding() if local_embedding else None
+    test = InProcessLoadTest(response_ratio, shards=data, embedding=embedding, memory=memory_config(memory))
+
+  rss_start = test.rss()
+  try:
+    elapsed = await test.run(events, speed)
+    rss_end = test.rss()
+  finally:
+    await test.close()
+    await openai_client.close()
+    if standin is not None:
+      await standin.stop()
+
+  channels = len(test.channels)
+  offered = len(events) / (events[-1].at / speed) if events and events[-1].at > 0 else float('nan')
+  dropped = sum(metrics.counters.get('replies_dropped_total', {}).values())
+  print(f'endpoint: {url}, data: {data}' + (f', {workers} workers logging to {test.log}' if workers else ''))
+  print(f'messages: {len(events)} in {channels} channels, offered {offered:.1f} msg/s, '
+        f'processed {len(events) / max(elapsed, 1e-9):.1f} msg/s in {elapsed:.2f} s')
+  if workers:
+    print(f'replies: {len(test.reply_latencies)}')
+  else:
+    print(f'replies: {len(test.reply_latencies)}, dropped {dropped:g}, errors {test.errors}')
+  print(f'reply latency: {_percentiles(test.reply_latencies)}')
+  print(f'handling latency: {_percentiles(test.handle_latencies)}')
+  if test.samples:
+    print(
+      f'messages in flight: mean {mean(test.samples):.1f}, max {max(test.samples)}, '
+      f'max per channel {max(test.peak_per_channel.values(), default=0)}'
+    )
+  print(
+    f'memory: rss {rss_start / 2**20:.1f} -> {rss_end / 2**20:.1f} MiB, '
+    f'{(rss_end - rss_start) / max(channels, 1) / 1024:.1f} KiB per channel'
+  )
+  if stats:
+    print(metrics.summary())
+
+
+def main(argv: list[str]) -> None:
+  parser = ArgumentParser(
+    prog='python -m openai_secretary.tools loadtest',
+    description='drive the Discord bot with recorded or synthetic traffic against a local OpenAI stand-in.',
+  )
+  parser.add_argument('--replay', default=None, help='JSONL traffic to replay instead of synthetic traffic.')
+  parser.add_argument('--speed', type=float, default=1.0, help='replay speed multiplier.')
+  parser.add_argument('--channels', type=int, default=8, help='number of synthetic channels.')
+  parser.add_argument('--rate', type=float, default=10.0, help='synthetic messages per second over all channels.')
+  parser.add_argument('--duration', type=float, default=30.0, help='seconds of synthetic traffic.')
+  parser.add_argument(
+    '--mention-ratio', type=float, default=0.1, help='ratio of synthetic messages mentioning the bot.'
+  )
+  parser.add_argument('--users', type=int, default=5, help='number of synthetic authors.')
+  parser.add_argument('--seed', type=int, default=0, help='seed of synthetic traffic.')
+  parser.add_argument('--response-ratio', type=float, default=0.2, help='response ratio of every channel.')
+  parser.add_argument('--url', default=None, help='API base URL. A local stand-in server is started by default.')
+  parser.add_argument('--latency', type=float, default=0.3, help='response delay of the stand-in server in seconds.')
+  parser.add_argument('--local-embedding', action='store_true', help='embed texts locally instead of by the API.')
+  parser.add_argument('--data', default=None, help='directory of databases of the test. temporary by default.')
+  parser.add_argument('--workers', type=int, default=0, help='run the bot in this many worker processes.')
+  parser.add_argument('--stats', action='store_true', help='print stage latencies and counters afterwards.')
+  add_memory_arguments(parser)
+  args = parser.parse_args(argv)
+
+  data = abspath(args.data or mkdtemp(prefix='oai_secretary_loadtest_'))
+  if not args.workers and not db_path.startswith(join(data, '')):
+    # the global database is bound when the package is imported, so that the bot runs in a child process whose home
+    # directory is the data directory.
+    makedirs(data, exist_ok=True)
+    child = subprocess.run(
+      [sys.executable, '-m', 'openai_secretary.tools', 'loadtest', *argv, '--data', data],
+      env={**os.environ, 'HOME': data},
+    )
+    sys.exit(child.returncode)
+
+  if args.replay is not None:
+    events = replay(args.replay)
+  else:
+    events = synthetic(args.channels, args.rate, args.duration, args.mention_ratio, args.users, args.seed)
+
+  asyncio.run(
+    loadtest(
+      events,
+      url=args.url,
+      latency=args.latency,
+      response_ratio=args.response_ratio,
+      local_embedding=args.local_embedding,
+      data=data,
+      workers=args.workers,
+      speed=args.speed,
+      stats=args.stats,
+      memory=args,
+    )
+  )
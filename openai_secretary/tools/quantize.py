@@ -0,0 +1,128 @@
+from argparse import ArgumentParser
+import json
+from os.path import getsize
+from random import sample
+from time import perf_counter
+
+from pony.orm import commit, db_session, desc, raw_sql, select
+
+from openai_secretary.database import db
+from openai_secretary.database.connection import db_path
+from openai_secretary.database.models import Message, QuantizedEmbedding
+from openai_secretary.memory.quantize import Quantization, quantize_query, quantized_candidates, store_quantized
+
+
+def backfill(conversation_id: int | None, batch: int) -> int:
+  """
+  Store quantized codes of every embedded message which has none yet.
+  """
+  done = 0
+
+  while True:
+    with db_session:
+      # yapf: disable
+      msgs = select(
+        m for m in Message
+        if m.embeddings is not None and m.quantized is None
+        and (conversation_id is None or m.conversation.id == conversation_id)
+      )[:batch]
+      # yapf: enable
+
+      for m in msgs:
+        store_quantized(m, json.loads(m.embeddings))
+      commit()
+
+    done += len(msgs)
+    if len(msgs) < batch:
+      return done
+
+
+def exact_top(m: Message, search_vec: str, limit: int, ids: list[int] | None = None) -> list[int]:
+  c, space = m.conversation, m.space
+  # yapf: disable
+  query = select(
+    (o.id, raw_sql('similarity(o.embeddings, $search_vec) as "sim"', result_type=float))
+    for o in Message if o.embeddings is not None and o.space == space and o.conversation == c and o.id != m.id
+  )
+  if ids is not None:
+    query = query.filter(lambda i, s: i in ids)
+  return [i for i, _ in query.order_by(lambda i, s: desc(raw_sql('"sim"')))[:limit]]
+  # yapf: enable
+
+
+@db_session
+def bench(conversation_id: int | None, queries: int, rerank: int) -> None:
+  # yapf: disable
+  cond = '' if conversation_id is None else f'WHERE m."conversation" = {int(conversation_id)}'
+  text, int8, bits, rows = db.select(
+    'SELECT SUM(LENGTH(m."embeddings")), SUM(LENGTH(q."int8")), SUM(LENGTH(q."bits")), COUNT(*) '
+    f'FROM "QuantizedEmbedding" q JOIN "Message" m ON m."id" = q."message" {cond}'
+  )[0]
+  # yapf: enable
+
+  if not rows:
+    print('no quantized messages found.')
+    return
+
+  print(f'database file:      {getsize(db_path) / 2**20:10.2f} MiB')
+  print(f'text embeddings:    {text / 2**20:10.2f} MiB ({text / rows:.0f} B/row, {rows} rows)')
+  print(f'int8 codes:         {int8 / 2**20:10.2f} MiB ({int8 / rows:.0f} B/row)')
+  print(f'binary codes:       {bits / 2**20:10.2f} MiB ({bits / rows:.0f} B/row)')
+
+  # yapf: disable
+  ids = select(
+    q.message.id for q in QuantizedEmbedding
+    if conversation_id is None or q.message.conversation.id == conversation_id
+  )[:]
+  # yapf: enable
+
+  timings: dict[str, float] = {'exact': 0.0, 'int8': 0.0, 'binary': 0.0}
+  hits: dict[str, int] = {'int8': 0, 'binary': 0}
+  relevant = 0
+  picked = sample(list(ids), min(queries, len(ids)))
+
+  for mid in picked:
+    m = Message[mid]
+    search_vec = m.embeddings
+    vec = json.loads(search_vec)
+
+    start = perf_counter()
+    expected = exact_top(m, search_vec, 10)
+    timings['exact'] += perf_counter() - start
+    relevant += len(expected)
+
+    kind: Quantization
+    for kind in ('int8', 'binary'):
+      start = perf_counter()
+      code = quantize_query(vec, kind)
+      candidates = quantized_candidates(m.conversation, m.space, code, kind, -1, 2**62, rerank + 1)
+      actual = exact_top(m, search_vec, 10, candidates)
+      timings[kind] += perf_counter() - start
+      hits[kind] += len(set(actual) & set(expected))
+
+  n = len(picked)
+  print(f'queries:            {n} (rerank {rerank})')
+  print(f'exact scan:         {timings["exact"] / n * 1000:10.2f} ms/query')
+  for kind in ('int8', 'binary'):
+    print(
+      f'{kind + " + rerank:":20}{timings[kind] / n * 1000:10.2f} ms/query, '
+      f'recall@10 {hits[kind] / max(relevant, 1):.3f}'
+    )
+
+
+def main(argv: list[str]) -> None:
+  parser = ArgumentParser(
+    prog='python -m openai_secretary.tools quantize',
+    description='store int8 and binary codes of message embeddings, and optionally benchmark quantized recall.',
+  )
+  parser.add_argument('--conversation', type=int, default=None, help='restrict to a conversation.')
+  parser.add_argument('--batch', type=int, default=1000, help='messages quantized per transaction.')
+  parser.add_argument('--bench', action='store_true', help='report database size, scan time and recall@10.')
+  parser.add_argument('--queries', type=int, default=50, help='number of sampled queries for the benchmark.')
+  parser.add_argument('--rerank', type=int, default=300, help='number of candidates re-ranked exactly.')
+  args = parser.parse_args(argv)
+
+  print(f'{backfill(args.conversation, args.batch)} messages are quantized.')
+
+  if args.bench:
+    bench(args.conversation, args.queries, args.rerank)
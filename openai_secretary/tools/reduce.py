@@ -0,0 +1,116 @@
+from argparse import ArgumentParser
+import json
+from random import sample
+from time import perf_counter
+
+import numpy as np
+from pony.orm import db_session, select
+
+from openai_secretary.database import db
+from openai_secretary.database.models import Conversation, Message
+from openai_secretary.memory.reduction import ReductionMethod, create_reducer, fit, format_vector, reproject
+from openai_secretary.tools.quantize import exact_top
+
+
+@db_session
+def report(conversation_id: int, dims: list[int], method: ReductionMethod, queries: int, rerank: int) -> None:
+  """
+  Fit throwaway reducers at each target dimension, and compare recall@10 and scan time against exact recall.
+  """
+  c = Conversation[conversation_id]
+  space = c.latest_space()
+  # yapf: disable
+  rows = select(
+    (m.id, m.embeddings) for m in Message if m.conversation == c and m.embeddings is not None and m.space == space
+  )[:]
+  # yapf: enable
+  if not rows:
+    print(f'conversation {conversation_id} has no embedded messages.')
+    return
+
+  ids = [i for i, _ in rows]
+  vecs = np.array([json.loads(e) for _, e in rows], dtype=np.float32)
+  picked = sample(range(len(rows)), min(queries, len(rows)))
+
+  exact: dict[int, list[int]] = {}
+  elapsed = 0.0
+  for i in picked:
+    m = Message[ids[i]]
+    start = perf_counter()
+    exact[i] = exact_top(m, m.embeddings, 10)
+    elapsed += perf_counter() - start
+
+  size = sum(len(e) for _, e in rows) / len(rows)
+  print(f'messages:   {len(rows)}, queries: {len(picked)}, rerank: {rerank}')
+  print(f'{"dims":>6} {"B/row":>8} {"ms/query":>10} {"recall@10":>10}')
+  print(f'{len(vecs[0]):>6} {size:>8.0f} {elapsed / len(picked) * 1000:>10.2f} {1.0:>10.3f}')
+
+  connection = db.get_connection()
+  for d in dims:
+    mean, matrix = fit(vecs, d, method)
+    reduced = [format_vector(v) for v in (vecs - mean) @ matrix.T]
+
+    connection.execute('DROP TABLE IF EXISTS temp.reduction_report')
+    connection.execute('CREATE TEMP TABLE reduction_report (id INTEGER PRIMARY KEY, vector TEXT)')
+    connection.executemany('INSERT INTO temp.reduction_report VALUES (?, ?)', zip(ids, reduced))
+
+    hits = relevant = 0
+    elapsed = 0.0
+    for i in picked:
+      m = Message[ids[i]]
+      start = perf_counter()
+      candidates = [
+        row[0] for row in connection.execute(
+          'SELECT id FROM temp.reduction_report WHERE id != ? ORDER BY similarity(vector, ?) DESC LIMIT ?',
+          (m.id, reduced[i], rerank),
+        )
+      ]
+      actual = exact_top(m, m.embeddings, 10, candidates)
+      elapsed += perf_counter() - start
+      hits += len(set(actual) & set(exact[i]))
+      relevant += len(exact[i])
+
+    size = sum(len(v) for v in reduced) / len(reduced)
+    print(f'{matrix.shape[0]:>6} {size:>8.0f} {elapsed / len(picked) * 1000:>10.2f} {hits / max(relevant, 1):>10.3f}')
+
+  connection.execute('DROP TABLE IF EXISTS temp.reduction_report')
+
+
+def main(argv: list[str]) -> None:
+  parser = ArgumentParser(
+    prog='python -m openai_secretary.tools reduce',
+    description='fit dimensionality reducers for recall vectors and project stored messages with them.',
+  )
+  common = ArgumentParser(add_help=False)
+  common.add_argument('--conversation', type=int, required=True, help='conversation to work on.')
+  common.add_argument('--batch', type=int, default=1000, help='messages projected per transaction.')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  fit_parser = commands.add_parser(
+    'fit', aliases=['refit'], parents=[common], help='fit a new reducer and re-project every message.'
+  )
+  fit_parser.add_argument('--dims', type=int, default=256, help='target dimension.')
+  fit_parser.add_argument('--method', choices=['pca', 'random'], default='pca')
+  fit_parser.add_argument('--samples', type=int, default=None, help='fit on a random sample of messages.')
+
+  commands.add_parser('reproject', parents=[common], help='project messages not projected by the active reducer yet.')
+
+  report_parser = commands.add_parser(
+    'report', parents=[common], help='report recall quality and latency at several dimensions.'
+  )
+  report_parser.add_argument('--dims', default='32,64,128,256,512', help='comma separated target dimensions.')
+  report_parser.add_argument('--method', choices=['pca', 'random'], default='pca')
+  report_parser.add_argument('--queries', type=int, default=50, help='number of sampled queries.')
+  report_parser.add_argument('--rerank', type=int, default=300, help='number of candidates re-ranked exactly.')
+
+  args = parser.parse_args(argv)
+
+  match args.command:
+    case 'fit' | 'refit':
+      rid = create_reducer(args.conversation, args.dims, args.method, args.samples)
+      print(f'reducer {rid} is fitted.')
+      print(f'{reproject(args.conversation, args.batch)} messages are projected.')
+    case 'reproject':
+      print(f'{reproject(args.conversation, args.batch)} messages are projected.')
+    case 'report':
+      report(args.conversation, [int(d) for d in args.dims.split(',')], args.method, args.queries, args.rerank)
@@ -0,0 +1,194 @@
+from argparse import ArgumentParser
+from contextlib import closing
+from datetime import timedelta
+from os.path import getsize
+import sqlite3
+from statistics import median
+from time import perf_counter
+from typing import NamedTuple
+
+from pony.orm import db_session, desc, select
+
+from openai_secretary.database.models import Conversation, Message
+from openai_secretary.database.sharding import ShardLayout, enable_sharding, shard
+from openai_secretary.memory import RetentionPolicy, TieredMemory
+from openai_secretary.memory.retention import conversation_ids, databases, file_stats, incremental_vacuum, prune_batch
+
+
+class Query(NamedTuple):
+  conversation: int
+  vector: str
+  space: str
+  index: int
+
+
+def count_messages(paths: list[str]) -> int:
+  total = 0
+  for path in paths:
+    with closing(sqlite3.connect(path)) as connection:
+      if connection.execute('SELECT 1 FROM sqlite_master WHERE "name" = \'Message\'').fetchone():
+        total += connection.execute('SELECT COUNT(*) FROM "Message"').fetchone()[0]
+  return total
+
+
+def file_sizes(paths: list[str]) -> int:
+  return sum(getsize(path) for path in paths)
+
+
+def sample_queries(cids: list[int], per_conversation: int) -> list[Query]:
+  """
+  Take the latest embedded messages of conversations as recall queries, which survive pruning unless `max_rows` is
+  smaller than `per_conversation`.
+  """
+  queries: list[Query] = []
+  for cid in cids:
+    with shard(cid), db_session:
+      # yapf: disable
+      latest = select(
+        m for m in Message if m.conversation.id == cid and m.embeddings is not None
+      ).order_by(lambda m: desc(m.index))[:per_conversation]
+      # yapf: enable
+      for m in latest:
+        queries.append(Query(cid, m.embeddings, m.space, m.index))
+  return queries
+
+
+def time_recall(queries: list[Query]) -> float:
+  """
+  Median seconds `TieredMemory.recall` with the default configuration takes for the queries.
+  """
+  memory = TieredMemory()
+  timings: list[float] = []
+  for q in queries:
+    with shard(q.conversation), db_session:
+      c = Conversation[q.conversation]
+      start = perf_counter()
+      memory.recall(c, q.vector, q.space, q.index)
+      timings.append(perf_counter() - start)
+  return median(timings) if timings else 0.0
+
+
+def report(paths: list[str]) -> None:
+  for path in paths:
+    stats = file_stats(path)
+    mode = {0: 'none', 1: 'full', 2: 'incremental'}[stats['auto_vacuum']]
+    print(
+      f'{path}: {getsize(path) / 2**20:.2f} MiB, {stats["page_count"]} pages, {stats["freelist_count"]} free, '
+      f'auto_vacuum {mode}'
+    )
+  print(f'messages: {count_messages(paths)}')
+
+
+def prune(
+  paths: list[str],
+  cids: list[int],
+  policy: RetentionPolicy,
+  batch: int,
+  vacuum: bool,
+  queries: int,
+) -> None:
+  """
+  Prune conversations, and print the space reclaimed and the recall latency before and after pruning.
+  """
+  sampled = sample_queries(cids, queries)
+  size_before = file_sizes(paths)
+  messages_before = count_messages(paths)
+  latency_before = time_recall(sampled)
+
+  for cid in cids:
+    pruned = 0
+    while (deleted := prune_batch(cid, policy, batch)) > 0:
+      pruned += deleted
+      if deleted < batch:
+        break
+    if pruned:
+      print(f'conversation {cid}: {pruned} messages are pruned.')
+
+  released = 0
+  if vacuum:
+    for path in paths:
+      released += incremental_vacuum(path)
+      if file_stats(path)['auto_vacuum'] != 2:
+        print(f'{path} is not in the incremental auto-vacuum mode. run `retention vacuum --convert` to shrink it.')
+
+  size_after = file_sizes(paths)
+  messages_after = count_messages(paths)
+  latency_after = time_recall(sampled)
+
+  print(f'messages:       {messages_before} -> {messages_after} ({messages_before - messages_after} pruned)')
+  print(
+    f'database files: {size_before / 2**20:.2f} MiB -> {size_after / 2**20:.2f} MiB '
+    f'({(size_before - size_after) / 2**20:.2f} MiB reclaimed, {released} pages released)'
+  )
+  if sampled:
+    print(
+      f'recall:         {latency_before * 1000:.2f} ms -> {latency_after * 1000:.2f} ms per query '
+      f'(median of {len(sampled)} queries, x{latency_before / max(latency_after, 1e-9):.2f})'
+    )
+
+
+def convert(paths: list[str]) -> None:
+  """
+  Rebuild database files in the incremental auto-vacuum mode. Takes an exclusive lock and as much free disk space as
+  the file, so that it should run while the bot is stopped.
+  """
+  for path in paths:
+    before = getsize(path)
+    with closing(sqlite3.connect(path, isolation_level=None)) as connection:
+      connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+      connection.execute('VACUUM')
+    print(f'{path}: {before / 2**20:.2f} MiB -> {getsize(path) / 2**20:.2f} MiB, auto_vacuum incremental')
+
+
+def main(argv: list[str]) -> None:
+  parser = ArgumentParser(
+    prog='python -m openai_secretary.tools retention',
+    description='prune old messages and reclaim the space of the databases.',
+  )
+  parser.add_argument('--shards', default=None, help='directory of conversation databases.')
+  parser.add_argument('--buckets', type=int, default=None, help='number of conversation database files.')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  commands.add_parser('report', help='print size, free pages and auto-vacuum mode of the databases.')
+
+  prune_parser = commands.add_parser('prune', help='delete messages beyond a retention policy.')
+  prune_parser.add_argument('--conversation', type=int, default=None, help='restrict to a conversation.')
+  prune_parser.add_argument('--max-age', type=float, default=None, help='prune messages older than this many days.')
+  prune_parser.add_argument('--max-rows', type=int, default=None, help='keep this many latest messages.')
+  prune_parser.add_argument(
+    '--unsummarized', action='store_true', help='also prune messages which are not covered by a summary.'
+  )
+  prune_parser.add_argument('--batch', type=int, default=200, help='messages deleted per transaction.')
+  prune_parser.add_argument('--no-vacuum', action='store_true', help='keep the freed pages for reuse.')
+  prune_parser.add_argument(
+    '--queries', type=int, default=5, help='recall queries per conversation timed before and after pruning.'
+  )
+
+  vacuum_parser = commands.add_parser('vacuum', help='release free pages of the databases.')
+  vacuum_parser.add_argument(
+    '--convert', action='store_true', help='rebuild the databases in the incremental auto-vacuum mode first.'
+  )
+
+  args = parser.parse_args(argv)
+
+  layout = None
+  if args.shards is not None:
+    layout = enable_sharding(ShardLayout(args.shards, args.buckets))
+  paths = databases(layout)
+
+  match args.command:
+    case 'report':
+      report(paths)
+    case 'prune':
+      policy = RetentionPolicy(
+        max_age=timedelta(days=args.max_age) if args.max_age is not None else None,
+        max_rows=args.max_rows,
+        summarized=not args.unsummarized,
+      )
+      cids = [args.conversation] if args.conversation is not None else conversation_ids(paths)
+      prune(paths, cids, policy, args.batch, not args.no_vacuum, args.queries)
+    case 'vacuum':
+      if args.convert:
+        convert(paths)
+      for path in paths:
+        print(f'{path}: {incremental_vacuum(path)} pages are released.')
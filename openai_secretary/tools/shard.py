@@ -0,0 +1,85 @@
+from argparse import ArgumentParser
+from contextlib import closing
+from os import makedirs
+import sqlite3
+
+from openai_secretary.database.connection import db_path
+from openai_secretary.database.sharding import ShardLayout, create_shard_tables, shard_tables
+
+_conditions: dict[str, str] = {
+  'Conversation': '"id" = :cid',
+  'Message': '"conversation" = :cid',
+  'Summary': '"conversation" = :cid',
+  'Reducer': '"conversation" = :cid',
+  'ReducedEmbedding': '"message" IN (SELECT "id" FROM "global"."Message" WHERE "conversation" = :cid)',
+  'QuantizedEmbedding': '"message" IN (SELECT "id" FROM "global"."Message" WHERE "conversation" = :cid)',
+  'EmotionCheckpoint': '"id" = :cid',
+  'SavedEmotion': '"id" = :cid',
+}
+"""
+Rows of each shard table which belong to the conversation `:cid`.
+"""
+
+
+def split(layout: ShardLayout, prune: bool) -> None:
+  """
+  Copy every conversation of the global database into its shard file. Conversations already present in their shard
+  are skipped, so that an interrupted split can be run again.
+  """
+  makedirs(layout.directory, exist_ok=True)
+  with closing(sqlite3.connect(db_path)) as source:
+    cids = [cid for cid, in source.execute('SELECT "id" FROM "Conversation" ORDER BY "id"')]
+
+  for cid in cids:
+    path = layout.path(cid)
+    connection = sqlite3.connect(path, isolation_level=None)
+    try:
+      connection.execute('ATTACH DATABASE ? AS "global"', (db_path, ))
+      create_shard_tables(connection)
+
+      if connection.execute('SELECT 1 FROM "Conversation" WHERE "id" = ?', (cid, )).fetchone():
+        print(f'conversation {cid} is already in {path}, skipped.')
+        continue
+
+      connection.execute('BEGIN IMMEDIATE')
+      counts = []
+      for table in shard_tables:
+        cursor = connection.execute(
+          f'INSERT INTO main."{table}" SELECT * FROM "global"."{table}" WHERE {_conditions[table]}', {'cid': cid}
+        )
+        counts.append(f'{table} {cursor.rowcount}')
+      connection.execute('COMMIT')
+      print(f'conversation {cid} -> {path}: {", ".join(counts)}')
+    finally:
+      connection.close()
+
+  if not prune:
+    return
+
+  with closing(sqlite3.connect(db_path, isolation_level=None)) as source:
+    source.execute('BEGIN IMMEDIATE')
+    for table in reversed(shard_tables):
+      source.execute(f'DELETE FROM "{table}"')
+    source.execute('COMMIT')
+    source.execute('VACUUM')
+  print('conversations are removed from the global database.')
+
+
+def main(argv: list[str]) -> None:
+  parser = ArgumentParser(
+    prog='python -m openai_secretary.tools shard',
+    description='move conversations of the global database into per conversation database files.',
+  )
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  split_parser = commands.add_parser('split', help='copy every conversation into its shard file.')
+  split_parser.add_argument('--directory', default=ShardLayout.directory, help='shard directory.')
+  split_parser.add_argument('--buckets', type=int, default=None, help='hash conversations into this many files.')
+  split_parser.add_argument(
+    '--prune', action='store_true', help='remove the conversations from the global database afterwards.'
+  )
+
+  args = parser.parse_args(argv)
+
+  if args.command == 'split':
+    split(ShardLayout(args.directory, args.buckets), args.prune)
@@ -0,0 +1,134 @@
+from argparse import ArgumentParser
+import asyncio
+from hashlib import blake2b
+import random
+import re
+
+from aiohttp import web
+
+from openai_secretary.metrics import metrics
+
+_numbered_text = re.compile(r'^text \d+:', re.MULTILINE)
+
+
+def fake_embedding(text: str, dims: int) -> list[float]:
+  """
+  Deterministic unit vector of `text`, so that identical texts are identical in the stand-in's embedding space.
+  """
+  rng = random.Random(blake2b(text.encode()).digest())
+  vec = [rng.gauss(0.0, 1.0) for _ in range(dims)]
+  norm = sum(x * x for x in vec)**0.5
+  return [x / norm for x in vec]
+
+
+def _usage(prompt: str, completion: str = '') -> dict[str, int]:
+  tokens = len(prompt) // 4 + 1, len(completion) // 4
+  return {'prompt_tokens': tokens[0], 'completion_tokens': tokens[1], 'total_tokens': sum(tokens)}
+
+
+class StandIn:
+  """
+  StandIn is a local server speaking the subset of the OpenAI API used by the agent, for benchmarks and load tests.
+
+  Every response is delayed by `latency` seconds to emulate the API's processing time.
+  """
+  latency: float
+  dims: int
+  runner: web.AppRunner | None = None
+
+  def __init__(self, *, latency: float = 0.0, dims: int = 1536) -> None:
+    self.latency = latency
+    self.dims = dims
+
+  def app(self) -> web.Application:
+    app = web.Application()
+    app.router.add_post('/v1/embeddings', self.embeddings)
+    app.router.add_post('/v1/completions', self.completions)
+    app.router.add_post('/v1/chat/completions', self.chat_completions)
+    return app
+
+  async def _body(self, request: web.Request, endpoint: str) -> dict:
+    body = await request.json()
+    metrics.inc('standin_requests_total', endpoint=endpoint)
+    if self.latency:
+      await asyncio.sleep(self.latency)
+    return body
+
+  async def embeddings(self, request: web.Request) -> web.Response:
+    body = await self._body(request, 'embeddings')
+    inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+    data = [
+      {'object': 'embedding', 'index': i, 'embedding': fake_embedding(text, self.dims)} for i, text in enumerate(inputs)
+    ]
+    usage = _usage(''.join(inputs))
+    return web.json_response({'object': 'list', 'data': data, 'model': body['model'], 'usage': usage})
+
+  async def completions(self, request: web.Request) -> web.Response:
+    body = await self._body(request, 'completions')
+    rng = random.Random(blake2b(body['prompt'].encode()).digest())
+    # batched emotion prompts list numbered texts and expect one evaluation for each of them.
+    if texts := len(_numbered_text.findall(body['prompt'])):
+      text = str([[rng.randint(-3, 3) for _ in range(5)] for _ in range(texts)])
+    else:
+      text = str([rng.randint(-3, 3) for _ in range(5)])
+    return web.json_response({
+      'object': 'text_completion',
+      'model': body['model'],
+      'choices': [{'index': 0, 'text': text, 'finish_reason': 'stop'}],
+      'usage': _usage(body['prompt'], text),
+    })
+
+  async def chat_completions(self, request: web.Request) -> web.Response:
+    body = await self._body(request, 'chat_completions')
+    prompt = body['messages'][-1]['content']
+    text = f'「{prompt[:40]}」についてですね。'
+    return web.json_response({
+      'object': 'chat.completion',
+      'model': body['model'],
+      'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+      'usage': _usage(''.join(m['content'] for m in body['messages']), text),
+    })
+
+  async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+    """
+    Start serving in the running event loop.
+
+    Returns:
+      str: Base URL to be set to `openai.api_base`.
+    """
+    self.runner = web.AppRunner(self.app(), access_log=None)
+    await self.runner.setup()
+    site = web.TCPSite(self.runner, host, port)
+    await site.start()
+    bound_host, bound_port = self.runner.addresses[0][:2]
+    return f'http://{bound_host}:{bound_port}/v1'
+
+  async def stop(self) -> None:
+    if self.runner is not None:
+      await self.runner.cleanup()
+      self.runner = None
+
+
+def main(argv: list[str]) -> None:
+  parser = ArgumentParser(
+    prog='python -m openai_secretary.tools standin',
+    description='serve a local stand-in of the OpenAI API.',
+  )
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--latency', type=float, default=0.0, help='seconds each response is delayed by.')
+  parser.add_argument('--dims', type=int, default=1536, help='dimension of embeddings.')
+  args = parser.parse_args(argv)
+
+  async def serve() -> None:
+    standin = StandIn(latency=args.latency, dims=args.dims)
+    print(f'serving at {await standin.start(args.host, args.port)}')
+    try:
+      await asyncio.Event().wait()
+    finally:
+      await standin.stop()
+
+  try:
+    asyncio.run(serve())
+  except KeyboardInterrupt:
+    pass
@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# the database binds to ~/.oai_secretary/master.db when it is imported, so that tests use a scratch home.
+os.environ['HOME'] = tempfile.mkdtemp(prefix='oai-secretary-tests-')
@@ -0,0 +1,15 @@
+from datetime import datetime
+
+from openai_secretary.resource.emotion import Emotion
+
+
+def test_checkpoint_record_round_trip() -> None:
+  emotion = Emotion(0.1, 0.2, 0.3, 0.4, 0.5)
+  emotion._created = datetime(2023, 4, 1, 12, 30, 15, 250000)
+  data = emotion.to_bytes()
+  restored = Emotion.from_bytes(data)
+
+  assert len(data) == 48
+  assert restored == emotion
+  assert restored._created == emotion._created
+  assert restored.json() == emotion.json()
@@ -0,0 +1,16 @@
+from openai_secretary.memory.lexical import fuse
+
+
+def test_fuse_prefers_items_ranked_by_both() -> None:
+  assert fuse([[1, 2, 3], [3, 4, 1]])[:2] == [1, 3]
+
+
+def test_fuse_keeps_every_item_once() -> None:
+  fused = fuse([[5, 6], [7], [6, 8]])
+  assert sorted(fused) == [5, 6, 7, 8]
+  assert fused[0] == 6
+
+
+def test_fuse_of_a_single_ranking_keeps_its_order() -> None:
+  assert fuse([[9, 3, 7]]) == [9, 3, 7]
+  assert fuse([]) == []
@@ -0,0 +1,29 @@
+from openai_secretary.metrics import Metrics
+
+
+def test_every_sample_belongs_to_a_declared_family() -> None:
+  metrics = Metrics()
+  metrics.inc('messages_total', conversation=1)
+  metrics.observe('stage_seconds', 0.3, stage='reply')
+  metrics.observe('stage_seconds', 0.02, stage='embed')
+
+  declared: dict[str, str] = {}
+  for line in metrics.render().splitlines():
+    if line.startswith('# TYPE '):
+      name, kind = line[len('# TYPE '):].split()
+      declared[name] = kind
+      continue
+    name = line.split('{')[0].split()[0]
+    family = name.removesuffix('_bucket').removesuffix('_sum').removesuffix('_count')
+    assert name in declared or declared.get(family) == 'histogram', line
+
+
+def test_histogram_buckets_are_cumulative() -> None:
+  metrics = Metrics()
+  for seconds in (0.001, 0.2, 0.2, 40.0):
+    metrics.observe('stage_seconds', seconds, stage='reply')
+
+  buckets = [line for line in metrics.render().splitlines() if line.startswith('oai_secretary_stage_seconds_bucket')]
+  counts = [int(line.rsplit(' ', 1)[1]) for line in buckets]
+  assert counts == sorted(counts)
+  assert buckets[-1].endswith('le="+Inf"} 4')
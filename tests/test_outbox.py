@@ -0,0 +1,64 @@
+import asyncio
+from time import monotonic
+
+from openai_secretary.discord.outbox import Outbox
+
+
+class Channel:
+  id = 1
+
+  def __init__(self) -> None:
+    self.sent: list[float] = []
+
+  async def send(self, content: str) -> None:
+    self.sent.append(monotonic())
+
+
+def test_no_window_holds_more_than_burst_sends() -> None:
+  window = 0.2
+
+  async def run() -> list[float]:
+    outbox = Outbox(burst=5, window=window)
+    channel = Channel()
+    for i in range(17):
+      outbox.send(channel, f'message {i}')
+    await outbox.close()
+    return channel.sent
+
+  sent = asyncio.run(run())
+  assert len(sent) == 17
+  for i, start in enumerate(sent):
+    assert sum(1 for t in sent[i:] if t < start + window) <= 5
+
+
+def test_system_messages_are_merged() -> None:
+
+  async def run() -> list[str]:
+    outbox = Outbox()
+    contents: list[str] = []
+
+    class Recorder(Channel):
+
+      async def send(self, content: str) -> None:
+        contents.append(content)
+
+    channel = Recorder()
+    outbox.system(channel, 'a')
+    outbox.system(channel, 'b')
+    await outbox.close()
+    return contents
+
+  assert asyncio.run(run()) == ['a\nb']
+
+
+def test_unwanted_replies_are_dropped() -> None:
+
+  async def run() -> list[float]:
+    outbox = Outbox()
+    channel = Channel()
+    outbox.send(channel, 'stale', wanted=lambda: False)
+    outbox.send(channel, 'fresh')
+    await outbox.close()
+    return channel.sent
+
+  assert len(asyncio.run(run())) == 1
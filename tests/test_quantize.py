@@ -0,0 +1,25 @@
+import numpy as np
+
+from openai_secretary.memory.quantize import quantize_binary, quantize_int8
+
+
+def test_int8_code_times_scale_approximates_the_unit_vector() -> None:
+  vec = np.random.default_rng(0).normal(size=256)
+  code, scale = quantize_int8(vec)
+  restored = np.frombuffer(code, dtype=np.int8) * scale
+  unit = vec / np.linalg.norm(vec)
+  assert len(code) == 256
+  assert np.abs(restored - unit).max() <= scale / 2 + 1e-6
+  assert float(restored @ unit) > 0.999
+
+
+def test_int8_of_a_zero_vector() -> None:
+  code, scale = quantize_int8([0.0, 0.0, 0.0])
+  assert code == bytes(3) and scale == 1.0
+
+
+def test_binary_code_packs_sign_bits() -> None:
+  vec = [0.5, -1.0, 2.0, -0.1, 0.0, 3.0, -2.0, 1.0, 4.0]
+  code = quantize_binary(vec)
+  assert len(code) == 2
+  assert list(np.unpackbits(np.frombuffer(code, dtype=np.uint8))[:9]) == [1, 0, 1, 0, 0, 1, 0, 1, 1]
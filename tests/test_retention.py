@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta
+
+from pony.orm import db_session, select
+
+from openai_secretary.database.models import Conversation, Message, Summary
+from openai_secretary.memory.retention import RetentionPolicy, prunable_upto, prune_batch
+
+
+def create_conversation(cid: int, messages: int, summarized_upto: int | None) -> None:
+  """
+  A system message at index 0, then user messages a day apart with the newest created now.
+  """
+  now = datetime.now()
+  with db_session:
+    c = Conversation(id=cid, name='test', description='test', created_at=now, last_interact_at=now)
+    Message(index=0, role='system', text='system', created_at=now - timedelta(days=messages), conversation=c)
+    for i in range(1, messages + 1):
+      Message(index=i, role='user', text=f'message {i}', created_at=now - timedelta(days=messages - i), conversation=c)
+    if summarized_upto is not None:
+      Summary(tier=0, first_index=1, last_index=summarized_upto, text='summary', created_at=now, conversation=c)
+
+
+def upto(cid: int, policy: RetentionPolicy) -> int | None:
+  with db_session:
+    return prunable_upto(Conversation[cid], policy)
+
+
+def test_selection_by_rows_and_age() -> None:
+  create_conversation(101, 20, None)
+  assert upto(101, RetentionPolicy(max_rows=5, summarized=False)) == 15
+  # messages 1 to 10 are at least 10 days old.
+  assert upto(101, RetentionPolicy(max_age=timedelta(days=9.5), summarized=False)) == 10
+  # the stricter of both applies.
+  assert upto(101, RetentionPolicy(max_age=timedelta(days=9.5), max_rows=5, summarized=False)) == 15
+  assert upto(101, RetentionPolicy(max_rows=50, summarized=False)) is None
+  assert upto(101, RetentionPolicy(summarized=False)) is None
+
+
+def test_selection_is_limited_to_summarized_messages() -> None:
+  create_conversation(102, 20, 8)
+  assert upto(102, RetentionPolicy()) == 8
+  assert upto(102, RetentionPolicy(max_rows=5)) == 8
+  assert upto(102, RetentionPolicy(max_rows=15)) == 5
+
+  create_conversation(103, 20, None)
+  assert upto(103, RetentionPolicy(max_rows=5)) is None
+
+
+def test_prune_batch_deletes_oldest_and_keeps_system_messages() -> None:
+  create_conversation(104, 20, None)
+  policy = RetentionPolicy(max_rows=5, summarized=False)
+  assert prune_batch(104, policy, batch=10) == 10
+  assert prune_batch(104, policy, batch=10) == 5
+  assert prune_batch(104, policy, batch=10) == 0
+  with db_session:
+    assert sorted(select(m.index for m in Message if m.conversation.id == 104)) == [0, 16, 17, 18, 19, 20]
+
+
+def test_policy_round_trip() -> None:
+  policy = RetentionPolicy(max_age=timedelta(days=90), max_rows=5000, summarized=False)
+  assert RetentionPolicy.from_dict(policy.to_dict()) == policy
+  assert RetentionPolicy.from_dict({}) == RetentionPolicy()
@@ -0,0 +1,13 @@
+from openai_secretary.scoring import parse_evaluations, split_tokens
+
+
+def test_split_tokens_is_proportional_and_exact() -> None:
+  assert split_tokens(100, [10, 20, 30]) == [17, 33, 50]
+  assert sum(split_tokens(7, [1, 1, 1])) == 7
+  assert split_tokens(5, [0, 0]) in ([3, 2], [2, 3])
+  assert split_tokens(0, [3, 4]) == [0, 0]
+
+
+def test_parse_evaluations_clamps_and_counts() -> None:
+  assert parse_evaluations('[[1, 2, 3, 4, 5], [0,0,0,0,-12]]', 2) == [[1, 2, 3, 4, 5], [0, 0, 0, 0, -10]]
+  assert parse_evaluations('[1, 2, 3, 4, 5]', 2) is None
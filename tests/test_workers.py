@@ -0,0 +1,22 @@
+from collections import Counter
+
+from openai_secretary.discord.workers import HashRing
+
+
+def test_owner_is_deterministic() -> None:
+  first, second = HashRing(4), HashRing(4)
+  assert [first.owner(c) for c in range(1000)] == [second.owner(c) for c in range(1000)]
+
+
+def test_channels_are_spread_over_workers() -> None:
+  counts = Counter(HashRing(4).owner(c) for c in range(10000))
+  assert sorted(counts) == [0, 1, 2, 3]
+  assert min(counts.values()) > 10000 / 4 * 0.6
+
+
+def test_adding_a_worker_moves_only_its_share() -> None:
+  before, after = HashRing(3), HashRing(4)
+  moved = [c for c in range(10000) if before.owner(c) != after.owner(c)]
+  # channels only move to the new worker, about a quarter of them.
+  assert all(after.owner(c) == 3 for c in moved)
+  assert len(moved) < 10000 * 0.4